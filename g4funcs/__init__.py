@@ -1,3 +1,5 @@
 from .g4regex import *
+from .g4runs import *
 from .g4filter import *
-from .g4fileutils import *
\ No newline at end of file
+from .g4fileutils import *
+from .g4parallel import *
\ No newline at end of file
@@ -8,10 +8,19 @@ author: Matthew Parker
 import os
 import sys
 import gzip
-import signal
-import subprocess
-from tempfile import mkstemp
-from itertools import groupby
+import mmap
+import heapq
+import shutil
+import struct
+import zlib
+import warnings
+from bisect import bisect_right
+from operator import itemgetter
+from tempfile import mkdtemp, mkstemp
+from collections import namedtuple, defaultdict
+from concurrent.futures import ThreadPoolExecutor
+from multiprocessing import shared_memory
+import numpy as np
 
 
 class FileWrapper(object):
@@ -26,43 +35,1021 @@ class FileWrapper(object):
         self.file.close()
 
 
+# FastaReader reads files in blocks of this many bytes
+FASTA_BLOCK_SIZE = 4194304
+
+# size of the chunks FastaReader.iter_chunks yields if no chunk_size is
+# given, so that memory use does not grow with the length of a record
+STREAM_CHUNK_SIZE = 10000000
+
+
 class FastaReader(FileWrapper):
+    '''
+    streaming fasta parser for stdin, gzipped files and file objects. The
+    input is read in blocks of block_size bytes, with newlines removed from
+    each block in bulk rather than line by line. decode_method is no longer
+    used, as sequences are always decoded as ascii, and is deprecated.
+    '''
 
-    def __init__(self, fasta, decode_method=str):
+    def __init__(self, fasta, decode_method=None, block_size=FASTA_BLOCK_SIZE):
+        if decode_method is not None:
+            warnings.warn(
+                'FastaReader decode_method is deprecated and ignored',
+                DeprecationWarning, stacklevel=2)
         if isinstance(fasta, str):
             self._open_fasta(fasta)
         else:
             self.file = fasta
-            self.decode_method = decode_method
+        self.block_size = block_size
+
+    def _iter_blocks(self):
+        '''
+        yield name, None at the start of each record, then None, seq for
+        pieces of its sequence (ascii bytes, newlines removed) as they are
+        read
+        '''
+        line_start = True
+        header = None
+        while True:
+            try:
+                block = self.file.read(self.block_size)
+            except AttributeError:
+                raise IOError('Object passed to FastaReader is not readable')
+            if not block:
+                break
+            if isinstance(block, str):
+                block = block.encode('ascii', 'replace')
+            pos = 0
+            while pos < len(block):
+                if header is not None:
+                    # header lines may be split between blocks
+                    end = block.find(b'\n', pos)
+                    if end == -1:
+                        header += block[pos:]
+                        break
+                    header += block[pos:end]
+                    # take first word of fasta header as name, remove '>'
+                    yield header.split()[0][1:].decode(), None
+                    header = None
+                    pos = end + 1
+                    line_start = True
+                elif line_start and block[pos] == ord('>'):
+                    header = b''
+                else:
+                    end = block.find(b'\n>', pos)
+                    if end == -1:
+                        end = len(block)
+                        line_start = block.endswith(b'\n')
+                    else:
+                        end += 1
+                        line_start = True
+                    piece = block[pos:end].translate(None, b'\r\n')
+                    if piece:
+                        yield None, piece
+                    pos = end
+        if header is not None:
+            yield header.split()[0][1:].decode(), None
+
+    def _iter_records(self):
+        name = None
+        for header, piece in self._iter_blocks():
+            if header is not None:
+                if name is not None:
+                    yield name, b''.join(pieces)
+                name, pieces = header, []
+            elif name is not None:
+                # sequence before the first header is ignored
+                pieces.append(piece)
+        if name is not None:
+            yield name, b''.join(pieces)
 
     def parse_fasta(self):
-        d = self.decode_method
+        for name, seq in self._iter_records():
+            yield name, seq.decode('ascii', 'replace')
 
-        def is_header(line):
-            return d(line).startswith('>')
+    def parse_regions(self, regions, pad=0):
+        '''
+        yield a SeqChunk for each interval of a RegionSet, padded by pad
+        bases, in the order of the records. Each record is read whole.
+        '''
+        for name, seq in self._iter_records():
+            seq = memoryview(seq)
+            for start, end in regions.intervals(name, pad, len(seq)):
+                yield SeqChunk(name, start, seq[start:end], end - start)
 
-        try:
-            fasta_it = groupby(self.file, is_header)
-        except TypeError:
-            raise IOError('Object passed to FastaReader is not iterable')
+    def iter_chunks(self, chunk_size=None, overlap=0, regions=None):
+        '''
+        yield the same SeqChunks as iter_chunks does for each record, but
+        while the record is still being read, so that only about
+        chunk_size + overlap bases of it are held in memory at once.
+        STREAM_CHUNK_SIZE is used if chunk_size is None. Chunk sequences
+        are ascii bytes.
+        If a RegionSet is given, only its intervals padded by overlap bases
+        are chunked (see parse_regions).
+        '''
+        if regions is not None:
+            for piece in self.parse_regions(regions, overlap):
+                for chunk in iter_chunks(piece.seq_id, piece.seq, chunk_size,
+                                         overlap, piece.offset):
+                    yield chunk
+            return
+        if chunk_size is None:
+            chunk_size = STREAM_CHUNK_SIZE
+        if chunk_size < 1:
+            raise ValueError('chunk_size should be a positive integer')
+        size = chunk_size + overlap
+        seq_id = None
+        buf = bytearray()
+        offset = 0
+        for header, piece in self._iter_blocks():
+            if header is not None:
+                if seq_id is not None:
+                    for chunk in self._last_chunks(
+                            seq_id, buf, offset, chunk_size, overlap):
+                        yield chunk
+                seq_id, buf, offset = header, bytearray(), 0
+                continue
+            if seq_id is None:
+                continue
+            buf += piece
+            # once there is more than one chunk of sequence, the record
+            # cannot be a single chunk and the first one is complete
+            while len(buf) > size:
+                yield SeqChunk(seq_id, offset, bytes(buf[:size]), chunk_size)
+                del buf[:chunk_size]
+                offset += chunk_size
+        if seq_id is not None:
+            for chunk in self._last_chunks(
+                    seq_id, buf, offset, chunk_size, overlap):
+                yield chunk
 
-        for h, group in fasta_it:
-            # take first word of fasta header as name, remove '>'
-            header = d(next(group)).split()[0][1:]
-            _, seq_it = next(fasta_it)
-            seq = ''.join(d(x).strip() for x in seq_it)
-            yield header, seq
+    @staticmethod
+    def _last_chunks(seq_id, buf, offset, chunk_size, overlap):
+        buf = bytes(buf)
+        if offset == 0:
+            for chunk in iter_chunks(seq_id, buf, chunk_size, overlap):
+                yield chunk
+            return
+        for start in range(0, len(buf), chunk_size):
+            yield SeqChunk(seq_id, offset + start,
+                           buf[start: start + chunk_size + overlap],
+                           min(chunk_size, len(buf) - start))
 
     def _open_fasta(self, fasta):
         if fasta == '-':
-            self.file = sys.stdin
-            self.decode_method = str
+            self.file = sys.stdin.buffer
         elif os.path.splitext(fasta)[1] == '.gz':
             self.file = gzip.open(fasta)
-            self.decode_method = bytes.decode
         else:
-            self.file = open(fasta)
-            self.decode_method = str
+            self.file = open(fasta, 'rb')
+
+
+# a .fai index entry (see samtools faidx): offset is the position of the
+# first base in the file, line_bases and line_width the number of bases and
+# bytes (including the newline) in each line
+FaiEntry = namedtuple(
+    'FaiEntry', ['name', 'length', 'offset', 'line_bases', 'line_width'])
+
+
+class _FaiRecord(object):
+    '''
+    line layout of a fasta record, built up from pieces of its sequence
+    (see build_fai)
+    '''
+
+    def __init__(self, name, offset):
+        self.name = name
+        self.offset = offset
+        self.line_width = None
+        self.n_newlines = self.n_cr = 0
+        # file offset of the last newline, or of a virtual one before the
+        # first line, and whether a line shorter than line_width was seen
+        self.last_newline = offset - 1
+        self.short_line = False
+
+    def add(self, seq_array, start):
+        '''
+        add the part of the record in seq_array, which is at start in the file
+        '''
+        newlines = np.flatnonzero(seq_array == ord('\n')) + start
+        self.n_cr += int(np.count_nonzero(seq_array == ord('\r')))
+        if not len(newlines):
+            return
+        widths = np.diff(newlines, prepend=self.last_newline)
+        if self.line_width is None:
+            self.line_width = int(widths[0])
+        # every line but the last must be full
+        short = widths < self.line_width
+        if (self.short_line or short[:-1].any()
+                or (widths > self.line_width).any()):
+            self.irregular()
+        self.short_line = bool(short[-1])
+        self.n_newlines += len(newlines)
+        self.last_newline = int(newlines[-1])
+
+    def entry(self, end):
+        '''
+        FaiEntry of the record, which ends at end in the file
+        '''
+        length = end - self.offset - self.n_newlines - self.n_cr
+        if self.line_width is None:
+            return FaiEntry(self.name, length, self.offset, length, length)
+        line_bases = self.line_width - 1 - (self.n_cr > 0)
+        last = end - self.last_newline - 1
+        if last and (self.short_line or last > line_bases):
+            self.irregular()
+        return FaiEntry(
+            self.name, length, self.offset, line_bases, self.line_width)
+
+    def irregular(self):
+        raise IOError(
+            'fasta record {} has lines of different lengths and cannot be '
+            'indexed'.format(self.name))
+
+
+def build_fai(pieces):
+    '''
+    list of FaiEntry for every record of an uncompressed fasta, given as an
+    iterable of consecutive pieces of the file (bytes, or memory maps), so
+    that a file never needs to be held in memory at once. Newlines are found
+    with numpy. Raises IOError if a record has lines of different lengths,
+    as it cannot be accessed by position.
+    '''
+    entries = []
+    record = None
+    header = None
+    line_start = True
+    start = 0  # position of piece in the file
+    for piece in pieces:
+        seq_array = np.frombuffer(piece, dtype=np.uint8)
+        pos = 0
+        while pos < len(piece):
+            if header is not None:
+                # header lines may be split between pieces
+                end = piece.find(b'\n', pos)
+                if end == -1:
+                    header += piece[pos:]
+                    break
+                header += piece[pos:end]
+                # take first word of fasta header as name, remove '>'
+                record = _FaiRecord(
+                    header.split()[0][1:].decode(), start + end + 1)
+                header = None
+                pos = end + 1
+                line_start = True
+            elif line_start and piece[pos] == ord('>'):
+                if record is not None:
+                    entries.append(record.entry(start + pos))
+                    record = None
+                header = b''
+            else:
+                end = piece.find(b'\n>', pos)
+                end = len(piece) if end == -1 else end + 1
+                if record is not None:
+                    record.add(seq_array[pos:end], start + pos)
+                line_start = piece[end - 1] == ord('\n')
+                pos = end
+        start += len(piece)
+    if header is not None:
+        record = _FaiRecord(header.split()[0][1:].decode(), start)
+    if record is not None:
+        entries.append(record.entry(start))
+    return entries
+
+
+def read_fai(fai_fn):
+    with open(fai_fn) as f:
+        return [FaiEntry(name, *(int(x) for x in fields[:4]))
+                for name, *fields in (line.split('\t') for line in f)]
+
+
+def write_fai(entries, fai_fn):
+    with open(fai_fn, 'w') as f:
+        for entry in entries:
+            f.write('\t'.join(str(x) for x in entry) + '\n')
+
+
+def parse_region(region):
+    '''
+    chrom, start, end from a samtools style region string, i.e.
+    chrom:start-end with 1-based, inclusive coordinates, or just chrom.
+    Returned coordinates are 0-based and half open, end is None if not given.
+    '''
+    chrom, _, span = region.rpartition(':')
+    if not chrom:
+        return region, 0, None
+    start, _, end = span.replace(',', '').partition('-')
+    try:
+        return chrom, int(start) - 1, int(end) if end else None
+    except ValueError:
+        # colon is part of the name
+        return region, 0, None
+
+
+class IndexedFastaReader(FileWrapper):
+    '''
+    memory mapped, uncompressed fasta file with a .fai index, which is read
+    from fasta.fai if it is up to date, or built (and saved there if
+    possible). Sequences are returned as ascii bytes-like objects: records
+    stored on a single line are zero copy memoryviews of the file, other
+    records have their newlines removed in bulk. Any region can be fetched
+    without reading the rest of the file.
+    '''
+
+    def __init__(self, fasta, fai=None):
+        self.file = open(fasta, 'rb')
+        self._mm = _map_file(self.file)
+        self._load_fai(fasta, fai)
+
+    def _load_fai(self, fasta, fai=None):
+        if fai is None:
+            fai = fasta + '.fai'
+        if _is_up_to_date(fai, fasta):
+            entries = read_fai(fai)
+        else:
+            try:
+                entries = self._build_fai()
+            except IOError:
+                self.close()
+                raise
+            try:
+                write_fai(entries, fai)
+            except OSError:
+                # e.g. read only directory, the index is just not reused
+                pass
+        self.names = [entry.name for entry in entries]
+        self.index = {entry.name: entry for entry in entries}
+
+    def _build_fai(self):
+        return build_fai([self._mm])
+
+    def _read(self, first, last):
+        '''
+        bytes first to last of the (uncompressed) file
+        '''
+        return memoryview(self._mm)[first:last]
+
+    def __len__(self):
+        return len(self.names)
+
+    def close(self):
+        _close_map(self._mm)
+        self.file.close()
+
+    def __exit__(self, exc_type, exc_value, exc_traceback):
+        self.close()
+
+    def fetch(self, chrom, start=0, end=None):
+        '''
+        sequence of chrom from start to end (0-based, half open)
+        '''
+        _, length, offset, line_bases, line_width = self.index[chrom]
+        start = max(start, 0)
+        end = length if end is None else min(end, length)
+        if start >= end:
+            return b''
+        first_line, first = divmod(start, line_bases)
+        last_line, last = divmod(end - 1, line_bases)
+        first += offset + first_line * line_width
+        last += offset + last_line * line_width + 1
+        seq = self._read(first, last)
+        if first_line == last_line:
+            return seq
+        return bytes(seq).translate(None, b'\r\n')
+
+    def fetch_region(self, region):
+        '''
+        sequence of a samtools style region, e.g. chr1:1001-2000
+        '''
+        if region in self.index:
+            # names can contain colons
+            return self.fetch(region)
+        return self.fetch(*parse_region(region))
+
+    def parse_fasta(self):
+        for name in self.names:
+            yield name, self.fetch(name)
+
+    def length(self, chrom):
+        return self.index[chrom].length
+
+    def _intervals(self, name, regions=None, pad=0):
+        '''
+        (start, end) intervals of record name to scan: the whole record, or
+        the intervals of a RegionSet padded by pad bases
+        '''
+        length = self.length(name)
+        if regions is None:
+            return [(0, length)]
+        return regions.intervals(name, pad, length)
+
+    def parse_regions(self, regions=None, pad=0):
+        '''
+        yield a SeqChunk for each interval of a RegionSet, padded by pad
+        bases, in the order of the records. Only the intervals are read.
+        Without a RegionSet each record is yielded whole.
+        '''
+        for name in self.names:
+            for start, end in self._intervals(name, regions, pad):
+                yield SeqChunk(name, start, self.fetch(name, start, end),
+                               end - start)
+
+    def iter_chunks(self, chunk_size=None, overlap=0, regions=None):
+        '''
+        SeqChunks of every record (see iter_chunks), which are zero copy for
+        records stored on one line. Each chunk is fetched when it is needed,
+        so only one is held in memory at a time.
+        If a RegionSet is given, only its intervals padded by overlap bases
+        are chunked and read.
+        '''
+        for name in self.names:
+            for start, end in self._intervals(name, regions, overlap):
+                for offset, size, n_owned in chunk_spans(
+                        end - start, chunk_size, overlap):
+                    offset += start
+                    yield SeqChunk(name, offset,
+                                   self.fetch(name, offset, offset + size),
+                                   n_owned)
+
+
+def _map_file(f):
+    # empty files cannot be memory mapped
+    if not os.fstat(f.fileno()).st_size:
+        return b''
+    return mmap.mmap(f.fileno(), 0, access=mmap.ACCESS_READ)
+
+
+def _close_map(mm):
+    try:
+        if mm:
+            mm.close()
+    except BufferError:
+        # memoryviews of the file still exist, the map is closed when
+        # they are garbage collected
+        pass
+
+
+def _is_up_to_date(index_fn, fn):
+    return os.path.exists(index_fn) and (
+        os.path.getmtime(index_fn) >= os.path.getmtime(fn))
+
+
+# BGZF (blocked gzip, see the SAM specification, made by bgzip) files are
+# series of gzip members of up to 64 kb each, with the size of the member in
+# a 'BC' extra field of its header
+BGZF_MAGIC = b'\x1f\x8b\x08\x04'
+
+
+def is_bgzf(fn):
+    '''
+    True if fn starts with a BGZF block header
+    '''
+    with open(fn, 'rb') as f:
+        header = f.read(18)
+    return header[:4] == BGZF_MAGIC and header[12:14] == b'BC'
+
+
+def read_gzi(gzi_fn):
+    '''
+    (compressed, uncompressed) offsets of each block from a bgzip .gzi index,
+    which does not list the first block
+    '''
+    with open(gzi_fn, 'rb') as f:
+        n_blocks = int.from_bytes(f.read(8), 'little')
+        offsets = np.frombuffer(f.read(16 * n_blocks), dtype='<u8')
+    return [(0, 0)] + [tuple(int(x) for x in pair)
+                       for pair in offsets.reshape(-1, 2)]
+
+
+def write_gzi(blocks, gzi_fn):
+    with open(gzi_fn, 'wb') as f:
+        f.write((len(blocks) - 1).to_bytes(8, 'little'))
+        f.write(np.array(blocks[1:], dtype='<u8').tobytes())
+
+
+class BgzfFile(FileWrapper):
+    '''
+    random access to the uncompressed contents of a BGZF file. Blocks are
+    located with a .gzi index (see bgzip -i), which is read from fn.gzi if
+    it is up to date or built from the block headers without decompressing
+    anything (and saved there if possible). Reads spanning several blocks
+    decompress them in parallel in a pool of threads (zlib releases the GIL),
+    threads=None uses one per cpu.
+    '''
+
+    def __init__(self, fn, gzi=None, threads=None):
+        self.file = open(fn, 'rb')
+        self._mm = _map_file(self.file)
+        if gzi is None:
+            gzi = fn + '.gzi'
+        if _is_up_to_date(gzi, fn):
+            blocks = read_gzi(gzi)
+        else:
+            try:
+                blocks = self._scan_blocks()
+            except IOError:
+                self.close()
+                raise
+            try:
+                write_gzi(blocks, gzi)
+            except OSError:
+                pass
+        coffsets, uoffsets = zip(*blocks)
+        self._coffsets = np.array(coffsets + (len(self._mm),), dtype=np.int64)
+        self._uoffsets = np.array(uoffsets, dtype=np.int64)
+        # uncompressed size of the last block is stored at the end of it
+        self.size = int(uoffsets[-1]) + int.from_bytes(
+            self._mm[-4:], 'little') if self._mm else 0
+        self._executor = ThreadPoolExecutor(threads) if threads != 1 else None
+
+    def _scan_blocks(self):
+        mm = self._mm
+        blocks = []
+        coffset = uoffset = 0
+        while coffset < len(mm):
+            block_size = self._block_size(coffset)
+            blocks.append((coffset, uoffset))
+            # ISIZE, the uncompressed size, ends the block
+            uoffset += int.from_bytes(
+                mm[coffset + block_size - 4: coffset + block_size], 'little')
+            coffset += block_size
+        return blocks or [(0, 0)]
+
+    def _block_size(self, coffset):
+        mm = self._mm
+        if mm[coffset: coffset + 4] != BGZF_MAGIC:
+            raise IOError('{} is not a BGZF file'.format(self.file.name))
+        xlen = int.from_bytes(mm[coffset + 10: coffset + 12], 'little')
+        pos = coffset + 12
+        while pos < coffset + 12 + xlen:
+            field_len = int.from_bytes(mm[pos + 2: pos + 4], 'little')
+            if mm[pos: pos + 2] == b'BC':
+                return int.from_bytes(mm[pos + 4: pos + 6], 'little') + 1
+            pos += 4 + field_len
+        raise IOError('{} is not a BGZF file'.format(self.file.name))
+
+    def _decompress(self, i):
+        coffset = int(self._coffsets[i])
+        xlen = int.from_bytes(self._mm[coffset + 10: coffset + 12], 'little')
+        # raw deflate data between the header and the CRC32/ISIZE trailer
+        return zlib.decompress(
+            self._mm[coffset + 12 + xlen: int(self._coffsets[i + 1]) - 8],
+            -15)
+
+    def read(self, first, last):
+        '''
+        uncompressed bytes first to last
+        '''
+        last = min(last, self.size)
+        if first >= last:
+            return b''
+        i = int(np.searchsorted(self._uoffsets, first, 'right')) - 1
+        j = int(np.searchsorted(self._uoffsets, last, 'left'))
+        blocks = range(i, max(j, i + 1))
+        if self._executor is not None and len(blocks) > 1:
+            data = b''.join(self._executor.map(self._decompress, blocks))
+        else:
+            data = b''.join(map(self._decompress, blocks))
+        skip = first - int(self._uoffsets[i])
+        return data[skip: skip + last - first]
+
+    def iter_blocks(self, batch_size=64):
+        '''
+        yield the uncompressed contents of each block in order. Batches of
+        batch_size blocks are decompressed in parallel.
+        '''
+        n_blocks = len(self._uoffsets)
+        for i in range(0, n_blocks, batch_size):
+            blocks = range(i, min(i + batch_size, n_blocks))
+            if self._executor is not None:
+                blocks = self._executor.map(self._decompress, blocks)
+            else:
+                blocks = map(self._decompress, blocks)
+            for block in blocks:
+                yield block
+
+    def close(self):
+        if self._executor is not None:
+            self._executor.shutdown()
+        _close_map(self._mm)
+        self.file.close()
+
+
+class BgzfFastaReader(IndexedFastaReader):
+    '''
+    IndexedFastaReader for a BGZF compressed fasta (bgzip, or samtools faidx
+    indexed .fa.gz), which uses fasta.fai and fasta.gzi indexes. Only the
+    blocks holding the requested region are decompressed, in parallel (see
+    BgzfFile). A missing .fai is built one batch of blocks at a time.
+    '''
+
+    def __init__(self, fasta, fai=None, gzi=None, threads=None):
+        self.file = BgzfFile(fasta, gzi, threads)
+        self._load_fai(fasta, fai)
+
+    def _build_fai(self):
+        return build_fai(self.file.iter_blocks())
+
+    def _read(self, first, last):
+        return self.file.read(first, last)
+
+    def close(self):
+        self.file.close()
+
+
+# UCSC .2bit files store 4 bases per byte, most significant bits first
+TWOBIT_SIGNATURE = 0x1A412743
+TWOBIT_TABLE = np.array(
+    [[ord('TCAG'[(byte >> shift) & 3]) for shift in (6, 4, 2, 0)]
+     for byte in range(256)], dtype=np.uint8)
+
+# a sequence in a .2bit file: blocks of N and soft masked (lower case) bases
+# are given as arrays of starts and sizes, dna_offset is the position of the
+# packed bases in the file
+TwoBitEntry = namedtuple('TwoBitEntry', [
+    'name', 'length', 'dna_offset', 'n_starts', 'n_sizes', 'mask_starts',
+    'mask_sizes'])
+
+# TwoBitReader does not read blocks of at least this many N, which are
+# listed in the file header, at all
+NGAP_MIN_SIZE = 1000
+
+
+class TwoBitReader(IndexedFastaReader):
+    '''
+    memory mapped UCSC .2bit file, read like an IndexedFastaReader. Bases are
+    only decoded (with a lookup table over the packed bytes) for the region
+    which is fetched, then N blocks and soft masked blocks are applied, so
+    --soft-mask works as with fasta input. Sequences are returned as
+    memoryviews of ascii bytes. Records are chunked (see parse_regions and
+    iter_chunks) around long N blocks, so these are skipped without being
+    decoded or scanned.
+    '''
+
+    def __init__(self, fn):
+        self.file = open(fn, 'rb')
+        self._mm = _map_file(self.file)
+        try:
+            entries = self._read_index()
+        except (IOError, struct.error):
+            self.close()
+            raise IOError('{} is not a valid .2bit file'.format(fn))
+        self.names = [entry.name for entry in entries]
+        self.index = {entry.name: entry for entry in entries}
+
+    def _read_index(self):
+        mm = self._mm
+        for byte_order in '<>':
+            signature, version, n_seqs, _ = struct.unpack(
+                byte_order + 'IIII', mm[:16])
+            if signature == TWOBIT_SIGNATURE:
+                break
+        else:
+            raise IOError('bad signature')
+        # version 1 files use 64 bit offsets
+        offset_fmt = byte_order + ('Q' if version else 'I')
+        offset_size = struct.calcsize(offset_fmt)
+        entries = []
+        pos = 16
+        for _ in range(n_seqs):
+            name_size = mm[pos]
+            name = mm[pos + 1: pos + 1 + name_size].decode()
+            pos += 1 + name_size
+            offset, = struct.unpack(offset_fmt, mm[pos: pos + offset_size])
+            pos += offset_size
+            entries.append(self._read_record(name, offset, byte_order))
+        return entries
+
+    def _read_record(self, name, offset, byte_order):
+        mm = self._mm
+        length, n_blocks = struct.unpack(
+            byte_order + 'II', mm[offset: offset + 8])
+        offset += 8
+        n_starts, n_sizes, offset = self._read_blocks(
+            n_blocks, offset, byte_order)
+        mask_blocks, = struct.unpack(
+            byte_order + 'I', mm[offset: offset + 4])
+        mask_starts, mask_sizes, offset = self._read_blocks(
+            mask_blocks, offset + 4, byte_order)
+        # skip reserved field
+        return TwoBitEntry(name, length, offset + 4, n_starts, n_sizes,
+                           mask_starts, mask_sizes)
+
+    def _read_blocks(self, n_blocks, offset, byte_order):
+        # copied, so that the memory map can be closed
+        starts, sizes = np.frombuffer(
+            self._mm, dtype=byte_order + 'u4', count=2 * n_blocks,
+            offset=offset).astype(np.int64).reshape(2, n_blocks)
+        return starts, sizes, offset + 8 * n_blocks
+
+    def fetch(self, chrom, start=0, end=None):
+        '''
+        sequence of chrom from start to end (0-based, half open)
+        '''
+        entry = self.index[chrom]
+        start = max(start, 0)
+        end = entry.length if end is None else min(end, entry.length)
+        if start >= end:
+            return b''
+        first_byte = start // 4
+        packed = np.frombuffer(
+            self._mm, dtype=np.uint8, count=(end + 3) // 4 - first_byte,
+            offset=entry.dna_offset + first_byte)
+        skip = start - first_byte * 4
+        seq = TWOBIT_TABLE[packed].ravel()[skip: skip + end - start]
+        for block_start, block_end in self._overlapping(
+                entry.n_starts, entry.n_sizes, start, end):
+            seq[block_start:block_end] = ord('N')
+        for block_start, block_end in self._overlapping(
+                entry.mask_starts, entry.mask_sizes, start, end):
+            seq[block_start:block_end] |= 0x20  # lower case
+        return memoryview(seq)
+
+    @staticmethod
+    def _overlapping(starts, sizes, start, end):
+        '''
+        yield start, end relative to start of each block overlapping start to
+        end. Blocks are sorted and do not overlap.
+        '''
+        first = np.searchsorted(starts + sizes, start, 'right')
+        last = np.searchsorted(starts, end, 'left')
+        for block_start, size in zip(
+                starts[first:last].tolist(), sizes[first:last].tolist()):
+            yield (max(block_start, start) - start,
+                   min(block_start + size, end) - start)
+
+    def n_blocks(self, chrom):
+        '''
+        starts and sizes of the blocks of N in chrom, from the file header
+        '''
+        entry = self.index[chrom]
+        return entry.n_starts, entry.n_sizes
+
+    def _intervals(self, name, regions=None, pad=0):
+        '''
+        intervals as for IndexedFastaReader, with blocks of at least
+        NGAP_MIN_SIZE N removed. Loops cannot contain N, so no G4 spans one.
+        '''
+        starts, sizes = self.n_blocks(name)
+        gaps = sizes >= NGAP_MIN_SIZE
+        starts, sizes = starts[gaps], sizes[gaps]
+        intervals = []
+        for start, end in super()._intervals(name, regions, pad):
+            pos = start
+            for gap_start, gap_end in self._overlapping(
+                    starts, sizes, start, end):
+                if start + gap_start > pos:
+                    intervals.append((pos, start + gap_start))
+                pos = start + gap_end
+            if end > pos:
+                intervals.append((pos, end))
+        return intervals
+
+
+def open_fasta(fasta, threads=None):
+    '''
+    IndexedFastaReader for uncompressed fasta files, TwoBitReader for UCSC
+    .2bit files, BgzfFastaReader for BGZF compressed files (decompressing
+    with threads), or the streaming
+    FastaReader for stdin ('-'), plain gzipped files and files with lines of
+    different lengths, which cannot be indexed
+    '''
+    if fasta == '-':
+        return FastaReader(fasta)
+    if os.path.splitext(fasta)[1] == '.2bit':
+        return TwoBitReader(fasta)
+    try:
+        if os.path.splitext(fasta)[1] != '.gz':
+            return IndexedFastaReader(fasta)
+        if is_bgzf(fasta):
+            return BgzfFastaReader(fasta, threads=threads)
+    except IOError:
+        pass
+    return FastaReader(fasta)
+
+
+# colour of bed12 records
+BED12_RGB = '85,118,209'  # nice blue colour...
+
+
+class G4Record(namedtuple('G4Record', [
+        'chrom', 'start', 'end', 'name', 'score', 'strand',
+        'block_sizes', 'block_starts'])):
+    '''
+    a predicted G4. Fields are indexed in the same order as a bed6 record,
+    block_sizes and block_starts are tuples of tetrad lengths and starts
+    (relative to start) for bed12 output, or empty for bed6 records.
+    Records are only formatted as text when written (see BedWriter).
+    '''
+
+    __slots__ = ()
+
+    def to_bed6(self):
+        return '\t'.join((
+            self.chrom, str(self.start), str(self.end), self.name,
+            str(self.score), self.strand))
+
+    def to_bed12(self):
+        start, end = str(self.start), str(self.end)
+        return '\t'.join((
+            self.chrom, start, end, self.name, str(self.score), self.strand,
+            start, end,  # thickStart/End the same as chromStart/End
+            BED12_RGB, str(len(self.block_sizes)),
+            ','.join(str(x) for x in self.block_sizes),
+            ','.join(str(x) for x in self.block_starts)))
+
+    def __str__(self):
+        if self.block_sizes:
+            return self.to_bed12()
+        return self.to_bed6()
+
+    @classmethod
+    def from_bed(cls, line):
+        '''
+        parse a bed6 or bed12 line written by g4predict
+        '''
+        fields = line.split()
+        if len(fields) >= 12:
+            block_sizes = tuple(int(x) for x in fields[10].split(',') if x)
+            block_starts = tuple(int(x) for x in fields[11].split(',') if x)
+        else:
+            block_sizes = block_starts = ()
+        return cls(fields[0], int(fields[1]), int(fields[2]), fields[3],
+                   float(fields[4]), fields[5], block_sizes, block_starts)
+
+
+# a piece of a larger sequence: offset is the position of seq in the whole
+# sequence, only G4s starting in the first n_owned bases belong to the chunk
+SeqChunk = namedtuple('SeqChunk', ['seq_id', 'offset', 'seq', 'n_owned'])
+
+
+def chunk_spans(length, chunk_size=None, overlap=0):
+    '''
+    yield offset, size, n_owned for each chunk of a sequence of length bases
+    (see iter_chunks)
+    '''
+    if chunk_size is not None and chunk_size < 1:
+        raise ValueError('chunk_size should be a positive integer')
+    if chunk_size is None or length <= chunk_size + overlap:
+        yield 0, length, length
+        return
+    for offset in range(0, length, chunk_size):
+        yield (offset, min(chunk_size + overlap, length - offset),
+               min(chunk_size, length - offset))
+
+
+def iter_chunks(seq_id, seq, chunk_size=None, overlap=0, offset=0):
+    '''
+    split a sequence into chunks of chunk_size bases, each extended by
+    overlap bases into the next chunk. If chunk_size is None, or the sequence
+    is short enough, the whole sequence is yielded as one chunk. offset is
+    the position of seq in the whole sequence, if it is only part of it.
+    '''
+    for start, size, n_owned in chunk_spans(len(seq), chunk_size, overlap):
+        if start == 0 and size == len(seq):
+            yield SeqChunk(seq_id, offset, seq, n_owned)
+        else:
+            yield SeqChunk(seq_id, offset + start, seq[start: start + size],
+                           n_owned)
+
+
+def merge_intervals(intervals):
+    '''
+    sorted list of (start, end) tuples with overlapping or adjacent
+    intervals merged
+    '''
+    merged = []
+    for start, end in sorted(intervals):
+        if merged and start <= merged[-1][1]:
+            if end > merged[-1][1]:
+                merged[-1] = (merged[-1][0], end)
+        else:
+            merged.append((start, end))
+    return merged
+
+
+class RegionSet(object):
+    '''
+    target intervals, e.g. promoters or peaks from a bed file, merged by
+    contig. Used to scan only part of a genome (see parse_regions) and to
+    keep only the records which overlap the intervals.
+    '''
+
+    def __init__(self, intervals):
+        by_chrom = defaultdict(list)
+        for chrom, start, end in intervals:
+            if end > start:
+                by_chrom[chrom].append((start, end))
+        self._merged = {chrom: merge_intervals(ivs)
+                        for chrom, ivs in by_chrom.items()}
+        self._ends = {chrom: [end for _, end in ivs]
+                      for chrom, ivs in self._merged.items()}
+
+    @classmethod
+    def from_bed(cls, bed_fn):
+        '''
+        read the first three columns of a bed file, skipping track, browser
+        and comment lines
+        '''
+        with open(bed_fn) as f:
+            intervals = []
+            for line in f:
+                fields = line.split()
+                if not fields or fields[0] in ('track', 'browser') or (
+                        fields[0].startswith('#')):
+                    continue
+                intervals.append(
+                    (fields[0], int(fields[1]), int(fields[2])))
+        return cls(intervals)
+
+    def __contains__(self, chrom):
+        return chrom in self._merged
+
+    def __len__(self):
+        '''
+        total number of bases in the intervals
+        '''
+        return sum(end - start for ivs in self._merged.values()
+                   for start, end in ivs)
+
+    def intervals(self, chrom, pad=0, length=None):
+        '''
+        merged intervals of chrom, extended by pad bases at each end and
+        clipped to the contig length if it is given. Intervals which
+        overlap once padded are merged, so no base is in two of them.
+        '''
+        padded = []
+        for start, end in self._merged.get(chrom, ()):
+            start, end = max(start - pad, 0), end + pad
+            if length is not None:
+                end = min(end, length)
+            if end > start:
+                padded.append((start, end))
+        return merge_intervals(padded)
+
+    def overlaps(self, chrom, start, end):
+        '''
+        True if start to end overlaps any interval of chrom
+        '''
+        ends = self._ends.get(chrom)
+        if ends is None:
+            return False
+        i = bisect_right(ends, start)
+        return i < len(ends) and self._merged[chrom][i][0] < end
+
+
+class SharedSequence(object):
+    '''
+    a decoded sequence (str or ascii bytes) stored as ascii bytes in shared
+    memory. Other processes attach to it by name and scan memoryview slices
+    of it (see chunk), so the sequence is never pickled or copied to them.
+
+    The process which creates the sequence owns the memory and frees it on
+    close, processes which attach only detach from it. Use as a context
+    manager so that the memory is freed on errors too.
+    '''
+
+    def __init__(self, seq_id, seq=None, name=None, length=None):
+        self.seq_id = seq_id
+        if seq is not None:
+            if isinstance(seq, str):
+                seq = seq.encode('ascii', 'replace')
+            self.length = len(seq)
+            # shared memory blocks cannot be empty
+            self._shm = shared_memory.SharedMemory(
+                create=True, size=max(self.length, 1))
+            self._shm.buf[:self.length] = seq
+            self._owner = True
+        else:
+            self.length = length
+            self._shm = shared_memory.SharedMemory(name=name)
+            self._owner = False
+        self.name = self._shm.name
+
+    def __enter__(self):
+        return self
+
+    def __exit__(self, exc_type, exc_value, exc_traceback):
+        self.close()
+
+    def __len__(self):
+        return self.length
+
+    def chunk(self, offset, size, n_owned):
+        '''
+        SeqChunk of size bases from offset, the chunk seq is a memoryview of
+        the shared memory which must be released before close is called.
+        '''
+        return SeqChunk(self.seq_id, offset,
+                        self._shm.buf[offset: offset + size], n_owned)
+
+    def close(self):
+        if self._shm is None:
+            return
+        self._shm.close()
+        if self._owner:
+            self._shm.unlink()
+        self._shm = None
 
 
 class BedWriter(FileWrapper):
@@ -82,20 +1069,254 @@ class BedWriter(FileWrapper):
         self.fn = fn
 
     def write(self, bed_record):
+        '''
+        write a G4Record or a bed formatted string
+        '''
         self.file.write('{}\n'.format(bed_record))
 
 
-def sort_bed_file(unsorted_fn):
+# sort_records keeps about this many bytes of records in memory before
+# spilling a sorted run to disk
+SORT_MEMORY = 268435456
+
+# rough size of the python objects holding each buffered record, on top of
+# the length of its bed line
+SORT_RECORD_OVERHEAD = 150
+
+# each record in a spilled run is stored as contig rank, start and length of
+# the bed line, followed by the line itself
+_RUN_HEADER = struct.Struct('<IqI')
+
+_sort_key = itemgetter(0, 1)
+
+
+def _write_run(buf, run_fn):
+    buf.sort(key=_sort_key)
+    with open(run_fn, 'wb', buffering=1048576) as f:
+        for rank, start, line in buf:
+            line = line.encode()
+            f.write(_RUN_HEADER.pack(rank, start, len(line)))
+            f.write(line)
+
+
+def _read_run(run_fn):
+    header_size = _RUN_HEADER.size
+    with open(run_fn, 'rb', buffering=1048576) as f:
+        while True:
+            header = f.read(header_size)
+            if not header:
+                return
+            rank, start, length = _RUN_HEADER.unpack(header)
+            yield rank, start, f.read(length).decode()
+
+
+def sort_records(records, memory=SORT_MEMORY, spill_dir=None):
+    '''
+    sort G4Records or bed lines by contig, then start position, and yield
+    them as bed lines. Contigs are kept in the order they first appear in
+    records, and records with the same start in their input order.
+    Records are sorted in memory until they take about memory bytes, then
+    written as a sorted run of binary records to a temporary directory in
+    spill_dir (the system default if None), and the runs are merged back
+    with a heap. Spilled runs are deleted when the generator finishes, is
+    closed or raises an error.
+    '''
+    ranks = {}
+    buf = []
+    buf_size = 0
+    run_fns = []
+    tmpdir = None
+    try:
+        for record in records:
+            if isinstance(record, str):
+                line = record.rstrip('\n')
+                chrom, start = line.split('\t', 2)[:2]
+                start = int(start)
+            else:
+                chrom, start, line = record.chrom, record.start, str(record)
+            rank = ranks.setdefault(chrom, len(ranks))
+            buf.append((rank, start, line))
+            buf_size += len(line) + SORT_RECORD_OVERHEAD
+            if buf_size > memory:
+                if tmpdir is None:
+                    tmpdir = mkdtemp(prefix='g4sort', dir=spill_dir)
+                run_fns.append(
+                    os.path.join(tmpdir, 'run{}'.format(len(run_fns))))
+                _write_run(buf, run_fns[-1])
+                buf, buf_size = [], 0
+        buf.sort(key=_sort_key)
+        if not run_fns:
+            for _, _, line in buf:
+                yield line
+            return
+        # the buffer holds the last records, so goes last to keep ties in
+        # input order
+        runs = [_read_run(fn) for fn in run_fns] + [buf]
+        for _, _, line in heapq.merge(*runs, key=_sort_key):
+            yield line
+    finally:
+        if tmpdir is not None:
+            shutil.rmtree(tmpdir, ignore_errors=True)
+
+
+# BedReader reads bed files in blocks of about this many bytes of whole lines
+BED_BLOCK_SIZE = 1048576
+
+
+class BedReader(FileWrapper):
+    '''
+    read a bed file (or stdin, '-', or a gzipped file) in blocks of whole
+    lines, which are parsed in bulk with BedColumns rather than line by line
+    '''
+
+    def __init__(self, bed, block_size=BED_BLOCK_SIZE):
+        if bed == '-':
+            self.file = sys.stdin.buffer
+        elif os.path.splitext(bed)[1] == '.gz':
+            self.file = gzip.open(bed)
+        else:
+            self.file = open(bed, 'rb')
+        self.block_size = block_size
+
+    def iter_line_blocks(self):
+        '''
+        yield blocks of complete lines as bytes
+        '''
+        partial = b''
+        while True:
+            block = self.file.read(self.block_size)
+            if not block:
+                break
+            end = block.rfind(b'\n') + 1
+            if not end:
+                partial += block
+                continue
+            yield partial + block[:end]
+            partial = block[end:]
+        if partial:
+            yield partial
+
+
+def join_line_blocks(lines, block_size=BED_BLOCK_SIZE):
+    '''
+    join an iterable of bed lines (with or without newlines) into blocks of
+    about block_size bytes of whole lines, like BedReader.iter_line_blocks
+    '''
+    block = []
+    size = 0
+    for line in lines:
+        line = line.rstrip('\n').encode()
+        block.append(line)
+        size += len(line) + 1
+        if size >= block_size:
+            yield b'\n'.join(block) + b'\n'
+            block, size = [], 0
+    if block:
+        yield b'\n'.join(block) + b'\n'
+
+
+def sort_bed_file(unsorted_fn, memory=SORT_MEMORY, spill_dir=None):
     '''
-    sort a bed file using unix sort and yield sorted records in generator.
+    sort a bed file (or '-' for stdin, or a gzipped file) with sort_records,
+    using about memory bytes and spilling sorted runs to spill_dir, and
+    yield the sorted lines. Contigs are kept in the order they first appear.
+    Track, browser and comment lines are dropped.
     '''
-    def default_sigpipe():
-        '''fixes some broken pipe behaviour'''
-        signal.signal(signal.SIGPIPE, signal.SIG_DFL)
+    def iter_lines():
+        with BedReader(unsorted_fn) as f:
+            for block in f.iter_line_blocks():
+                for line in block.decode().splitlines():
+                    fields = line.split(None, 1)
+                    if not fields or fields[0] in ('track', 'browser') or (
+                            fields[0].startswith('#')):
+                        continue
+                    yield line
+
+    for line in sort_records(iter_lines(), memory, spill_dir):
+        yield line
+
+
+def _field_array(buf, starts, ends):
+    '''
+    the fields buf[starts[i]:ends[i]] as a fixed width bytes array, padded
+    with null bytes (which numpy strips)
+    '''
+    width = int((ends - starts).max()) if len(starts) else 0
+    width = max(width, 1)
+    idx = starts[:, None] + np.arange(width)
+    chars = buf[np.minimum(idx, len(buf) - 1)]
+    chars[idx >= ends[:, None]] = 0
+    return chars.view('S{}'.format(width)).ravel()
+
+
+class BedColumns(object):
+    '''
+    a block of tab separated bed6 or bed12 lines (e.g. written by g4predict)
+    parsed in bulk into typed columns: chrom and strand are bytes arrays,
+    start and end int64 and score float64 arrays. No other field is parsed,
+    instead the original text of any records can be taken with lines, so
+    they are never reformatted. Blank, comment, track and browser lines are
+    skipped.
+    '''
+
+    __slots__ = ('chrom', 'start', 'end', 'score', 'strand',
+                 '_data', '_line_starts', '_line_ends')
+
+    def __init__(self, data):
+        if data and not data.endswith(b'\n'):
+            data += b'\n'
+        buf = np.frombuffer(data, dtype=np.uint8)
+        line_ends = np.flatnonzero(buf == ord('\n'))
+        line_starts = np.concatenate([[0], line_ends[:-1] + 1])
+        line_starts = line_starts[:len(line_ends)]
+        first = buf[np.minimum(line_starts, len(buf) - 1)]
+        is_record = (line_ends > line_starts) & (first != ord('#'))
+        for i in np.flatnonzero(is_record & np.isin(first, (116, 98))):
+            # lines starting with t or b might be track or browser lines
+            word = data[line_starts[i]:line_ends[i]].split(None, 1)[0]
+            if word in (b'track', b'browser'):
+                is_record[i] = False
+        line_starts = line_starts[is_record]
+        line_ends = line_ends[is_record]
+
+        tabs = np.flatnonzero(buf == ord('\t'))
+        first_tab = np.searchsorted(tabs, line_starts)
+        n_tabs = np.searchsorted(tabs, line_ends) - first_tab
+        if len(n_tabs) and n_tabs.min() < 5:
+            raise ValueError('bed records should have at least 6 fields')
+        tabs = np.append(tabs, len(buf))
+        field_starts = [line_starts] + [
+            tabs[first_tab + i] + 1 for i in range(5)]
+        # the last field ends at the end of the line for bed6
+        field_ends = [tabs[first_tab + i] for i in range(5)] + [
+            np.where(n_tabs > 5, tabs[first_tab + 5], line_ends)]
+        fields = [_field_array(buf, s, e)
+                  for s, e in zip(field_starts, field_ends)]
+        self.chrom = fields[0]
+        self.start = fields[1].astype(np.int64)
+        self.end = fields[2].astype(np.int64)
+        self.score = fields[4].astype(np.float64)
+        self.strand = fields[5]
+        self._data = buf
+        self._line_starts = line_starts
+        self._line_ends = line_ends
+
+    def __len__(self):
+        return len(self._line_starts)
 
-    s = subprocess.Popen(['sort', '-k1,1', '-k2,2n', unsorted_fn],
-                         stdout=subprocess.PIPE, preexec_fn=default_sigpipe)
+    def lines(self, rows):
+        '''
+        the original text of records rows (an increasing array of row
+        numbers), as bytes with a newline after each line
+        '''
+        starts = self._line_starts[rows]
+        lengths = self._line_ends[rows] + 1 - starts
+        offsets = np.cumsum(lengths) - lengths
+        idx = np.repeat(starts - offsets, lengths) + np.arange(lengths.sum())
+        return self._data[idx].tobytes()
 
-    for record in s.stdout:
-        yield record.decode().strip()
-    s.stdout.close()
+    def tail(self, row):
+        '''
+        the text of all lines from record row to the end of the block
+        '''
+        return self._data[self._line_starts[row]:].tobytes()
@@ -6,6 +6,11 @@ author: Matthew Parker
 
 from operator import itemgetter
 from bisect import bisect_left
+from heapq import heappush, heappop, nlargest
+import numpy as np
+
+from .g4fileutils import (
+    G4Record, BedReader, BedColumns, BED_BLOCK_SIZE, join_line_blocks)
 
 
 def check_overlapping(cluster_range, record_start):
@@ -20,14 +25,16 @@ def check_overlapping(cluster_range, record_start):
 
 def cluster_overlapping(bed):
     '''
-    generator yielding new clusters, treats each strand separately
+    generator yielding new clusters, treats each strand separately. bed
+    can yield G4Records or bed formatted lines, which are parsed to
+    G4Records once here.
     '''
     cluster = {'+': [], '-': []}
     cluster_range = {'+': [0, 0], '-': [0, 0]}
     cluster_chrom = {'+': None, '-': None}
     while True:
         try:
-            record = next(bed).split()
+            record = next(bed)
         except StopIteration:
             if cluster['+']:
                 yield cluster['+']
@@ -35,9 +42,8 @@ def cluster_overlapping(bed):
                 yield cluster['-']
             break
 
-        record[1] = int(record[1])
-        record[2] = int(record[2])
-        record[4] = float(record[4])
+        if isinstance(record, str):
+            record = G4Record.from_bed(record)
         s = record[5]
 
         # check cluster not empty:
@@ -71,69 +77,167 @@ def cluster_overlapping(bed):
 
 def join_records(cluster):
     '''
-    list of lists to list of tab delim strings
+    list of lists to list of tab delim strings. G4Records should be
+    formatted with str instead.
     '''
     return ['\t'.join([str(f) for f in record]) for record in cluster]
 
 
+# clusters with at least this many records are sorted and searched with
+# numpy in filter_overlapping, smaller ones are quicker in pure python
+FILTER_ARRAY_SIZE = 256
+
+
 def filter_overlapping(cluster):
     '''
     find the non-overlapping records in a cluster which yield
-    the best total score.
+    the best total score. Records are returned unchanged.
     '''
     # if cluster is only one record, return it
     if len(cluster) == 1:
-        return join_records(cluster)
+        return cluster
     # if cluster is only two records, return higher scoring
     if len(cluster) == 2:
-        return join_records([max(cluster, key=itemgetter(4)), ])
-    # cluster is sorted by stop-values
-    end_sorted_cluster = sorted(cluster, key=itemgetter(2))
-    end_sorted_vals = [x[2] for x in end_sorted_cluster]
-
-    # vector of maximum scores, one longer than cluster size
-    max_of_cluster = [[0, 0, 0], ] * (len(cluster) + 1)
-
-    # calculate max score from cluster:
-    # for each record in the cluster:
-    for i, record in enumerate(end_sorted_cluster):
-
-        # calculate the score from prev records if not including this record
-        not_incl = max(max_of_cluster[i][:2])
-
-        # find the closest non-overlapping record left of the current one
-        closest = bisect_left(end_sorted_vals, record[1])
-        if closest == 0:
-            closest = -1
-
-        # score including this record is total from closest plus current
-        incl = max(max_of_cluster[closest][:2]) + record[4]
-
-        # store scores and closest record in matrix
-        max_of_cluster[i+1] = [not_incl, incl, closest]
-    # backtrack through matrix to get high scoring records:
-    i = len(cluster)
-    incl_records = []
-    while i != -1:
-        # if not_incl score is less than incl
-        if max_of_cluster[i][1] >= max_of_cluster[i][0]:
-
-            # include cluster[i]
-            incl_records.append(end_sorted_cluster[i-1])
-
-            # jump to closest
-            i = max_of_cluster[i][2]
-        else:
+        return [max(cluster, key=itemgetter(4)), ]
+    if len(cluster) >= FILTER_ARRAY_SIZE:
+        order, pred = _end_sorted_arrays(
+            np.array([r[1] for r in cluster]),
+            np.array([r[2] for r in cluster]),
+            np.zeros(len(cluster), dtype=np.int64))
+        order, pred = order.tolist(), pred.tolist()
+    else:
+        # cluster is sorted by stop-values
+        order = sorted(range(len(cluster)), key=lambda i: cluster[i][2])
+        end_sorted_vals = [cluster[i][2] for i in order]
+        # the closest non-overlapping record left of each one
+        pred = [bisect_left(end_sorted_vals, cluster[i][1]) for i in order]
+    chosen = _schedule([0] * len(cluster), pred,
+                       [cluster[i][4] for i in order])
+    return [cluster[order[i]] for i in chosen]
+
+
+def _end_sorted_arrays(starts, ends, clusters):
+    '''
+    order which sorts records by cluster number, then end, and for each
+    record in that order the number of records before it in the order which
+    are in its cluster or an earlier one and end before it starts (i.e. one
+    past its closest non-overlapping record to the left)
+    '''
+    order = np.lexsort((ends, clusters))
+    sorted_clusters = clusters[order]
+    span = int(ends.max()) + 1 if len(ends) else 1
+    keys = sorted_clusters * span + ends[order]
+    pred = np.searchsorted(
+        keys, sorted_clusters * span + starts[order], 'left')
+    return order, pred
 
-            # try next record
+
+def _schedule(first, pred, scores):
+    '''
+    weighted interval scheduling over records sorted by cluster, then end.
+    first is the position of the first record of each record's cluster and
+    pred one past its closest non-overlapping record (first if there is
+    none). A record is included if that scores at least as much as leaving
+    it out. Returns the positions of the chosen records, backtracking from
+    the last record of the last cluster to the first of the first.
+    '''
+    n = len(scores)
+    best = [0] * n
+    incl_flags = [False] * n
+    for i in range(n):
+        f = first[i]
+        # scores if not including this record, and if including it
+        not_incl = best[i - 1] if i > f else 0
+        p = pred[i]
+        incl = (best[p - 1] if p > f else 0) + scores[i]
+        if incl >= not_incl:
+            best[i] = incl
+            incl_flags[i] = True
+        else:
+            best[i] = not_incl
+    # backtrack to get high scoring records, jumping to the closest
+    # non-overlapping record after including one
+    chosen = []
+    i = n - 1
+    while i >= 0:
+        if incl_flags[i]:
+            chosen.append(i)
+            i = pred[i] - 1
+        else:
             i -= 1
+    return chosen
 
-    return join_records(incl_records)
+
+def filter_overlapping_array(g4s):
+    '''
+    filter_overlapping for every cluster of an array of G4s from
+    G4Regex.get_g4s_as_arrays (e.g. all the G4s of one contig, ordered by
+    start position) at once. Clusters are found on each strand from the
+    running maximum of end positions, then all are sorted, searched and
+    scheduled together. Returns the chosen rows, in their original order,
+    the same records as apply_filter_method with filter_overlapping gives.
+    '''
+    starts = g4s['start'].astype(np.int64)
+    ends = g4s['end'].astype(np.int64)
+    clusters = _cluster_ids(
+        np.zeros(len(g4s), dtype=np.int64), starts, ends, g4s['strand'])
+    return g4s[_filter_clusters(starts, ends, g4s['score'], clusters)]
+
+
+def _cluster_ids(contigs, starts, ends, strands):
+    '''
+    number the clusters of overlapping records on each strand of each
+    contig, for records sorted by start position with the records of each
+    contig together (numbered in contigs). Clusters are numbered by strand,
+    then position.
+    '''
+    clusters = np.empty(len(starts), dtype=np.int64)
+    if not len(starts):
+        return clusters
+    # shift each contig past the end of the last, so clusters never span
+    # two contigs
+    shift = contigs * (int(ends.max()) + 1)
+    n_clusters = 0
+    for strand in np.unique(strands):
+        rows = np.flatnonzero(strands == strand)
+        # a record starts a new cluster if it starts at or after the end of
+        # every record before it on the strand
+        cluster_end = np.maximum.accumulate(ends[rows] + shift[rows])
+        new = np.concatenate(
+            [[True], starts[rows][1:] + shift[rows][1:] >= cluster_end[:-1]])
+        clusters[rows] = n_clusters + np.cumsum(new) - 1
+        n_clusters += int(new.sum())
+    return clusters
+
+
+def _filter_clusters(starts, ends, scores, clusters):
+    '''
+    mask of the records filter_overlapping keeps from each cluster
+    '''
+    keep = np.zeros(len(starts), dtype=bool)
+    # single records are always kept, the higher scoring of two (the
+    # first on ties) is kept
+    sizes = np.bincount(clusters)[clusters]
+    keep[sizes == 1] = True
+    pairs = np.flatnonzero(sizes == 2)
+    pairs = pairs[np.argsort(clusters[pairs], kind='stable')].reshape(-1, 2)
+    second = scores[pairs[:, 1]] > scores[pairs[:, 0]]
+    keep[pairs[np.arange(len(pairs)), second.astype(np.int64)]] = True
+    rows = np.flatnonzero(sizes > 2)
+    if len(rows):
+        order, pred = _end_sorted_arrays(
+            starts[rows], ends[rows], clusters[rows])
+        sorted_clusters = clusters[rows][order]
+        first = np.searchsorted(sorted_clusters, sorted_clusters, 'left')
+        chosen = _schedule(first.tolist(), pred.tolist(),
+                           scores[rows][order].tolist())
+        keep[rows[order[chosen]]] = True
+    return keep
 
 
 def merge_overlapping(cluster):
     '''
-    flatten all the records in a cluster into one bed6 formatted record.
+    flatten all the records in a cluster into one bed6 G4Record.
     score is set as the total number of records in the cluster (may give
     some indication of G4 variants at the locus, though the regex does
     not capture all potential variants, just one per left mapping pos).
@@ -141,14 +245,189 @@ def merge_overlapping(cluster):
     cluster_min = min(cluster, key=itemgetter(1))[1]
     cluster_max = max(cluster, key=itemgetter(2))[2]
     score = len(cluster)
-    return join_records([[cluster[0][0], cluster_min, cluster_max,
-                          'PG4_cluster', score, cluster[0][5]]])
+    return [G4Record(cluster[0][0], cluster_min, cluster_max,
+                     'PG4_cluster', score, cluster[0][5], (), ())]
+
+
+def apply_filter_method(records, filter_method):
+    '''
+    Cluster overlapping records then apply merge or filter methods, as the
+    records are read. records (G4Records or bed lines) should be sorted by
+    start position with the records of each contig together, as they are
+    predicted. Clusters are kept open on both strands and filtered as soon
+    as they are complete, and the filtered records are yielded sorted by
+    start position too, so need no resort: each is held back only until no
+    open cluster could yield a record starting before it.
+    '''
+    cluster = {'+': [], '-': []}
+    cluster_end = {'+': 0, '-': 0}
+    chrom = None
+    # heap of (start, n, record) for filtered records not yet yielded, n
+    # keeps records with the same start in the order they were filtered
+    done = []
+    n = 0
+    for record in records:
+        if isinstance(record, str):
+            record = G4Record.from_bed(record)
+        s = record[5]
+
+        if record[0] != chrom:
+            # all clusters on the last chromosome are complete
+            for strand in '+-':
+                n = _push_filtered(done, n, filter_method(cluster[strand])
+                                   if cluster[strand] else ())
+                cluster[strand] = []
+            while done:
+                yield heappop(done)[2]
+            chrom = record[0]
+
+        # if record does not overlap the cluster, the cluster is complete
+        elif cluster[s] and record[1] >= cluster_end[s]:
+            n = _push_filtered(done, n, filter_method(cluster[s]))
+            cluster[s] = []
+
+        if not cluster[s] or record[2] > cluster_end[s]:
+            cluster_end[s] = record[2]
+        cluster[s].append(record)
+
+        # records still to come all start at or after the first record of
+        # the open clusters
+        first_start = min(c[0][1] for c in cluster.values() if c)
+        while done and done[0][0] <= first_start:
+            yield heappop(done)[2]
+
+    for strand in '+-':
+        if cluster[strand]:
+            n = _push_filtered(done, n, filter_method(cluster[strand]))
+    while done:
+        yield heappop(done)[2]
+
+
+def _push_filtered(done, n, filtered):
+    for record in filtered:
+        heappush(done, (record[1], n, record))
+        n += 1
+    return n
+
+
+def top_scoring(records, n):
+    '''
+    the n highest scoring of records (G4Records), in their input order. Only
+    the best n seen so far are kept, in a heap, rather than sorting them
+    all. Of records with equal scores the first are kept.
+    '''
+    top = nlargest(n, enumerate(records), key=_record_score)
+    top.sort(key=itemgetter(0))
+    return [record for _, record in top]
+
+
+def _record_score(i_record):
+    return i_record[1][4]
+
+
+def filter_bed(bed, filter_method, block_size=BED_BLOCK_SIZE):
+    '''
+    apply filter_overlapping or merge_overlapping to a bed6 or bed12 file
+    (or '-' for stdin) sorted by start position with the records of each
+    contig together, e.g. one written by g4predict. bed can also be an
+    iterable of sorted bed lines, e.g. from sort_bed_file. Blocks of lines
+    are parsed into typed columns (see BedColumns) and all the clusters in a
+    block are filtered at once, choosing the same records as
+    apply_filter_method. Clusters still open at the end of a block are
+    carried into the next. Kept records are not reformatted: their original
+    lines are yielded in input order, joined into one string per block.
+    '''
+    if filter_method is filter_overlapping:
+        merge = False
+    elif filter_method is merge_overlapping:
+        merge = True
+    else:
+        raise ValueError(
+            'filter_bed can only apply filter_overlapping '
+            'or merge_overlapping')
+    if not isinstance(bed, str):
+        for text in _filter_line_blocks(
+                join_line_blocks(bed, block_size), merge):
+            yield text
+        return
+    with BedReader(bed, block_size) as f:
+        for text in _filter_line_blocks(f.iter_line_blocks(), merge):
+            yield text
+
+
+def _filter_line_blocks(blocks, merge):
+    '''
+    filter (or merge, if merge is True) the records of an iterable of blocks
+    of whole bed lines, see filter_bed
+    '''
+    block = next(blocks, None)
+    carry = b''
+    # whether each carried record is kept (1) or not (0), or -1 if its
+    # cluster was not complete
+    state = np.empty(0, dtype=np.int8)
+    while block is not None:
+        next_block = next(blocks, None)
+        cols = BedColumns(carry + block)
+        block = next_block
+        if not len(cols):
+            carry, state = b'', state[:0]
+            continue
+        decided = np.full(len(cols), -1, dtype=np.int8)
+        decided[:len(state)] = state
+        rows = np.flatnonzero(decided < 0)
+        contigs = np.concatenate(
+            [[0], np.cumsum(cols.chrom[1:] != cols.chrom[:-1])])
+        clusters = _cluster_ids(
+            contigs[rows], cols.start[rows], cols.end[rows],
+            cols.strand[rows])
+        _, first = np.unique(clusters, return_index=True)
+        first = rows[first]
+        # the last cluster of each strand on the last contig may carry on in
+        # the next block, so neither it nor anything after its first record
+        # is output yet
+        carry_row = len(cols)
+        if block is not None and len(rows):
+            for strand in np.unique(cols.strand[rows]):
+                last = rows[cols.strand[rows] == strand][-1]
+                if contigs[last] == contigs[-1]:
+                    carry_row = min(
+                        carry_row, first[clusters[rows == last][0]])
+        complete = (first < carry_row)[clusters]
+        rows, clusters = rows[complete], clusters[complete]
+        if merge:
+            text = _merge_cluster_lines(cols, rows, clusters)
+            decided[rows] = 0
+        else:
+            decided[rows] = _filter_clusters(
+                cols.start[rows], cols.end[rows], cols.score[rows],
+                clusters)
+            text = cols.lines(
+                np.flatnonzero(decided[:carry_row] == 1)).decode()
+        carry, state = (cols.tail(carry_row) if carry_row < len(cols)
+                        else b''), decided[carry_row:]
+        if text:
+            yield text.rstrip('\n')
 
 
-def apply_filter_method(file_handle, filter_method):
+def _merge_cluster_lines(cols, rows, clusters):
     '''
-    Cluster overlapping records then apply merge or filter methods.
+    merge_overlapping for each cluster of rows of BedColumns cols, as bed
+    lines ordered by the first record of each cluster
     '''
-    for cluster in cluster_overlapping(file_handle):
-        for record in filter_method(cluster):
-            yield record
+    if not len(rows):
+        return ''
+    order = np.lexsort((rows, clusters))
+    rows, clusters = rows[order], clusters[order]
+    bounds = np.flatnonzero(np.diff(clusters)) + 1
+    firsts = np.concatenate([[0], bounds])
+    cluster_ends = np.maximum.reduceat(cols.end[rows], firsts)
+    sizes = np.diff(np.append(firsts, len(rows)))
+    first_rows = rows[firsts]
+    lines = []
+    for i in np.argsort(first_rows):
+        r = first_rows[i]
+        lines.append(str(G4Record(
+            cols.chrom[r].decode(), int(cols.start[r]),
+            int(cluster_ends[i]), 'PG4_cluster', int(sizes[i]),
+            cols.strand[r].decode(), (), ())))
+    return '\n'.join(lines) + '\n'
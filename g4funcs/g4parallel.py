@@ -0,0 +1,305 @@
+'''
+Functions for predicting G4s with a pool of worker processes or threads
+
+author: Matthew Parker
+'''
+import os
+import time
+import logging as log
+from collections import deque, defaultdict
+from concurrent.futures import ThreadPoolExecutor
+import multiprocessing as mp
+from multiprocessing import resource_tracker
+import numpy as np
+
+from .g4fileutils import chunk_spans, iter_chunks, SeqChunk, SharedSequence
+from .g4runs import RunIndex, RUN_CHARS, find_array_runs
+
+# contigs longer than this are split into chunks when running in parallel
+# and no chunk size is given, so that one long chromosome does not end up on
+# a single worker
+PARALLEL_CHUNK_SIZE = 10000000
+
+# estimated cost of each position where a tetrad could start, relative to
+# the cost of scanning one base. Overlapped matching tries every loop length
+# at these positions, so G-rich chunks cost far more than their length.
+TETRAD_COST = 100
+
+# number of tasks ahead of the next result which the scheduler looks at
+# when choosing the most costly task to run next, per worker
+LOOKAHEAD = 8
+
+# G4Regex and open RunIndex used by each worker process, set by _init_worker
+_worker_state = {}
+
+
+def _init_worker(g4_regex, index_fn=None):
+    _worker_state['g4_regex'] = g4_regex
+    _worker_state['index'] = RunIndex(index_fn) if index_fn else None
+    _worker_state['shared'] = None
+
+
+def _attach_shared(seq_id, name, length):
+    '''
+    attach to a SharedSequence, detaching from the last one used by this
+    worker. Chunks of one sequence are usually scanned in a row, so this
+    avoids attaching for every chunk.
+    '''
+    shared = _worker_state['shared']
+    if shared is None or shared.name != name:
+        if shared is not None:
+            shared.close()
+        shared = SharedSequence(seq_id, name=name, length=length)
+        _worker_state['shared'] = shared
+    return shared
+
+
+def _predict_chunk(args):
+    seq_id, name, length, offset, span, use_bed12 = args
+    g4_regex = _worker_state['g4_regex']
+    chunk = _attach_shared(seq_id, name, length).chunk(*span)
+    if offset:
+        chunk = chunk._replace(offset=chunk.offset + offset)
+    try:
+        return list(g4_regex.get_g4s_from_chunk(chunk, use_bed12))
+    finally:
+        # release the memoryview so that the shared memory can be closed
+        chunk.seq.release()
+
+
+def _predict_table(args):
+    i, use_bed12 = args
+    g4_regex = _worker_state['g4_regex']
+    index = _worker_state['index']
+    return list(g4_regex.get_g4s_from_runs(
+        index.table(i), index.names[i], use_bed12))
+
+
+def _timed(func, task):
+    '''
+    run func(task) in a worker, returning the worker pid and time spent too
+    '''
+    start = time.perf_counter()
+    result = func(task)
+    return os.getpid(), time.perf_counter() - start, result
+
+
+def chunk_costs(seq, spans, min_tetrad, soft_mask=False):
+    '''
+    estimated cost of scanning each (offset, size, n_owned) span of seq
+    (str or bytes): the number of bases owned plus TETRAD_COST for each
+    position in them where min_tetrad G or C start. Runs are found with a
+    quick vectorised pass over the whole sequence.
+    '''
+    if isinstance(seq, str):
+        seq = seq.encode('ascii', 'replace')
+    seq_array = np.frombuffer(seq, dtype=np.uint8)
+    run_starts, run_tetrads = [], []
+    for base in 'GC':
+        starts, lengths = find_array_runs(
+            seq_array, RUN_CHARS[bool(soft_mask)][base])
+        keep = lengths >= min_tetrad
+        run_starts.append(starts[keep])
+        # number of positions in the run where a tetrad can start
+        run_tetrads.append(lengths[keep].astype(np.int64) - min_tetrad + 1)
+    run_starts = np.concatenate(run_starts)
+    order = np.argsort(run_starts, kind='stable')
+    run_starts = run_starts[order]
+    # n_tetrads[i] is the number of tetrad positions in the first i runs
+    n_tetrads = np.concatenate(
+        [[0], np.cumsum(np.concatenate(run_tetrads)[order])])
+    costs = []
+    for offset, _, n_owned in spans:
+        first, last = np.searchsorted(
+            run_starts, [offset, offset + n_owned])
+        costs.append(
+            n_owned + TETRAD_COST * int(n_tetrads[last] - n_tetrads[first]))
+    return costs
+
+
+class WorkerUsage(object):
+
+    '''
+    time each worker spent running tasks, for reporting how well work was
+    balanced between workers.
+    '''
+
+    def __init__(self, processes):
+        self.processes = processes
+        self.busy = defaultdict(float)
+        self.start = time.perf_counter()
+
+    def add(self, pid, seconds):
+        self.busy[pid] += seconds
+
+    def utilisation(self):
+        '''
+        fraction of the elapsed time each worker was busy, busiest first.
+        Workers which never ran a task are included as zeros.
+        '''
+        elapsed = max(time.perf_counter() - self.start, 1e-9)
+        usage = sorted((b / elapsed for b in self.busy.values()),
+                       reverse=True)
+        return usage + [0.0] * (self.processes - len(usage))
+
+    def report(self):
+        usage = self.utilisation()
+        log.info('Worker utilisation: {} (mean {:.0%})'.format(
+            ', '.join('{:.0%}'.format(u) for u in usage),
+            sum(usage) / len(usage)))
+
+
+def _imap_scheduled(pool, func, tasks, max_pending, lookahead, usage=None):
+    '''
+    like pool.imap, for an iterable of (cost, task) tuples. Results are
+    yielded in task order as task, result tuples, but tasks are submitted
+    most costly first from the next lookahead tasks, so that a costly task
+    (e.g. a G-rich chunk) starts early rather than holding up the rest of
+    the run. At most max_pending tasks are submitted at any time and only
+    lookahead tasks are read ahead, so memory use is bounded. Time spent
+    by each worker is added to usage if given.
+    '''
+    tasks = iter(tasks)
+    # [cost, task, async result or None if not submitted yet], in task order
+    window = deque()
+    n_pending = 0
+    exhausted = False
+    while True:
+        while not exhausted and len(window) < lookahead:
+            try:
+                cost, task = next(tasks)
+            except StopIteration:
+                exhausted = True
+            else:
+                window.append([cost, task, None])
+        if not window:
+            return
+        waiting = sorted((e for e in window if e[2] is None),
+                         key=lambda e: e[0], reverse=True)
+        n_free = max(max_pending - n_pending, 0)
+        if window[0][2] is None:
+            # the next result is needed first, so is always submitted
+            waiting.remove(window[0])
+            waiting.insert(0, window[0])
+            n_free = max(n_free, 1)
+        for e in waiting[:n_free]:
+            e[2] = pool.apply_async(_timed, (func, e[1]))
+            n_pending += 1
+        _, task, result = window.popleft()
+        pid, seconds, result = result.get()
+        n_pending -= 1
+        if usage is not None:
+            usage.add(pid, seconds)
+        yield task, result
+
+
+def _as_piece(item):
+    '''
+    SeqChunk owning all of a (seq_id, seq) tuple, SeqChunks for pieces of
+    sequences (e.g. from parse_regions) are returned as they are
+    '''
+    if isinstance(item, SeqChunk):
+        return item
+    seq_id, seq = item
+    return SeqChunk(seq_id, 0, seq, len(seq))
+
+
+def _shared_chunk_tasks(g4_regex, seqs, chunk_size, use_bed12, shared):
+    '''
+    copy each (seq_id, seq) into a SharedSequence, stored in shared by name,
+    and yield cost, task for each chunk of it. Tasks only hold the name of
+    the shared memory and the chunk coordinates, so are cheap to send to
+    workers.
+    '''
+    min_tetrad = g4_regex._params['tetrad_kwargs']['start']
+    soft_mask = g4_regex._params['soft_mask']
+    for seq_id, offset, seq, _ in map(_as_piece, seqs):
+        if isinstance(seq, str):
+            seq = seq.encode('ascii', 'replace')
+        spans = list(chunk_spans(len(seq), chunk_size, g4_regex.max_length))
+        costs = chunk_costs(seq, spans, min_tetrad, soft_mask)
+        seq = SharedSequence(seq_id, seq)
+        shared[seq.name] = seq
+        for span, cost in zip(spans, costs):
+            yield cost, (seq_id, seq.name, len(seq), offset, span, use_bed12)
+
+
+def parallel_g4s_as_bed(g4_regex, seqs, processes,
+                        use_bed12=True, chunk_size=None):
+    '''
+    query an iterable of (seq_id, seq) tuples, or of SeqChunks for pieces of
+    sequences, for G4s using a pool of processes. Each sequence is placed in
+    shared memory and split into chunks (see iter_chunks) which the workers
+    scan in place, without the sequence being copied to them. Chunks are
+    scheduled by their estimated cost (see chunk_costs). G4Records are
+    yielded in the same order as get_g4s with the same chunk size, and
+    worker utilisation is logged at the end.
+    A sequence is freed once its last chunk has been scanned, all shared
+    memory is freed if an error occurs or the generator is closed early.
+    '''
+    if chunk_size is None:
+        chunk_size = PARALLEL_CHUNK_SIZE
+
+    shared = {}
+    tasks = _shared_chunk_tasks(
+        g4_regex, seqs, chunk_size, use_bed12, shared)
+    usage = WorkerUsage(processes)
+    # workers must share our resource tracker, otherwise each starts its own
+    # which frees the shared memory they attached to when they exit
+    resource_tracker.ensure_running()
+    try:
+        with mp.Pool(processes, _init_worker, (g4_regex,)) as pool:
+            results = _imap_scheduled(
+                pool, _predict_chunk, tasks, processes * 2,
+                processes * LOOKAHEAD, usage)
+            for (_, name, length, _, span, _), records in results:
+                for record in records:
+                    yield record
+                offset, _, n_owned = span
+                if offset + n_owned == length:
+                    shared.pop(name).close()
+        usage.report()
+    finally:
+        for seq in shared.values():
+            seq.close()
+
+
+def parallel_g4s_from_index(g4_regex, index_fn, processes, use_bed12=True):
+    '''
+    query every contig of a RunIndex for G4s using a pool of processes. Each
+    worker memory maps the index itself, so only contig numbers are sent to
+    the workers. Contigs are scheduled by their number of G and C runs.
+    '''
+    index = RunIndex(index_fn)
+    index.check_soft_mask(g4_regex._params['soft_mask'])
+    tasks = ((index.n_runs(i), (i, use_bed12))
+             for i in range(len(index.names)))
+    usage = WorkerUsage(processes)
+
+    with mp.Pool(processes, _init_worker, (g4_regex, index_fn)) as pool:
+        results = _imap_scheduled(
+            pool, _predict_table, tasks, processes * 2,
+            processes * LOOKAHEAD, usage)
+        for _, records in results:
+            for record in records:
+                yield record
+    usage.report()
+
+
+def threaded_g4s_as_bed(g4_regex, seqs, threads,
+                        use_bed12=True, chunk_size=None):
+    '''
+    query an iterable of (seq_id, seq) tuples, or of SeqChunks for pieces of
+    sequences, for G4s, scanning the patterns of each sequence concurrently
+    in a pool of threads. All threads share the same sequence string, so
+    unlike parallel_g4s_as_bed nothing is pickled or copied to workers.
+    G4Records are yielded in the same order as get_g4s. The runs engine does
+    not benefit from threads.
+    '''
+    with ThreadPoolExecutor(threads) as executor:
+        for seq_id, offset, seq, _ in map(_as_piece, seqs):
+            for chunk in iter_chunks(seq_id, seq, chunk_size,
+                                     g4_regex.max_length, offset):
+                for record in g4_regex.get_g4s_from_chunk(
+                        chunk, use_bed12, executor):
+                    yield record
@@ -4,7 +4,6 @@ Predict putative G Quadruplexes using an extension of the Quadparser method;
 author: Matthew Parker;
 '''
 
-import os
 import sys
 import logging as log
 from pprint import pformat
@@ -53,7 +52,9 @@ def parse_args(argv=None):
                 tetrad_score_factor=args.pop('tetrad_score_factor'),
                 loop_pen_factor=args.pop('loop_pen_factor'),
                 bulge_pen_factor=args.pop('bulge_pen_factor')),
-            soft_mask=args.pop('soft_mask')
+            soft_mask=args.pop('soft_mask'),
+            engine=args.pop('engine'),
+            min_score=args.pop('min_score')
             )
 
         return args, g4.G4Regex(**g4_params)
@@ -92,11 +93,29 @@ def parse_args(argv=None):
             score_kwargs=dict(
                 tetrad_score_factor=args.pop('tetrad_score_factor'),
                 loop_pen_factor=args.pop('loop_pen_factor')),
-            soft_mask=args.pop('soft_mask')
+            soft_mask=args.pop('soft_mask'),
+            engine=args.pop('engine'),
+            min_score=args.pop('min_score')
             )
 
         return args, g4.PartialG4Regex(**g4_params)
 
+    def index(args):
+        '''
+        no G4Regex is needed to build a run index
+        '''
+
+        log.info('Running in mode: index')
+        return args, None
+
+    def filter_bed(args):
+        '''
+        no G4Regex is needed to filter an existing bed file
+        '''
+
+        log.info('Running in mode: filter')
+        return args, None
+
     a = argparse.ArgumentParser(
         description=__doc__,
         formatter_class=argparse.ArgumentDefaultsHelpFormatter)
@@ -115,6 +134,78 @@ might form with at least 1 other partial G4 from a different DNA/RNA molecule.
 ''')
     inter_parser.set_defaults(func=inter)
 
+    index_parser = sub.add_parser('index', help='''
+Build an index of the G and C runs in every contig of a fasta file. The index
+can be passed to intra or inter with --index, so that the fasta does not need
+to be read again when predicting with different parameters.
+''')
+    index_parser.set_defaults(func=index, run=build_index)
+    index_parser.add_argument(
+        '-f', '--fasta', type=str, required=True,
+        help='''
+Input fasta file, use '-' to read from stdin. Uncompressed files are memory
+mapped using a samtools style index (FASTA.fai), which is created if it does
+not exist. bgzip compressed files are indexed the same way (with FASTA.gzi)
+and decompressed in parallel. UCSC .2bit files
+are memory mapped and decoded as they are scanned''')
+    index_parser.add_argument(
+        '-o', '--output', type=str, required=True,
+        help='Output run index (.npz) file')
+    index_parser.add_argument(
+        '-c', '--soft-mask', action='store_true', required=False,
+        default=False,
+        help='''
+treat lower case nucleotides as masked, the index can then only be used with
+--soft-mask
+''')
+    index_parser.add_argument(
+        '-r', '--min-run', type=int, required=False, default=2,
+        help='''
+shortest G/C run to store. Use 1 if the index will be used with bulges,
+loops which do not allow G, or single base tetrads
+''')
+
+    filter_parser = sub.add_parser('filter', help='''
+Filter or merge the overlapping PG4s of a bed file written by intra or inter,
+without predicting them again. Output lines are copied from the input.
+''')
+    filter_parser.set_defaults(func=filter_bed, run=filter_bed_file)
+    filter_parser.add_argument(
+        '-i', '--input', type=str, required=True,
+        help='''
+Input bed6 or bed12 file sorted by start position with the PG4s of each contig
+together, as written by intra or inter, unless --sort is used. Use '-' to read
+from stdin
+''')
+    filter_parser.add_argument(
+        '-b', '--bed', type=str, required=True,
+        help='Output bed file, use \'-\' to write to stdout')
+    filter_parser.add_argument(
+        '-s', '--sort', action='store_true', default=False,
+        help='''
+sort the input first, if it is not sorted. Records are sorted in memory up to
+--sort-memory, then in sorted runs written to --spill-dir which are merged
+''')
+    filter_parser.add_argument(
+        '-m', '--sort-memory', type=int, required=False, default=256,
+        help='approximate memory (in MB) to sort records in with --sort')
+    filter_parser.add_argument(
+        '-T', '--spill-dir', type=str, required=False, default=None,
+        help='''
+directory to write sorted runs to with --sort, they are deleted when sorting
+finishes. Default is the system temporary directory
+''')
+    filter_method = filter_parser.add_mutually_exclusive_group(required=True)
+    filter_method.add_argument(
+        '-F', '--filter-overlapping', action='store_true', default=False,
+        help='''
+use filtering method to remove overlapping PG4s, yields the maximum number of
+high scoring, non-overlapping PG4s
+''')
+    filter_method.add_argument(
+        '-M', '--merge-overlapping', action='store_true', default=False,
+        help='use merge method to flatten overlapping PG4s into bed6 records')
+
     if argv is None:
         argv = sys.argv[1:]
     if len(argv) <= 1:
@@ -123,9 +214,29 @@ might form with at least 1 other partial G4 from a different DNA/RNA molecule.
 
     for p in (inter_parser, intra_parser):
         general = p.add_argument_group('General')
+        seq_input = general.add_mutually_exclusive_group(required=True)
+        seq_input.add_argument(
+            '-f', '--fasta', type=str,
+            help='''
+Input fasta file, use '-' to read from stdin. Uncompressed files are memory
+mapped using a samtools style index (FASTA.fai), which is created if it does
+not exist. bgzip compressed files are indexed the same way (with FASTA.gzi)
+and decompressed in parallel with --threads. UCSC .2bit files
+are memory mapped and decoded as they are scanned''')
+        seq_input.add_argument(
+            '-i', '--index', type=str,
+            help='''
+Input run index made with g4predict index, used instead of --fasta. PG4s are
+predicted with the runs engine, or the extend engine if it is selected
+''')
         general.add_argument(
-            '-f', '--fasta', type=str, required=True,
-            help='Input fasta file, use \'-\' to read from stdin')
+            '-R', '--regions', type=str, required=False, default=None,
+            help='''
+bed file of regions to predict PG4s in, e.g. promoters or peaks. Only the
+regions, padded by the longest possible PG4, are read and scanned, and only
+PG4s overlapping a region are output. Overlapping regions are merged, so PG4s
+are not reported twice. Cannot be used with --index
+''')
         general.add_argument(
             '-b', '--bed', type=str, required=True,
             help='Output bed file, use \'-\' to write to stdout')
@@ -151,6 +262,19 @@ high scoring, non-overlapping PG4s
             help='''
 use merge method to flatten overlapping PG4s, output is in bed6 and overrides
 the --write-bed12 flag
+''')
+        general.add_argument(
+            '-S', '--min-score', type=float, required=False, default=None,
+            help='''
+only report PG4s scoring at least this much. Loop and bulge lengths which
+cannot reach the score are not searched for, so higher scores run faster.
+Overlapping PG4s are filtered or merged after low scoring PG4s are removed
+''')
+        general.add_argument(
+            '-N', '--top-n', type=int, required=False, default=None,
+            help='''
+only report the N highest scoring PG4s (after filtering or merging), in
+position order. The first PG4s found are kept from equal scores
 ''')
         general.add_argument(
             '-c', '--soft-mask', action='store_true',
@@ -158,6 +282,40 @@ the --write-bed12 flag
             help='''
 if input fasta contains soft masking (i.e. lower case nucleotides in repetitive
 or low complexity regions), switch on case sensitivity to ignore these regions
+''')
+        general.add_argument(
+            '-e', '--engine', type=str, required=False, default='regex',
+            choices=g4.ENGINES,
+            help='''
+matching engine, regex scans the sequence once per pattern, combined scans it
+once per strand with all patterns merged, runs finds G/C runs once and
+enumerates PG4s from them, extend finds PG4 starts like combined then extends
+them one tetrad at a time through G/C runs for all patterns at once, which is
+fastest with tetrads of 4 or more and many bulge combinations. All give the
+same results
+''')
+        general.add_argument(
+            '-k', '--chunk-size', type=int, required=False, default=None,
+            help='''
+scan sequences in overlapping chunks of this many bases to bound memory use on
+long chromosomes. Results are the same as scanning whole sequences. Fasta read
+from stdin or gzipped files is always scanned in chunks (of 10000000 bases by
+default) as it is read
+''')
+        general.add_argument(
+            '-p', '--threads', type=int, required=False, default=1,
+            help='''
+number of worker processes or threads to use. Contigs, or chunks of long
+contigs, are scanned in parallel
+''')
+        general.add_argument(
+            '-P', '--pool', type=str, required=False, default='process',
+            choices=('process', 'thread'),
+            help='''
+use a pool of processes or threads with --threads. Threads scan the patterns
+of one sequence concurrently without copying it, which uses less memory than
+processes. Only the regex, combined and extend engines can use threads, and
+not with --index
 ''')
         score = p.add_argument_group('Score', description='''
 Score method parameters. Scoring method is x*T - y*L - z*B, where T is the
@@ -229,17 +387,157 @@ or 1s to disallow G in specific loops
         help='max runs of G to use to predict partial PG4s')
 
     args = a.parse_args(args=argv)
+    if args.func is filter_bed and args.sort_memory < 1:
+        a.error('--sort-memory should be a positive integer')
+    if args.func in (index, filter_bed):
+        return args.func(vars(args))
+
     if not args.write_bed12 and not args.write_bed6:
         args.write_bed12 = True  # this is the default
     elif args.write_bed12 and args.write_bed6:
         a.error('--write-bed12 and --write-bed6 are mutually exclusive')
 
+    if args.chunk_size is not None and args.chunk_size < 1:
+        a.error('--chunk-size should be a positive integer')
+
+    if args.threads < 1:
+        a.error('--threads should be a positive integer')
+
+    if args.top_n is not None and args.top_n < 1:
+        a.error('--top-n should be a positive integer')
+
+    if args.pool == 'thread' and args.index is not None:
+        a.error('--pool thread cannot be used with --index')
+
+    if args.pool == 'thread' and args.engine == 'runs':
+        a.error('--pool thread cannot be used with the runs engine')
+
+    if args.regions is not None and args.index is not None:
+        a.error('--regions cannot be used with --index')
+
     if args.filter_overlapping is args.merge_overlapping is True:
         a.error(
             '--filter-overlapping and --merge-overlapping'
             ' are mutually exclusive')
 
-    return args.func(vars(args))
+    try:
+        general_params, g4_regex = args.func(vars(args))
+        if general_params['index'] is not None:
+            # checked now, rather than when the first table is read and the
+            # output file is already open
+            index = g4.RunIndex(general_params['index'])
+            index.check_soft_mask(g4_regex._params['soft_mask'])
+            if g4_regex.min_table_run:
+                index.check_min_run(g4_regex.min_table_run)
+    except (IOError, ValueError) as e:
+        # e.g. a --min-score no PG4 can reach, or an incompatible --index
+        a.error(str(e))
+    return general_params, g4_regex
+
+
+def predict(general_params, g4_regex):
+    '''
+    G4Records for every G4 in the input fasta or run index. Records are
+    formatted as bed when written. If a bed file of regions is given, only
+    the regions are scanned and only G4s overlapping them are kept.
+    '''
+    if general_params['regions'] is None:
+        return _predict(general_params, g4_regex)
+    regions = g4.RegionSet.from_bed(general_params['regions'])
+    log.info('Scanning {} bases of regions'.format(len(regions)))
+    return (record for record in _predict(general_params, g4_regex, regions)
+            if regions.overlaps(record.chrom, record.start, record.end))
+
+
+def _predict(general_params, g4_regex, regions=None):
+    use_bed12 = general_params['write_bed12']
+    threads = general_params['threads']
+    if general_params['index'] is not None:
+        if threads > 1:
+            for record in g4.parallel_g4s_from_index(
+                    g4_regex, general_params['index'], threads,
+                    use_bed12=use_bed12):
+                yield record
+            return
+        index = g4.RunIndex(general_params['index'])
+        for seq_id, table in index.iter_tables(g4_regex._params['soft_mask']):
+            for record in g4_regex.get_g4s_from_runs(
+                    table, seq_id=seq_id, use_bed12=use_bed12):
+                yield record
+    else:
+        with g4.open_fasta(general_params['fasta'], threads) as f:
+            if regions is None and not isinstance(f, g4.TwoBitReader):
+                seqs = f.parse_fasta()
+            else:
+                # .2bit records are also split around their N blocks
+                seqs = f.parse_regions(regions, g4_regex.max_length)
+            if threads > 1 and general_params['pool'] == 'thread':
+                for record in g4.threaded_g4s_as_bed(
+                        g4_regex, seqs, threads,
+                        use_bed12=use_bed12,
+                        chunk_size=general_params['chunk_size']):
+                    yield record
+                return
+            if threads > 1:
+                for record in g4.parallel_g4s_as_bed(
+                        g4_regex, seqs, threads,
+                        use_bed12=use_bed12,
+                        chunk_size=general_params['chunk_size']):
+                    yield record
+                return
+            # chunks of stdin or gzipped input are scanned as they are read
+            for chunk in f.iter_chunks(
+                    general_params['chunk_size'], g4_regex.max_length,
+                    regions):
+                for record in g4_regex.get_g4s_from_chunk(chunk, use_bed12):
+                    yield record
+
+
+def build_index(general_params):
+    '''
+    build a run index from the input fasta
+    '''
+    log.info('Indexing G and C runs')
+    with g4.open_fasta(general_params['fasta']) as f:
+        n_contigs = g4.build_run_index(
+            f.parse_fasta(), general_params['output'],
+            soft_mask=general_params['soft_mask'],
+            min_run=general_params['min_run'])
+    log.info('Indexed {} contigs'.format(n_contigs))
+    return 0
+
+
+def filter_bed_file(general_params):
+    '''
+    filter or merge the overlapping records of an existing bed file
+    '''
+    if general_params['filter_overlapping']:
+        log.info('Filtering overlapping G4s')
+        filter_method = g4.filter_overlapping
+    else:
+        log.info('Merging overlapping G4s')
+        filter_method = g4.merge_overlapping
+
+    bed = general_params['input']
+    if general_params['sort']:
+        log.info('Sorting input')
+        bed = g4.sort_bed_file(
+            bed, general_params['sort_memory'] * 1048576,
+            general_params['spill_dir'])
+
+    g4count = 0
+    with g4.BedWriter(general_params['bed']) as o:
+        # blocks of lines are written as they are filtered
+        for lines in g4.filter_bed(bed, filter_method):
+            try:
+                o.write(lines)
+            except IOError:
+                break
+            g4count += lines.count('\n') + 1
+
+    log.info('Wrote {} G4s'.format(g4count))
+    log.info('Complete')
+    return 0
 
 
 def main(args=None):
@@ -254,28 +552,21 @@ def main(args=None):
     general_params, g4_regex = parse_args(args)
 
     log.info('Parameters:\n{}'.format(pformat(general_params, indent=8)))
+    if g4_regex is None:
+        return general_params['run'](general_params)
+
     log.info('G4 Parameters: \n{}'.format(pformat(g4_regex._params, indent=8)))
 
-    # if we want to filter overlapping records, we need to write to file, then
-    # sort the file before we do the filtering.
+    # records are predicted in sorted order (by start position, with contigs
+    # in input order) so are written out directly unless they are filtered
     log.info('Predicting G4s')
-    with g4.BedWriter() as o1, g4.FastaReader(general_params['fasta']) as f:
-        g4count = 0
-        for seq_id, seq in f.parse_fasta():
-            for record in g4_regex.get_g4s_as_bed(
-                    seq, seq_id=seq_id,
-                    use_bed12=general_params['write_bed12']):
-                o1.write(record)
-                g4count += 1
-    log.info('Predicted {} G4s'.format(g4count))
-
-    log.info('Sorting G4s...')
-    s = g4.sort_bed_file(o1.fn)
+    records = predict(general_params, g4_regex)
 
     if general_params['filter_overlapping'] or (
             general_params['merge_overlapping']):
 
-        # reopen sorted bedfile and filter it:
+        # filter the sorted records as they are predicted, the filtered
+        # records are sorted too:
         if general_params['filter_overlapping']:
             log.info('Filtering overlapping G4s')
             filter_method = g4.filter_overlapping
@@ -283,28 +574,26 @@ def main(args=None):
             log.info('Merging overlapping G4s')
             filter_method = g4.merge_overlapping
 
-        g4count = 0
-        with g4.BedWriter() as ff:
-            for record in g4.apply_filter_method(s, filter_method):
-                ff.write(record)
-                g4count += 1
-        log.info('{} G4s remaining after filter method'.format(g4count))
+        records = g4.apply_filter_method(records, filter_method)
 
-        # create new sorted file, post filtering
-        log.info('Resorting G4s...')
-        s = g4.sort_bed_file(ff.fn)
+    if general_params['top_n'] is not None:
+        log.info('Keeping the {} highest scoring G4s'.format(
+            general_params['top_n']))
+        records = g4.top_scoring(records, general_params['top_n'])
 
-    with g4.BedWriter(general_params['bed']) as o2:
-        for record in s:
+    g4count = 0
+    with g4.BedWriter(general_params['bed']) as o:
+        for record in records:
             try:
-                o2.write(record)
+                o.write(record)
             except IOError:
                 # this avoids BrokenPipeError or IOError when piping output to
                 # to head
                 break
+            g4count += 1
 
-    log.info('Complete. Cleaning up temporary files')
-    os.remove(o1.fn)
+    log.info('Wrote {} G4s'.format(g4count))
+    log.info('Complete')
 
     return 0
 
@@ -4,11 +4,25 @@ putative G Quadruplexes.
 
 author: Matthew Parker
 '''
-from collections import defaultdict
+from collections import defaultdict, namedtuple
 from copy import copy, deepcopy
+from functools import lru_cache, reduce
+import heapq
 from itertools import product
-from operator import itemgetter
+from operator import or_
 import regex
+import numpy as np
+
+from .g4runs import (
+    RunTable, RunMatch, spec_families, iter_run_matches, iter_extend_matches)
+from .g4fileutils import G4Record, iter_chunks
+
+# matching engines available to G4Regex, "regex" uses one overlapped regex
+# search per pattern, "combined" uses one search per strand with all patterns
+# merged to find G4 start positions, "runs" enumerates G4s from a table of
+# G/C runs, "extend" extends G4s tetrad by tetrad from the same table, placing
+# bulges from the runs rather than trying every bulge combination
+ENGINES = ('regex', 'combined', 'runs', 'extend')
 
 # DEFAULT PARAMETERS:
 # start and stop are inclusive
@@ -24,7 +38,8 @@ PARAMETERS = dict(
                       loop_pen_factor=1.5,
                       bulge_pen_factor=5),
     inter_kwargs=dict(start=2, stop=3),
-    soft_mask=False
+    soft_mask=False,
+    min_score=None
 )
 
 # REGEX BASES:
@@ -58,6 +73,188 @@ BULGED_TETRAD_BASE = (
     '(?P<btet{n}_2>{base}{{{t2}}})'
 )
 
+# the prefilter (see G4Regex._candidate_windows) checks blocks of this many
+# bases for G/C runs with fast substring searches. Smaller blocks skip more
+# of the sequence but make more searches.
+PREFILTER_BLOCK_SIZE = 1000
+
+
+# number of compiled pattern sets kept in memory. Each distinct set of G4
+# parameters (and flags) uses one slot, so long running processes which
+# create many G4Regex instances do not grow without bound.
+PATTERN_CACHE_SIZE = 16
+
+# get_g4s_as_arrays collects matches into arrays (and scores them) in
+# batches of this many G4s, so the per-match python objects do not all
+# need to be kept in memory at once
+ARRAY_BATCH_SIZE = 100000
+
+
+# everything about a match which is fixed by the pattern it belongs to, so
+# that it is worked out once per pattern rather than once per match.
+# loop_groups and tetrad_groups are group numbers, name is a format string
+# taking the comma separated loop lengths, and base_score and bulge_pen
+# are the tetrad and bulge terms of the score (see G4Regex._score_g4)
+PatternInfo = namedtuple('PatternInfo', [
+    'n_tetrad', 'l_tetrad', 'loop_groups', 'tetrad_groups', 'bulge_flag',
+    'n_bulges', 'name', 'tetrad_bp', 'base_score', 'bulge_pen'])
+
+
+def _match_start(strand_m):
+    return strand_m[1].start()
+
+
+def merge_match_streams(streams):
+    '''
+    merge streams of strand, match tuples which are each ordered by start
+    position (e.g. the overlapped matches of one pattern) into one stream
+    ordered by start position, using a heap. Matches with the same start
+    are kept in the order of the streams.
+    '''
+    if len(streams) == 1:
+        return iter(streams[0])
+    return heapq.merge(*streams, key=_match_start)
+
+
+def _with_strand(strand, matches):
+    for m in matches:
+        yield strand, m
+
+
+def _run_matches(r, table, spec, base):
+    for spans in iter_run_matches(table, spec, base):
+        yield RunMatch(r, spans)
+
+
+@lru_cache(maxsize=PATTERN_CACHE_SIZE)
+def _compile_patterns(patterns, flags):
+    '''
+    compile a tuple of regular expression strings. Patterns are not added to
+    the regex module's own cache, we keep them here instead.
+    '''
+    return tuple(
+        regex.compile(p, flags, cache_pattern=False) for p in patterns)
+
+
+def _element_regex(element, base):
+    '''
+    regular expression for one tetrad, bulged tetrad or loop element of a
+    pattern spec, the same as the one it was built with
+    '''
+    kind = element[0]
+    if kind == 'tet':
+        return TETRAD_BASE.format(base=base * element[2]).format(n=element[1])
+    elif kind == 'btet':
+        _, n, t1, t2, start, stop = element
+        return BULGED_TETRAD_BASE.format(
+            base=base, n=n, t1=t1, t2=t2, start=start, stop=stop)
+    _, n, start, stop, allow_G = element
+    if allow_G:
+        return LOOP_BASE.format(n=n, start=start, stop=stop)
+    return LOOP_BASE_NO_G.format(
+        n=n, b='C' if base == 'G' else 'G', start=start, stop=stop)
+
+
+def _split_pattern(pattern):
+    '''
+    split a G4 regex into its top level groups (tetrads, loops and bulges),
+    with group names removed.
+    '''
+    elements = []
+    depth = 0
+    element = ''
+    for char in pattern:
+        element += char
+        if char == '(':
+            depth += 1
+        elif char == ')':
+            depth -= 1
+            if depth == 0:
+                elements.append(element)
+                element = ''
+    return [regex.sub(r'^\(\?P<\w+>', '(?:', e) for e in elements]
+
+
+def _combine_patterns(patterns):
+    '''
+    merge patterns into a single regex which matches wherever any of them
+    match. Patterns are stored in a trie of their elements so that shared
+    prefixes (e.g. the first tetrad and loop) are only matched once, rather
+    than once per pattern.
+    '''
+    trie = {}
+    for pattern in patterns:
+        node = trie
+        for element in _split_pattern(pattern):
+            node = node.setdefault(element, {})
+        # empty key marks the end of a pattern
+        node[''] = {}
+
+    def build(node):
+        if not node:
+            return ''
+        alternatives = [k + build(v) for k, v in node.items()]
+        if len(alternatives) == 1:
+            return alternatives[0]
+        return '(?:{})'.format('|'.join(alternatives))
+
+    return build(trie)
+
+
+class G4PatternSet(object):
+
+    '''
+    Compiled regular expressions for both strands.
+
+    Patterns are compiled once and shared between all instances built with
+    the same regular expressions. Only the pattern strings and flags are
+    pickled, so sending a G4PatternSet to a worker process is cheap.
+    '''
+
+    def __init__(self, patterns, flags=0):
+        self.patterns = {
+            strand: tuple(p) for strand, p in patterns.items()}
+        self.flags = flags
+        self.compiled = {
+            strand: _compile_patterns(p, flags)
+            for strand, p in self.patterns.items()}
+        self._compiled_bytes = {}
+        self._combined = {}
+
+    def __getitem__(self, strand):
+        return self.compiled.get(strand, ())
+
+    def get(self, strand, binary=False):
+        '''
+        compiled patterns for strand. If binary is True the patterns match
+        bytes-like sequences (e.g. memoryviews of a SharedSequence) instead
+        of strings.
+        '''
+        if not binary:
+            return self[strand]
+        if strand not in self._compiled_bytes:
+            self._compiled_bytes[strand] = _compile_patterns(
+                tuple(p.encode() for p in self.patterns.get(strand, ())),
+                self.flags)
+        return self._compiled_bytes[strand]
+
+    def combined(self, strand, binary=False):
+        '''
+        compiled regex which matches at the start of any match of the
+        patterns for strand. Only used to find start positions, the matching
+        individual patterns are then used to get the groups.
+        '''
+        if (strand, binary) not in self._combined:
+            combined = _combine_patterns(self.patterns[strand])
+            if binary:
+                combined = combined.encode()
+            self._combined[strand, binary] = _compile_patterns(
+                (combined,), self.flags)[0]
+        return self._combined[strand, binary]
+
+    def __reduce__(self):
+        return (self.__class__, (self.patterns, self.flags))
+
 
 class G4Regex:
 
@@ -65,12 +262,22 @@ class G4Regex:
     Class for predicting G Quadruplexes.
 
     G Quadruplex tetrad length, loop length and bulge length parameters can
-    be set to vary range of Quadruplexes which are predicted.
+    be set to vary range of Quadruplexes which are predicted. The engine
+    used to find matches (see ENGINES) gives identical results.
     '''
 
     def __init__(self, **kwargs):
         self._params = deepcopy(PARAMETERS)
 
+        self._engine = kwargs.get('engine', 'regex')
+        if self._engine not in ENGINES:
+            raise ValueError(
+                'engine should be one of {}'.format(', '.join(ENGINES)))
+
+        # only scan windows of the sequence around G/C runs which could be
+        # part of a G4 (see _candidate_windows). Not used by the runs engine.
+        self._prefilter = kwargs.get('prefilter', True)
+
         # update parameters
         if kwargs.get('tetrad_kwargs', False):
             self._params['tetrad_kwargs'].update(kwargs['tetrad_kwargs'])
@@ -95,17 +302,36 @@ class G4Regex:
         if kwargs.get('soft_mask', False):
             self._params['soft_mask'] = True
 
+        if kwargs.get('min_score') is not None:
+            self._params['min_score'] = kwargs['min_score']
+
         # use case insensitive matching if soft masking is turned off.
         if self._params['soft_mask']:
             self._regex_flags = []
         else:
             self._regex_flags = [regex.IGNORECASE]
 
-        # self._regex stores generated regular expressions
+        # self._regex stores generated regular expressions, self._specs
+        # stores the same patterns as tuples of tetrad/bulge/loop elements
+        # for use by the run engine (see g4runs.py)
         self._regex = defaultdict(list)
+        self._specs = defaultdict(list)
 
         self._build_g4_regex()
 
+        if self._params['min_score'] is not None:
+            self._tighten_patterns()
+
+        # compile the regular expressions once, they are reused for every
+        # sequence passed to get_g4s_as_bed
+        self._patterns = G4PatternSet(
+            self._regex, reduce(or_, self._regex_flags, 0))
+        self._info = self._build_pattern_info()
+        if self._engine == 'extend':
+            self._families = {
+                strand: spec_families(specs)
+                for strand, specs in self._specs.items()}
+
     def _build_g4_regex(self):
 
         # generate separate regex for each strand (G4s on neg strand are still
@@ -118,8 +344,9 @@ class G4Regex:
             tetrad_kwargs_c = copy(self._params['tetrad_kwargs'])
             bulge_kwargs_c = copy(self._params['bulge_kwargs'])
 
-            # generate loop regex
+            # generate loop regex, and matching specs for the run engine
             loop_regex = []
+            loop_specs = []
             for i, kw in enumerate(loop_kwargs_c):
 
                 # for each loop, check if G's are allowed.
@@ -132,10 +359,20 @@ class G4Regex:
                     allowed_base = 'C' if strand == '+' else 'G'
                     loop_regex.append(
                         LOOP_BASE_NO_G.format(n=i, b=allowed_base, **kw))
+                loop_specs.append(
+                    ('loop', i, kw['start'], kw['stop'], bool(allow_G)))
 
             # reverse loops for opposite strand
             if strand == '-':
                 loop_regex = loop_regex[::-1]
+                loop_specs = loop_specs[::-1]
+
+            # maximum number of bulges that we can allow up to, the same for
+            # every tetrad number
+            n_bulged = bulge_kwargs_c.pop('bulges_allowed', 0)
+
+            # minimum number of unbulged tetrads can allow
+            n_unbulged = 4 - n_bulged
 
             # create individual regexes for each tetrad number
             # this is slower than backrefs when not allowing bulges,
@@ -144,12 +381,6 @@ class G4Regex:
                            tetrad_kwargs_c['stop'] + 1):
                 tet_regex = TETRAD_BASE.format(base=base * t)
 
-                # maximum number of bulges that we can allow up to
-                n_bulged = bulge_kwargs_c.pop('bulges_allowed', 0)
-
-                # minimum number of unbulged tetrads can allow
-                n_unbulged = 4 - n_bulged
-
                 # the bulge can fall anywhere inside the tetrad, e.g.
                 #    GATGGG
                 #    GGATGG
@@ -167,11 +398,13 @@ class G4Regex:
                 # now we build a regex for each bulge combination
                 for comb in bulge_combinations:
                     g4_regex = []
+                    g4_spec = []
                     for i in range(4):  # iter over tetrads
                         if comb[i] == 0:
 
                             # if comb is 0 add unbulged tetrad, use i to name
                             g4_regex.append(tet_regex.format(n=i))
+                            g4_spec.append(('tet', i, t))
                         else:
 
                             # if comb != 0 we add a bulged tetrad
@@ -183,117 +416,534 @@ class G4Regex:
                                 t2=t - comb[i],
                                 **bulge_kwargs_c)
                             g4_regex.append(bulge_regex)
+                            g4_spec.append(
+                                ('btet', i, comb[i], t - comb[i],
+                                 bulge_kwargs_c['start'],
+                                 bulge_kwargs_c['stop']))
 
                         # append a loop after each tetrad
                         try:
                             g4_regex.append(loop_regex[i])
+                            g4_spec.append(loop_specs[i])
                         except IndexError:
                             # no loop after last tetrad
                             pass
 
                     # add to ever increasing dict of regexes
                     self._regex[strand].append(''.join(g4_regex))
+                    self._specs[strand].append(tuple(g4_spec))
 
-    def get_g4s_as_bed(self, seq, seq_id='unknown', use_bed12=True):
+    def _tighten_patterns(self):
+        '''
+        the score of a G4 falls with the total length of its loops and
+        bulges (see _score_g4), so min_score caps that length for each
+        pattern. Patterns which cannot score min_score even with their
+        shortest loops and bulges are dropped, and the longest loop and
+        bulge lengths of the rest are cut to what the cap allows, so there
+        is less to scan. Loops which allow G are tried shortest first, and
+        other loops and bulges are fixed by the runs around them, so the G4
+        a pattern finds at a position is also its shortest there: the
+        tightened pattern finds the same G4 wherever it scores at least
+        min_score, and nothing where it does not.
+        '''
+        score_params = self._params['score_kwargs']
+        loop_pen_factor = score_params['loop_pen_factor']
+        min_score = self._params['min_score']
+        if loop_pen_factor <= 0:
+            # longer G4s do not score less, matches are only filtered
+            return
+        regexes = defaultdict(list)
+        specs = defaultdict(list)
+        for strand, base in (('+', 'G'), ('-', 'C')):
+            for pattern, spec in zip(self._regex[strand], self._specs[strand]):
+                first = spec[0]
+                l_tetrad = (first[2] if first[0] == 'tet'
+                            else first[2] + first[3])
+                base_score = score_params['tetrad_score_factor'] * l_tetrad
+                bulge_pen = score_params['bulge_pen_factor'] * sum(
+                    1 for e in spec if e[0] == 'btet')
+
+                def score(gap):
+                    # the same sum as _score_g4, for the same rounding
+                    return base_score - loop_pen_factor * gap - bulge_pen
+
+                # shortest loops and bulges, and the longest total allowed
+                min_gap = sum(e[2] if e[0] == 'loop' else e[4]
+                              for e in spec if e[0] != 'tet')
+                max_gap = int((base_score - bulge_pen - min_score) /
+                              loop_pen_factor)
+                while score(max_gap + 1) >= min_score:
+                    max_gap += 1
+                while max_gap >= min_gap and score(max_gap) < min_score:
+                    max_gap -= 1
+                if max_gap < min_gap:
+                    continue
+                tightened = []
+                for e in spec:
+                    if e[0] == 'loop':
+                        e = e[:3] + (min(e[3], max_gap - min_gap + e[2]),
+                                     e[4])
+                    elif e[0] == 'btet':
+                        e = e[:5] + (min(e[5], max_gap - min_gap + e[4]),)
+                    tightened.append(e)
+                tightened = tuple(tightened)
+                if tightened != spec:
+                    pattern = ''.join(
+                        _element_regex(e, base) for e in tightened)
+                regexes[strand].append(pattern)
+                specs[strand].append(tightened)
+        if not regexes:
+            raise ValueError(
+                'no G4 can score at least min_score ({})'.format(min_score))
+        self._regex = regexes
+        self._specs = specs
+
+    def _min_score_matches(self, matches):
+        '''
+        strand, match for each of matches scoring at least min_score
+        '''
+        min_score = self._params['min_score']
+        for strand, m in matches:
+            start, end = m.span(0)
+            if self._score_g4(self._info[m.re.pattern], end - start) >= (
+                    min_score):
+                yield strand, m
+
+    def _build_pattern_info(self):
+        '''
+        PatternInfo for every pattern, keyed by the pattern string. Both
+        str and bytes pattern strings are keys, as matches on bytes-like
+        sequences belong to the bytes versions of the patterns.
+        '''
+        info = {}
+        for strand, specs in self._specs.items():
+            for r, spec in zip(self._patterns[strand], specs):
+                info[r.pattern] = info[r.pattern.encode()] = (
+                    self._pattern_info(r, spec))
+        return info
+
+    def _pattern_info(self, r, spec):
+        score_params = self._params['score_kwargs']
+        # tetrad lengths are fixed by the pattern, all are the same length
+        # in bp (bulged tetrads are split into two parts)
+        first = spec[0]
+        l_tetrad = first[2] if first[0] == 'tet' else first[2] + first[3]
+        bulge_pos = set(e[1] for e in spec if e[0] == 'btet')
+        n_bulges = len(bulge_pos)
+        bulge_flag = sum(2 ** f for f in bulge_pos)
+        return PatternInfo(
+            n_tetrad=4,
+            l_tetrad=l_tetrad,
+            loop_groups=tuple(
+                r.groupindex['loop{}'.format(x)] for x in (0, 1, 2)),
+            # tetrads are always first and last matched groups with only one
+            # other group between them: use [::2] to get their numbers
+            tetrad_groups=tuple(range(1, r.groups + 1, 2)),
+            bulge_flag=bulge_flag,
+            n_bulges=n_bulges,
+            name='{}t{}b'.format(l_tetrad, bulge_flag) + '{}l',
+            tetrad_bp=l_tetrad * 4,
+            base_score=score_params['tetrad_score_factor'] * l_tetrad,
+            bulge_pen=score_params['bulge_pen_factor'] * n_bulges)
+
+    @property
+    def max_length(self):
+        '''
+        the longest G4 any of the patterns can match, derived from the
+        tetrad, loop and bulge limits. Sequence chunks must overlap by at
+        least this much for chunked scanning to find every G4. Zero if the
+        parameters give no patterns.
+        '''
+        def element_length(element):
+            if element[0] == 'tet':
+                return element[2]
+            elif element[0] == 'btet':
+                # both halves of the tetrad plus the longest bulge
+                return element[2] + element[3] + element[5]
+            else:
+                # longest loop
+                return element[3]
+
+        return max(
+            (sum(element_length(e) for e in spec)
+             for specs in self._specs.values() for spec in specs),
+            default=0)
+
+    @property
+    def min_run(self):
+        '''
+        the shortest run of G (or C) that every G4 the patterns can match
+        contains: the tetrad length, or the longer half of a bulged tetrad
+        if every tetrad of a pattern can be bulged. Zero if the parameters
+        give no patterns.
+        '''
+        def longest_run(spec):
+            return max(
+                e[2] if e[0] == 'tet' else max(e[2], e[3])
+                for e in spec if e[0] in ('tet', 'btet'))
+
+        return min(
+            (longest_run(spec)
+             for specs in self._specs.values() for spec in specs),
+            default=0)
+
+    @property
+    def min_table_run(self):
+        '''
+        the shortest runs of G or C which matching from a RunTable reads:
+        the shortest tetrad, or single bases if any pattern has a bulge or a
+        loop which cannot contain G, as these cannot contain any run of the
+        tetrad base (see g4runs._gap_excludes). Zero if the parameters give
+        no patterns, as then no runs are read.
+        '''
+        lengths = []
+        for specs in self._specs.values():
+            for spec in specs:
+                for e in spec:
+                    if e[0] == 'btet' or (e[0] == 'loop' and not e[4]):
+                        return 1
+                    elif e[0] == 'tet':
+                        lengths.append(e[2])
+        return min(lengths, default=0)
+
+    def get_g4s_as_bed(self, seq, seq_id='unknown', use_bed12=True,
+                       chunk_size=None, executor=None):
         '''
         query a sequence for G4s using G4Regex. Pass a seq_id to get fully
         formatted bed records.
         Predicted loops/tetrad positional information can be retained using
-        bed12 format.
+        bed12 format. Arguments are as for get_g4s.
         '''
+        for record in self.get_g4s(
+                seq, seq_id, use_bed12, chunk_size, executor):
+            yield str(record)
 
-        for strand in '+-':
-            for r in self._regex[strand]:
-                for m in regex.finditer(r,
-                                        seq,
-                                        overlapped=True,
-                                        *self._regex_flags):
-                    if use_bed12:
-                        yield self._format_bed12(m, seq_id, strand)
-                    else:
-                        yield self._format_bed6(m, seq_id, strand)
-                # clear re cache to save memory
-                regex.purge()
+    def get_g4s(self, seq, seq_id='unknown', use_bed12=True,
+                chunk_size=None, executor=None):
+        '''
+        query a sequence for G4s using G4Regex, yielding G4Records. These
+        are only formatted as text when written, so can be filtered or
+        merged without parsing bed lines.
+        If chunk_size is given, the sequence is scanned in overlapping
+        chunks of chunk_size bases. Records are the same, in the same order
+        (by start position, see _iter_matches), as for a whole sequence
+        scan.
+        If a concurrent.futures executor is given, the patterns are scanned
+        concurrently in it (see _iter_matches).
+        '''
+        for chunk in iter_chunks(seq_id, seq, chunk_size, self.max_length):
+            for record in self.get_g4s_from_chunk(chunk, use_bed12, executor):
+                yield record
 
-    def _format_bed6(self, match, seq_id, strand):
+    def get_g4s_from_chunk(self, chunk, use_bed12=True, executor=None):
+        '''
+        query a SeqChunk for G4s. Only G4s starting in the first
+        chunk.n_owned bases are reported, the remainder of the chunk overlaps
+        the next chunk which reports them instead. Coordinates are relative
+        to the whole sequence.
+        '''
+        for strand, m in self._iter_chunk_matches(chunk, executor):
+            yield self._make_record(
+                m, chunk.seq_id, strand, chunk.offset, use_bed12)
+
+    def _iter_chunk_matches(self, chunk, executor=None):
+        for strand, m in self._iter_matches(
+                chunk.seq, executor, chunk.n_owned):
+            if m.start() < chunk.n_owned:
+                yield strand, m
+
+    def get_g4s_as_arrays(self, seq, chunk_size=None, executor=None,
+                          batch_size=ARRAY_BATCH_SIZE):
+        '''
+        query a sequence for G4s, returning a numpy structured array with
+        one row per G4 (see array_dtype) in the same order as get_g4s.
+        Matches are collected and scored in batches of batch_size, nothing
+        is formatted as text. chunk_size and executor are as for get_g4s.
         '''
-        format a bed6 entry
+        dtype = self.array_dtype
+        no_loop = (-1,) * self._n_loops
+        batches = []
+        rows = []
+        for chunk in iter_chunks(None, seq, chunk_size, self.max_length):
+            offset = chunk.offset
+            for strand, m in self._iter_chunk_matches(chunk, executor):
+                start, end = m.span(0)
+                n_tetrad, l_tetrad, loops, bulge_flag, n_bulges = (
+                    self._match_fields(m))
+                rows.append(
+                    (start + offset, end + offset, strand, n_tetrad, l_tetrad)
+                    + loops + no_loop[len(loops):]
+                    + (bulge_flag, n_bulges, 0.0))
+                if len(rows) == batch_size:
+                    batches.append(self._score_array(np.array(rows, dtype)))
+                    rows = []
+        batches.append(self._score_array(np.array(rows, dtype)))
+        return np.concatenate(batches)
+
+    @property
+    def array_dtype(self):
         '''
-        # use groupdict to count bulges and tetrads, to name the PG4
-        gd = match.groupdict()
-        tetrads = [v for k, v in gd.items() if k.startswith('tet')]
-        l_tetrad = len(tetrads[0])  # length of each tetrad in bp
+        dtype of the arrays returned by get_g4s_as_arrays. Loop lengths are
+        in fields loop0, loop1, etc, with -1 where a G4 has fewer loops.
+        '''
+        return np.dtype(
+            [('start', np.int64), ('end', np.int64), ('strand', 'U1'),
+             ('n_tetrad', np.int32), ('l_tetrad', np.int32)] +
+            [('loop{}'.format(i), np.int32) for i in range(self._n_loops)] +
+            [('bulge_flag', np.int32), ('n_bulges', np.int32),
+             ('score', np.float64)])
 
-        loops = [gd['loop{}'.format(x)] for x in (0, 1, 2)]
-        loops = ','.join(str(len(x)) for x in loops)
+    _n_loops = 3
 
-        bulges = [k for k, v in gd.items() if k.startswith('btet')]
-        bulge_pos = set(k[4] for k in bulges)
-        n_bulges = len(bulge_pos)
-        bulge_flag = sum(2 ** int(f) for f in bulge_pos)
+    def _iter_matches(self, seq, executor=None, n_owned=None):
+        '''
+        yield strand, match for every match of every pattern, ordered by
+        start position. Each pattern on each strand (or each strand for the
+        combined and extend engines) is scanned in order of position, and
+        the scans are merged (see merge_match_streams), so matches at the
+        same position are ordered + strand first, then by pattern.
+        With an executor, the regex engine scans each pattern and the
+        combined and extend engines each strand as a separate task. The
+        regex module releases the GIL while matching, so tasks can run in
+        threads which all share seq. Matches are yielded in the same order
+        as without an executor.
+        seq can be a string or a bytes-like object such as a memoryview of
+        a SharedSequence, which is scanned without copying.
+        If n_owned is given, matches starting after it may not be yielded.
+        With a min_score, only matches scoring at least min_score are
+        yielded (see _tighten_patterns).
+        '''
+        if not self._specs:
+            # e.g. an empty tetrad range, nothing can match
+            return
+        if self._engine == 'runs':
+            # pure python, nothing to gain from threads
+            table = RunTable(seq, self._params['soft_mask'])
+            for strand_m in self._iter_run_matches(table):
+                yield strand_m
+            return
+
+        binary = not isinstance(seq, str)
+        if n_owned is None:
+            n_owned = len(seq)
+        if self._prefilter:
+            windows = self._candidate_windows(seq, n_owned, binary)
+        else:
+            windows = [(0, len(seq), len(seq))]
+
+        if self._engine == 'combined':
+            scans = [(self._scan_combined, seq, windows, strand, binary)
+                     for strand in '+-']
+        elif self._engine == 'extend':
+            scans = [(self._scan_extend, seq, windows, strand, binary)
+                     for strand in '+-']
+        else:
+            scans = [(self._scan_pattern, seq, windows, strand, r)
+                     for strand in '+-'
+                     for r in self._patterns.get(strand, binary)]
 
-        start, end = match.span(0)
-        name = '{}t{}b{}l'.format(l_tetrad, bulge_flag, loops)
-        score = self._score_g4(l_tetrad, n_bulges, end - start)
+        if executor is None:
+            streams = [scan(*args) for scan, *args in scans]
+        else:
+            def run_scan(scan_args):
+                scan, *args = scan_args
+                return list(scan(*args, concurrent=True))
+
+            streams = list(executor.map(run_scan, scans))
+        matches = merge_match_streams(streams)
+        if self._params['min_score'] is not None:
+            matches = self._min_score_matches(matches)
+        for strand_m in matches:
+            yield strand_m
+
+    def _candidate_windows(self, seq, n_owned, binary=False):
+        '''
+        (start, end, owned_end) windows of seq which together contain every
+        G4 starting in the first n_owned bases. Every G4 contains a run of
+        min_run G or C, so only blocks of seq with such a run, plus
+        max_length bases before them, need to be scanned, and scans from
+        there never need to read more than max_length bases ahead. Long
+        stretches of N or AT rich sequence are skipped. Matches starting at
+        or after owned_end belong to another window, or to no window.
+        '''
+        margin = self.max_length
+        min_run = self.min_run
+        block_size = PREFILTER_BLOCK_SIZE
+        runs = ['G' * min_run, 'C' * min_run]
+        if binary:
+            runs = [run.encode() for run in runs]
+        owned = []
+        # a run starting in a block may end in the next one
+        for start in range(0, min(len(seq), n_owned + margin), block_size):
+            block = seq[start: start + block_size + min_run - 1]
+            if binary:
+                block = bytes(block)
+            if not self._params['soft_mask']:
+                block = block.upper()
+            if not any(run in block for run in runs):
+                continue
+            first = max(start - margin, 0)
+            last = min(start + block_size, n_owned)
+            if first >= last:
+                continue
+            if owned and first <= owned[-1][1]:
+                owned[-1][1] = last
+            else:
+                owned.append([first, last])
+        return [(first, min(last + margin, len(seq)), last)
+                for first, last in owned]
+
+    def _scan_pattern(self, seq, windows, strand, r, concurrent=False):
+        for start, end, owned_end in windows:
+            for m in r.finditer(seq, start, end, overlapped=True,
+                                concurrent=concurrent):
+                if m.start() >= owned_end:
+                    break
+                yield strand, m
+
+    def _combined_starts(self, seq, windows, strand, binary=False,
+                         concurrent=False):
+        '''
+        yield window end, start for every position in windows where any
+        pattern for strand matches, in order.
+        '''
+        combined = self._patterns.combined(strand, binary)
+        for start, end, owned_end in windows:
+            for c in combined.finditer(
+                    seq, start, end, overlapped=True, concurrent=concurrent):
+                pos = c.start()
+                if pos >= owned_end:
+                    break
+                yield end, pos
+
+    def _scan_combined(self, seq, windows, strand, binary=False,
+                       concurrent=False):
+        patterns = self._patterns.get(strand, binary)
+        for end, pos in self._combined_starts(
+                seq, windows, strand, binary, concurrent):
+            for r in patterns:
+                m = r.match(seq, pos, end, concurrent=concurrent)
+                if m is not None:
+                    yield strand, m
+
+    def _scan_extend(self, seq, windows, strand, binary=False,
+                     concurrent=False):
+        '''
+        find start positions with the combined pattern, then extend G4s
+        from each start through the runs of the sequence (see
+        iter_extend_matches), rather than trying each pattern in turn.
+        '''
+        table = RunTable(seq, self._params['soft_mask'])
+        starts = (pos for _, pos in self._combined_starts(
+            seq, windows, strand, binary, concurrent))
+        for m in self._iter_extend_matches(table, strand, starts):
+            yield strand, m
 
-        # format the bed record
-        bed6 = '\t'.join(('{}',)*6)
-        return bed6.format(seq_id, start, end, name, score, strand)
+    def get_g4s_from_runs(self, table, seq_id='unknown', use_bed12=True):
+        '''
+        query a RunTable (e.g. one contig of a RunIndex) for G4s using the
+        run engine. Output is the same as get_g4s for the sequence the
+        table was built from, as G4Records.
+        '''
+        for strand, m in self._iter_run_matches(table):
+            yield self._make_record(m, seq_id, strand, use_bed12=use_bed12)
 
-    def _format_bed12(self, match, seq_id, strand):
+    def _iter_run_matches(self, table):
+        '''
+        strand, RunMatch for every match in a RunTable, ordered by start
+        position like _iter_matches
+        '''
+        if not self._specs:
+            return iter(())
+        streams = []
+        for strand, base in (('+', 'G'), ('-', 'C')):
+            if self._engine == 'extend':
+                streams.append(_with_strand(
+                    strand, self._iter_extend_matches(table, strand)))
+                continue
+            for r, spec in zip(self._patterns[strand], self._specs[strand]):
+                streams.append(_with_strand(
+                    strand, _run_matches(r, table, spec, base)))
+        matches = merge_match_streams(streams)
+        if self._params['min_score'] is not None:
+            return self._min_score_matches(matches)
+        return matches
+
+    def _iter_extend_matches(self, table, strand, starts=None):
+        '''
+        RunMatches from the extend engine, ordered by position then pattern
+        like the combined engine
         '''
-        format a bed12 entry
+        patterns = self._patterns[strand]
+        base = 'G' if strand == '+' else 'C'
+        for _, found in iter_extend_matches(
+                table, self._families[strand], base, starts):
+            for i in sorted(found):
+                yield RunMatch(patterns[i], found[i])
+
+    def _make_record(self, match, seq_id, strand, offset=0,
+                     use_bed12=True):
         '''
-        # tetrads are always first and last matched groups with only one
-        # other group between them: use [::2] to get their spans
-        tetrad_spans = [
-            match.span(x + 1) for x in range(len(match.groups()))][::2]
+        make a G4Record from a match, offset is added to match coordinates.
+        Tetrad positions are only kept for bed12 records.
+        '''
+        info = self._info[match.re.pattern]
         start, end = match.span(0)
+        name = info.name.format(','.join(
+            str(match.end(x) - match.start(x)) for x in info.loop_groups))
+        score = self._score_g4(info, end - start)
+        block_sizes, block_starts = self._tetrad_blocks(
+            match, info, use_bed12)
+        return G4Record(seq_id, start + offset, end + offset, name, score,
+                        strand, block_sizes, block_starts)
+
+    def _match_fields(self, match):
+        '''
+        number and length of tetrads, loop lengths, bulge flag and number of
+        bulges of a match
+        '''
+        info = self._info[match.re.pattern]
+        loops = tuple(match.end(x) - match.start(x) for x in info.loop_groups)
+        return (info.n_tetrad, info.l_tetrad, loops, info.bulge_flag,
+                info.n_bulges)
 
-        # use groupdict to count bulges and tetrads, to name the PG4
-        gd = match.groupdict()
-        tetrads = [v for k, v in gd.items() if k.startswith('tet')]
-        l_tetrad = len(tetrads[0])  # length of each tetrad in bp
-
-        loops = [gd['loop{}'.format(x)] for x in (0, 1, 2)]
-        loops = ','.join(str(len(x)) for x in loops)
-
-        bulges = [k for k, v in gd.items() if k.startswith('btet')]
-        bulge_pos = set(k[4] for k in bulges)
-        n_bulges = len(bulge_pos)
-        bulge_flag = sum(2 ** int(f) for f in bulge_pos)
-
-        start, end = match.span(0)
-        name = '{}t{}b{}l'.format(l_tetrad, bulge_flag, loops)
-        score = self._score_g4(l_tetrad, n_bulges, end - start)
-        rgb = '85,118,209'  # nice blue colour...
-
-        # positional info
-        # tetrads shown as blocks, loops+bulges as gaps
-        block_count = 4 + n_bulges
-        block_sizes = ','.join(str(y - x) for x, y in tetrad_spans)
-        block_starts = ','.join(
-            str(x - start) for x, _ in tetrad_spans)
-
-        # format the bed record
-        bed12 = '\t'.join(('{}',)*12)
-        return bed12.format(
-            seq_id, start, end, name, score, strand,
-            start, end,  # thickStart/End the same as chromStart/End
-            rgb, block_count, block_sizes, block_starts)
-
-    def _score_g4(self, l_tetrad, n_bulge, length, n_tetrad=4):
+    @staticmethod
+    def _tetrad_blocks(match, info, use_bed12=True):
+        '''
+        sizes and starts (relative to the match start) of each tetrad, shown
+        as blocks in bed12 with loops+bulges as gaps. Empty for bed6.
+        '''
+        if not use_bed12:
+            return (), ()
+        tetrad_spans = [match.span(x) for x in info.tetrad_groups]
+        start = tetrad_spans[0][0]
+        return (tuple(y - x for x, y in tetrad_spans),
+                tuple(x - start for x, _ in tetrad_spans))
+
+    def _score_g4(self, info, length):
         '''
         currently 'score' is just number of tetrads - total length of
-        G4 loops and bulges, minus a gap penalty for bulges.
+        G4 loops and bulges, minus a gap penalty for bulges. Only the loop
+        term depends on the match, the others are taken from its PatternInfo.
+        '''
+        loop_pen = self._params['score_kwargs']['loop_pen_factor'] * (
+            length - info.tetrad_bp)
+        return info.base_score - loop_pen - info.bulge_pen
+
+    def _score_array(self, g4s):
+        '''
+        fill in the score field of an array from get_g4s_as_arrays, using
+        the same formula as _score_g4 for every G4 at once
         '''
         score_params = self._params['score_kwargs']
+        l_tetrad = g4s['l_tetrad']
         base_score = score_params['tetrad_score_factor'] * l_tetrad
         loop_pen = score_params['loop_pen_factor'] * (
-            length - l_tetrad * n_tetrad)
-        bulge_pen = score_params['bulge_pen_factor'] * n_bulge
+            (g4s['end'] - g4s['start']) - l_tetrad * g4s['n_tetrad'])
+        bulge_pen = score_params['bulge_pen_factor'] * g4s['n_bulges']
 
-        return base_score - loop_pen - bulge_pen
+        g4s['score'] = base_score - loop_pen - bulge_pen
+        return g4s
 
 
 class PartialG4Regex(G4Regex):
@@ -306,8 +956,9 @@ class PartialG4Regex(G4Regex):
             tetrad_kwargs_c = copy(self._params['tetrad_kwargs'])
             inter_kwargs_c = copy(self._params['inter_kwargs'])
 
-            # generate loop regex
+            # generate loop regex, and matching specs for the run engine
             loop_regex = []
+            loop_specs = []
             for i, kw in enumerate(loop_kwargs_c):
 
                 # for each loop, check if G's are allowed.
@@ -320,6 +971,8 @@ class PartialG4Regex(G4Regex):
                     allowed_base = 'C' if strand == '+' else 'G'
                     loop_regex.append(
                         LOOP_BASE_NO_G.format(n=i, b=allowed_base, **kw))
+                loop_specs.append(
+                    ('loop', i, kw['start'], kw['stop'], bool(allow_G)))
 
             # create individual regexes for each tetrad number
             for t in range(tetrad_kwargs_c['start'],
@@ -327,71 +980,64 @@ class PartialG4Regex(G4Regex):
                 tet_regex = TETRAD_BASE.format(base=base * t)
 
                 loop_regex_c = loop_regex[:t-1]
+                loop_specs_c = loop_specs[:t-1]
                 # reverse loops for opposite strand
                 if strand == '-':
                     loop_regex_c = loop_regex_c[::-1]
+                    loop_specs_c = loop_specs_c[::-1]
 
                 g4_regex = ''
+                g4_spec = ()
                 # create regex for range of partial G4s.
                 for i in range(inter_kwargs_c['stop']):
                     g4_regex += tet_regex.format(n=i)
+                    g4_spec += (('tet', i, t),)
 
                     if i in range(inter_kwargs_c['start'] - 1,
                                   inter_kwargs_c['stop']):
                         self._regex[strand].append(''.join(g4_regex))
+                        self._specs[strand].append(g4_spec)
 
                     # append a loop after each tetrad
                     try:
                         g4_regex += loop_regex_c[i]
+                        g4_spec += (loop_specs_c[i],)
                     except IndexError:
                         # no loop after last tetrad
                         break
 
-    def _format_bed6(self, match, seq_id, strand):
-        '''
-        format a bed6 entry
-        '''
-
-        n_tetrad = match.re.pattern.count('tet')
-
-        l_tetrad = len(match.group(1))  # length of each tetrad in bp
-
-        start, end = match.span(0)
-        name = 'PG4_{}t_{}'.format(l_tetrad, n_tetrad)
-        score = self._score_g4(l_tetrad, 0, end - start, n_tetrad)
+    @property
+    def _n_loops(self):
+        return self._params['inter_kwargs']['stop'] - 1
 
-        # format the bed record
-        bed6 = '\t'.join(('{}',)*6)
-        return bed6.format(seq_id, start, end, name, score, strand)
-
-    def _format_bed12(self, match, seq_id, strand):
+    def _pattern_info(self, r, spec):
+        score_params = self._params['score_kwargs']
+        n_tetrad = len(spec) // 2 + 1  # tetrads and loops alternate
+        l_tetrad = spec[0][2]
+        return PatternInfo(
+            n_tetrad=n_tetrad,
+            l_tetrad=l_tetrad,
+            # loops (5'->3') are the even numbered groups
+            loop_groups=tuple(range(2, 2 * n_tetrad, 2)),
+            tetrad_groups=tuple(range(1, 2 * n_tetrad, 2)),
+            bulge_flag=0,
+            n_bulges=0,
+            name='PG4_{}t_{}'.format(l_tetrad, n_tetrad),
+            tetrad_bp=l_tetrad * n_tetrad,
+            base_score=score_params['tetrad_score_factor'] * l_tetrad,
+            bulge_pen=0)
+
+    def _make_record(self, match, seq_id, strand, offset=0,
+                     use_bed12=True):
         '''
-        format a bed12 entry
+        make a G4Record from a match, offset is added to match coordinates.
+        Tetrad positions are only kept for bed12 records. Partial G4 names
+        do not depend on loop lengths.
         '''
-        # tetrads are always first and last matched groups with only one
-        # other group between them: use [::2] to get their spans
-        tetrad_spans = [
-            match.span(x + 1) for x in range(len(match.groups()))][::2]
+        info = self._info[match.re.pattern]
         start, end = match.span(0)
-
-        n_tetrad = match.re.pattern.count('tet')
-
-        l_tetrad = len(match.group(1))  # length of each tetrad in bp
-
-        name = 'PG4_{}t_{}'.format(l_tetrad, n_tetrad)
-        score = self._score_g4(l_tetrad, 0, end - start, n_tetrad)
-        rgb = '85,118,209'  # nice blue colour...
-
-        # positional info
-        # tetrads shown as blocks, loops+bulges as gaps
-        block_count = n_tetrad
-        block_sizes = ','.join(str(y - x) for x, y in tetrad_spans)
-        block_starts = ','.join(
-            str(x - start) for x, _ in tetrad_spans)
-
-        # format the bed record
-        bed12 = '\t'.join(('{}',)*12)
-        return bed12.format(
-            seq_id, start, end, name, score, strand,
-            start, end,  # thickStart/End the same as chromStart/End
-            rgb, block_count, block_sizes, block_starts)
+        score = self._score_g4(info, end - start)
+        block_sizes, block_starts = self._tetrad_blocks(
+            match, info, use_bed12)
+        return G4Record(seq_id, start + offset, end + offset, info.name,
+                        score, strand, block_sizes, block_starts)
@@ -0,0 +1,766 @@
+'''
+G4Runs: an alternative matching engine for G4Regex. Runs of G and C are
+found once per sequence and G4s are enumerated directly from the table of
+runs, using the tetrad, loop and bulge elements of each pattern, instead of
+scanning the whole sequence once per regular expression.
+
+author: Matthew Parker
+'''
+from bisect import bisect_left, bisect_right
+import struct
+import zipfile
+import numpy as np
+import regex
+
+# run types used by the engine: G, C and N, where N is anything which can
+# never be part of a G4 (i.e. not ACGT).
+RUN_REGEX = {
+    'G': 'G{{{},}}',
+    'C': 'C{{{},}}',
+    'N': '[^ACGT]{{{},}}',
+}
+
+# which run types may not appear in each kind of gap between tetrads.
+# loops which allow G cannot contain invalid characters, loops which do not
+# allow G also cannot contain the tetrad base, and bulges can only be A or T.
+LOOP_EXCLUDES = {'G': ('N',), 'C': ('N',)}
+LOOP_NO_G_EXCLUDES = {'G': ('N', 'G'), 'C': ('N', 'C')}
+BULGE_EXCLUDES = ('N', 'G', 'C')
+
+# characters making up each run type when building a run index, with and
+# without soft masking. N runs are made of anything which is not ACGT.
+RUN_CHARS = {
+    False: {'G': b'Gg', 'C': b'Cc', 'N': b'ACGTacgt'},
+    True: {'G': b'G', 'C': b'C', 'N': b'ACGT'},
+}
+
+# version of the run index file format written by build_run_index
+RUN_INDEX_VERSION = 1
+
+# number of (tetrad, position) results iter_extend_matches remembers before
+# forgetting those behind the current start position
+EXTEND_MEMO_SIZE = 100000
+
+
+class RunTable(object):
+
+    '''
+    Table of maximal runs of G, C and invalid characters in one sequence.
+    Runs are found lazily, only for the run types and minimum lengths which
+    the patterns being matched actually need.
+    '''
+
+    def __init__(self, seq, soft_mask=False):
+        self.length = len(seq)
+        self._seq = seq
+        # if soft_mask is False, lower case bases are treated the same as
+        # upper case, otherwise they are treated as invalid.
+        self._flags = 0 if soft_mask else regex.IGNORECASE
+        self._runs = {}
+        self._barriers = {}
+
+    def runs(self, run_type, min_length=1):
+        '''
+        sorted lists of starts and ends of runs of run_type which are at
+        least min_length long
+        '''
+        key = (run_type, min_length)
+        if key not in self._runs:
+            self._runs[key] = self._find_runs(run_type, min_length)
+        return self._runs[key]
+
+    def _find_runs(self, run_type, min_length):
+        starts, ends = [], []
+        pattern = RUN_REGEX[run_type].format(min_length)
+        if not isinstance(self._seq, str):
+            # bytes-like sequence, e.g. a memoryview of a SharedSequence
+            pattern = pattern.encode()
+        for m in regex.finditer(pattern, self._seq, self._flags):
+            starts.append(m.start())
+            ends.append(m.end())
+        return starts, ends
+
+    def tetrad_starts(self, base, t):
+        '''
+        all positions where t or more of base start, in order.
+        '''
+        starts, ends = self.runs(base, t)
+        for start, end in zip(starts, ends):
+            for pos in range(start, end - t + 1):
+                yield pos
+
+    def is_tetrad(self, base, t, pos):
+        '''
+        True if there are at least t of base starting at pos.
+        '''
+        starts, ends = self.runs(base, t)
+        i = bisect_right(starts, pos) - 1
+        return i >= 0 and ends[i] >= pos + t
+
+    def tetrad_ends(self, base, t, first, last):
+        '''
+        all positions between first and last (inclusive) where t or more of
+        base end, in order.
+        '''
+        starts, ends = self.runs(base, t)
+        i = bisect_left(ends, first)
+        while i < len(ends) and starts[i] + t <= last:
+            for pos in range(max(first, starts[i] + t),
+                             min(last, ends[i]) + 1):
+                yield pos
+            i += 1
+
+    def barriers(self, run_types):
+        '''
+        sorted starts and ends of runs of any of run_types (which never
+        overlap, as each run type is made of different characters)
+        '''
+        if run_types not in self._barriers:
+            merged = sorted(
+                run for run_type in run_types
+                for run in zip(*self.runs(run_type)))
+            self._barriers[run_types] = (
+                [start for start, _ in merged], [end for _, end in merged])
+        return self._barriers[run_types]
+
+    def next_run(self, run_types, pos):
+        '''
+        first position at or after pos which is covered by a run of any of
+        run_types, or the sequence length if there is none.
+        '''
+        starts, ends = self.barriers(run_types)
+        i = bisect_right(ends, pos)
+        if i < len(ends):
+            return max(starts[i], pos)
+        return self.length
+
+    def prev_run_end(self, run_types, pos):
+        '''
+        end of the last run of any of run_types which starts before pos, or
+        zero if there is none. A gap ending at pos cannot start before this.
+        '''
+        starts, ends = self.barriers(run_types)
+        i = bisect_left(starts, pos) - 1
+        if i >= 0:
+            return ends[i]
+        return 0
+
+
+class IndexedRunTable(RunTable):
+
+    '''
+    RunTable for one contig of a RunIndex. Runs are read from (memory
+    mapped) arrays of run starts and lengths rather than from the sequence.
+    '''
+
+    def __init__(self, length, arrays, min_run):
+        self.length = length
+        self._arrays = arrays
+        self._min_run = min_run
+        self._runs = {}
+        self._barriers = {}
+
+    def _find_runs(self, run_type, min_length):
+        if run_type != 'N' and min_length < self._min_run:
+            raise ValueError(
+                'Run index only contains runs of at least {} bases but these '
+                'parameters need runs of {}, rebuild the index with '
+                '--min-run {}'.format(self._min_run, min_length, min_length))
+        starts, lengths = self._arrays[run_type]
+        if min_length > 1:
+            keep = lengths >= min_length
+            starts = starts[keep]
+            lengths = lengths[keep]
+        return starts.tolist(), (starts + lengths).tolist()
+
+
+def find_array_runs(seq_array, chars, invert=False):
+    '''
+    starts and lengths of maximal runs of any of chars in a uint8 array of a
+    sequence (or of anything but chars if invert is True)
+    '''
+    mask = np.isin(seq_array, np.frombuffer(chars, dtype=np.uint8),
+                   invert=invert)
+    edges = np.diff(mask.view(np.int8), prepend=np.int8(0),
+                    append=np.int8(0))
+    starts = np.flatnonzero(edges == 1)
+    ends = np.flatnonzero(edges == -1)
+    return starts, ends - starts
+
+
+def build_run_index(fasta_iter, fn, soft_mask=False, min_run=2):
+    '''
+    find G, C and N runs for every (seq_id, seq) in fasta_iter (str or ascii
+    bytes sequences) and save them to an uncompressed .npz file which
+    RunIndex can memory map. G and C runs shorter than min_run are not
+    stored (they are only needed for bulges, loops which do not allow G and
+    tetrads of one base) to keep the index compact. Returns the number of
+    contigs indexed.
+    '''
+    chars = RUN_CHARS[bool(soft_mask)]
+    names, lengths = [], []
+    runs = {run_type: ([], []) for run_type in 'GCN'}
+    for seq_id, seq in fasta_iter:
+        names.append(seq_id)
+        lengths.append(len(seq))
+        if isinstance(seq, str):
+            seq = seq.encode('ascii', 'replace')
+        seq_array = np.frombuffer(seq, dtype=np.uint8)
+        for run_type in 'GCN':
+            starts, run_lengths = find_array_runs(
+                seq_array, chars[run_type], invert=run_type == 'N')
+            if run_type != 'N' and min_run > 1:
+                keep = run_lengths >= min_run
+                starts = starts[keep]
+                run_lengths = run_lengths[keep]
+            runs[run_type][0].append(starts.astype(np.int64))
+            runs[run_type][1].append(run_lengths.astype(np.uint32))
+
+    arrays = dict(
+        version=np.array(RUN_INDEX_VERSION),
+        names=np.array(names, dtype=str),
+        lengths=np.array(lengths, dtype=np.int64),
+        soft_mask=np.array(bool(soft_mask)),
+        min_run=np.array(min_run),
+    )
+    for run_type, (starts, run_lengths) in runs.items():
+        # offsets[i]:offsets[i + 1] gives the runs for contig i
+        counts = [len(x) for x in starts]
+        arrays['{}_offsets'.format(run_type)] = np.concatenate(
+            [[0], np.cumsum(counts)]).astype(np.int64)
+        arrays['{}_starts'.format(run_type)] = np.concatenate(
+            starts or [np.empty(0, np.int64)])
+        arrays['{}_lengths'.format(run_type)] = np.concatenate(
+            run_lengths or [np.empty(0, np.uint32)])
+    np.savez(fn, **arrays)
+    return len(names)
+
+
+def _mmap_npz(fn):
+    '''
+    memory map each array in an uncompressed .npz file. Arrays are stored
+    as .npy files inside a zip archive, so can be mapped directly from their
+    offset in the archive.
+    '''
+    arrays = {}
+    with zipfile.ZipFile(fn) as z, open(fn, 'rb') as f:
+        for info in z.infolist():
+            name = info.filename[:-len('.npy')]
+            if info.compress_type != zipfile.ZIP_STORED:
+                arrays[name] = np.load(z.open(info))
+                continue
+            # skip the zip local file header to get to the .npy data
+            f.seek(info.header_offset)
+            header = f.read(30)
+            name_len, extra_len = struct.unpack('<HH', header[26:30])
+            f.seek(info.header_offset + 30 + name_len + extra_len)
+            version = np.lib.format.read_magic(f)
+            if version == (1, 0):
+                shape, fortran, dtype = np.lib.format.read_array_header_1_0(f)
+            else:
+                shape, fortran, dtype = np.lib.format.read_array_header_2_0(f)
+            if not np.prod(shape):
+                arrays[name] = np.empty(shape, dtype=dtype)
+            else:
+                arrays[name] = np.memmap(
+                    fn, dtype=dtype, mode='r', offset=f.tell(), shape=shape,
+                    order='F' if fortran else 'C')
+    return arrays
+
+
+class RunIndex(object):
+
+    '''
+    G, C and N runs for every contig in a fasta file, memory mapped from a
+    file written by build_run_index.
+    '''
+
+    def __init__(self, fn):
+        self._arrays = _mmap_npz(fn)
+        if int(self._arrays['version']) != RUN_INDEX_VERSION:
+            raise ValueError('{} is not a compatible run index'.format(fn))
+        self.names = [str(x) for x in self._arrays['names']]
+        self.lengths = self._arrays['lengths']
+        self.soft_mask = bool(self._arrays['soft_mask'])
+        self.min_run = int(self._arrays['min_run'])
+
+    def table(self, i):
+        '''
+        IndexedRunTable for the ith contig
+        '''
+        arrays = {}
+        for run_type in 'GCN':
+            offsets = self._arrays['{}_offsets'.format(run_type)]
+            start, end = offsets[i], offsets[i + 1]
+            arrays[run_type] = (
+                self._arrays['{}_starts'.format(run_type)][start:end],
+                self._arrays['{}_lengths'.format(run_type)][start:end])
+        return IndexedRunTable(int(self.lengths[i]), arrays, self.min_run)
+
+    def n_runs(self, i):
+        '''
+        total number of G and C runs stored for the ith contig
+        '''
+        n = 0
+        for run_type in 'GC':
+            offsets = self._arrays['{}_offsets'.format(run_type)]
+            n += int(offsets[i + 1] - offsets[i])
+        return n
+
+    def check_soft_mask(self, soft_mask):
+        '''
+        raise ValueError if the index was not built with the same soft
+        masking setting that will be used for prediction.
+        '''
+        if bool(soft_mask) != self.soft_mask:
+            raise ValueError(
+                'Run index was built {} soft masking, rebuild it with the '
+                'same --soft-mask setting used for prediction'.format(
+                    'with' if self.soft_mask else 'without'))
+
+    def check_min_run(self, min_run):
+        '''
+        raise ValueError if the index does not store the runs of min_run
+        bases that prediction needs (see G4Regex.min_table_run).
+        '''
+        if min_run < self.min_run:
+            raise ValueError(
+                'Run index only contains runs of at least {} bases but these '
+                'parameters need runs of {}, rebuild the index with '
+                '--min-run {}'.format(self.min_run, min_run, min_run))
+
+    def iter_tables(self, soft_mask=False):
+        '''
+        yield seq_id, IndexedRunTable for each contig in the index.
+        '''
+        self.check_soft_mask(soft_mask)
+        for i, seq_id in enumerate(self.names):
+            yield seq_id, self.table(i)
+
+
+class RunMatch(object):
+
+    '''
+    Match found by the run engine. Mimics the parts of the regex match
+    interface (spans and the pattern the match belongs to) which are used
+    to format bed records.
+    '''
+
+    __slots__ = ('re', '_spans')
+
+    def __init__(self, pattern, spans):
+        self.re = pattern
+        self._spans = spans
+
+    def span(self, group=0):
+        if group == 0:
+            return self._spans[0][0], self._spans[-1][1]
+        if not isinstance(group, int):
+            group = self.re.groupindex[group]
+        return self._spans[group - 1]
+
+    def start(self, group=0):
+        return self.span(group)[0]
+
+    def end(self, group=0):
+        return self.span(group)[1]
+
+
+def _gap_excludes(element, base):
+    '''
+    run types which cannot appear in a loop or bulge element
+    '''
+    if element[0] == 'btet':
+        return BULGE_EXCLUDES
+    elif element[4]:
+        return LOOP_EXCLUDES[base]
+    else:
+        return LOOP_NO_G_EXCLUDES[base]
+
+
+def _tetrads_ending_in(table, element, base, first, last):
+    '''
+    start positions of a tetrad (or bulged tetrad) element which ends
+    between first and last
+    '''
+    if element[0] == 'tet':
+        t = element[2]
+        for end in table.tetrad_ends(base, t, first, last):
+            yield end - t
+    else:
+        _, _, t1, t2, b_start, b_stop = element
+        for end in table.tetrad_ends(base, t2, first, last):
+            second = end - t2
+            bulge_first = max(second - b_stop,
+                              table.prev_run_end(BULGE_EXCLUDES, second))
+            for bulge_start in table.tetrad_ends(
+                    base, t1, bulge_first, second - b_start):
+                yield bulge_start - t1
+
+
+def _last_tetrad_starts(table, element, base):
+    '''
+    start positions of the last tetrad element, from whichever half of the
+    tetrad has the longest (and therefore least common) run.
+    '''
+    if element[0] == 'tet':
+        return table.tetrad_starts(base, element[2])
+    _, _, t1, t2, b_start, b_stop = element
+    if t2 >= t1:
+        return _tetrads_ending_in(table, element, base, 0, table.length)
+    starts = []
+    for pos in table.tetrad_starts(base, t1):
+        bulge_start = pos + t1
+        longest = min(b_stop, table.next_run(
+            BULGE_EXCLUDES, bulge_start) - bulge_start)
+        for l_bulge in range(b_start, longest + 1):
+            if table.is_tetrad(base, t2, bulge_start + l_bulge):
+                starts.append(pos)
+                break
+    return starts
+
+
+def _live_positions(table, spec, base):
+    '''
+    for each element of spec, the set of positions from which the rest of
+    the pattern (from that element onwards) can be matched. Sets are built
+    backwards from the last tetrad, so only positions close to runs which
+    could complete a G4 are ever visited. The entry after the last element
+    is None, meaning any position can end the pattern.
+    '''
+    # elements alternate tetrad, loop, tetrad ... tetrad
+    live = [None] * (len(spec) + 1)
+    live[-2] = set(_last_tetrad_starts(table, spec[-1], base))
+    for k in range(len(spec) - 3, -1, -2):
+        loop = spec[k + 1]
+        _, _, l_start, l_stop, _ = loop
+        excludes = _gap_excludes(loop, base)
+
+        # ranges of loop starts which reach a live tetrad, merged so that
+        # each position is only visited once
+        ranges = []
+        for q in sorted(live[k + 2]):
+            first = max(q - l_stop, table.prev_run_end(excludes, q), 0)
+            last = q - l_start
+            if first > last:
+                continue
+            if ranges and first <= ranges[-1][1] + 1:
+                ranges[-1][1] = max(ranges[-1][1], last)
+            else:
+                ranges.append([first, last])
+
+        loop_starts = set()
+        tetrad_starts = set()
+        for first, last in ranges:
+            loop_starts.update(range(first, last + 1))
+            tetrad_starts.update(
+                _tetrads_ending_in(table, spec[k], base, first, last))
+        live[k + 1] = loop_starts
+        live[k] = tetrad_starts
+    return live
+
+
+def iter_run_matches(table, spec, base):
+    '''
+    yield the group spans of each match of spec, one per start position, in
+    order of start position (i.e. the same as an overlapped regex search).
+
+    Lengths are tried in the same order as the regex module backtracks:
+    shortest first for lazy loops (which allow G) and longest first for
+    greedy loops and bulges. Because only lengths leading to positions from
+    which the rest of the pattern can be matched are accepted, the first
+    length tried which is accepted gives the same match the regex engine
+    finds, without any backtracking.
+    '''
+    live = _live_positions(table, spec, base)
+    for start in sorted(live[0]):
+        spans = []
+        pos = start
+        for k, element in enumerate(spec):
+            after = live[k + 1]
+            kind = element[0]
+            if kind == 'tet':
+                t = element[2]
+                spans.append((pos, pos + t))
+                pos += t
+
+            elif kind == 'btet':
+                _, _, t1, t2, b_start, b_stop = element
+                bulge_start = pos + t1
+                longest = min(b_stop, table.next_run(
+                    BULGE_EXCLUDES, bulge_start) - bulge_start)
+                # greedy bulge: longest first
+                for l_bulge in range(longest, b_start - 1, -1):
+                    q = bulge_start + l_bulge
+                    if table.is_tetrad(base, t2, q) and (
+                            after is None or q + t2 in after):
+                        break
+                spans.extend(((pos, bulge_start),
+                              (bulge_start, q),
+                              (q, q + t2)))
+                pos = q + t2
+
+            else:
+                _, _, l_start, l_stop, allow_G = element
+                longest = min(l_stop, table.next_run(
+                    _gap_excludes(element, base), pos) - pos)
+                if allow_G:
+                    # lazy loop: shortest first
+                    loop_lengths = range(l_start, longest + 1)
+                else:
+                    # greedy loop: longest first
+                    loop_lengths = range(longest, l_start - 1, -1)
+                for l_loop in loop_lengths:
+                    if pos + l_loop in after:
+                        break
+                spans.append((pos, pos + l_loop))
+                pos += l_loop
+        yield spans
+
+
+class SpecFamily(object):
+
+    '''
+    patterns of one strand which share a tetrad length and loop and bulge
+    limits, and only differ in which tetrads are bulged where (or, for
+    partial G4s, in how many tetrads they have). Each pattern is identified
+    by its comb: a tuple with one digit per tetrad, 0 for an unbulged
+    tetrad or the length of the first half of a bulged one.
+    '''
+
+    __slots__ = ('t', 'loops', 'bulge', 'run_length', 'patterns', 'ends',
+                 'extend', 'n_suffixes')
+
+    def __init__(self, t, loops, bulge):
+        self.t = t
+        self.loops = loops
+        # (start, stop) of bulges, or None if no pattern has one
+        self.bulge = bulge
+        # shortest runs of the tetrad base that tetrads are read from
+        self.run_length = t if bulge is None else 1
+        self.patterns = {}
+
+    def add(self, comb, i):
+        self.patterns[comb] = i
+
+    def finish(self):
+        '''
+        index the combs by the tetrad they start from. For the kth tetrad
+        with a given digit: ends[k] holds the digits which end a comb,
+        extend[k][digit] maps the suffixes of combs from the next tetrad to
+        the suffixes from the kth, and n_suffixes[k][digit] counts those.
+        '''
+        n_tetrads = max(len(comb) for comb in self.patterns)
+        self.ends = []
+        self.extend = []
+        self.n_suffixes = []
+        for k in range(n_tetrads):
+            suffixes = set(
+                comb[k:] for comb in self.patterns if len(comb) > k)
+            self.ends.append(set(s[0] for s in suffixes if len(s) == 1))
+            extend = {}
+            counts = {}
+            for suffix in suffixes:
+                digit = suffix[0]
+                counts[digit] = counts.get(digit, 0) + 1
+                if len(suffix) > 1:
+                    extend.setdefault(digit, {})[suffix[1:]] = suffix
+            self.extend.append(extend)
+            self.n_suffixes.append(counts)
+
+
+def spec_families(specs):
+    '''
+    group a list of pattern specs into SpecFamilies. Patterns without
+    bulges join a family with the same loops which has them, and patterns
+    whose loops are the first loops of a longer pattern (partial G4s with
+    fewer tetrads) join its family, so that each family is matched in one
+    pass.
+    '''
+    parsed = []
+    for i, spec in enumerate(specs):
+        comb = tuple(e[2] if e[0] == 'btet' else 0
+                     for e in spec if e[0] in ('tet', 'btet'))
+        t = spec[0][2] if spec[0][0] == 'tet' else spec[0][2] + spec[0][3]
+        loops = tuple(e for e in spec if e[0] == 'loop')
+        bulges = set(e[4:6] for e in spec if e[0] == 'btet')
+        bulge = bulges.pop() if bulges else None
+        parsed.append((i, comb, t, loops, bulge))
+
+    families = []
+    # longest patterns first, so that shorter ones can join them
+    for i, comb, t, loops, bulge in sorted(
+            parsed, key=lambda p: (-len(p[3]), p[4] is None)):
+        for family in families:
+            if family.t == t and family.loops[:len(loops)] == loops and (
+                    bulge is None or family.bulge == bulge):
+                break
+        else:
+            family = SpecFamily(t, loops, bulge)
+            families.append(family)
+        family.add(comb, i)
+    for family in families:
+        family.finish()
+    return families
+
+
+def iter_extend_matches(table, families, base, starts=None):
+    '''
+    yield start, {pattern index: group spans} for every start position
+    where any of the patterns in a list of SpecFamilies match, in order of
+    start position. Each pattern gets the same match an overlapped regex
+    search would find at that start.
+
+    G4s are extended one tetrad at a time through the runs of base. A bulge
+    can only be made of A and T, so the run containing a position decides
+    which tetrad starts there: the whole tetrad if the rest of the run is
+    long enough, otherwise a bulged tetrad whose first half is the rest of
+    the run, whose bulge is the following A/T run and whose second half
+    starts the next run. Bulges are placed once per run rather than once
+    per pattern. Loop lengths are tried in the order the regex module
+    tries them (see iter_run_matches), and the combs (see SpecFamily)
+    which can be completed from each (tetrad, position) are remembered
+    with the first way of completing each. So every tetrad and loop is
+    matched once however many bulge combinations the patterns allow, and
+    the cost grows with the run, loop and bulge lengths rather than with
+    the number of patterns. starts is an increasing iterable of positions
+    to try, by default every position where a first tetrad could start.
+    '''
+    runs = {}
+    for family in families:
+        runs[family.run_length] = table.runs(base, family.run_length)
+    bulge_starts, bulge_ends = table.barriers(BULGE_EXCLUDES)
+    length = table.length
+    loop_barriers = [
+        [(table.barriers(_gap_excludes(loop, base)), loop[2], loop[3],
+          loop[4])
+         for loop in family.loops]
+        for family in families]
+
+    def tetrad(family, pos):
+        # digit, group spans and end of the tetrad starting at pos
+        t = family.t
+        run_starts, run_ends = runs[family.run_length]
+        i = bisect_right(run_starts, pos) - 1
+        if i < 0 or run_ends[i] <= pos:
+            return None
+        r = run_ends[i] - pos
+        if r >= t:
+            return 0, ((pos, pos + t),), pos + t
+        if family.bulge is None:
+            return None
+        b_start, b_stop = family.bulge
+        bulge_start = pos + r
+        j = bisect_right(bulge_ends, bulge_start)
+        second = bulge_starts[j] if j < len(bulge_ends) else length
+        if not b_start <= second - bulge_start <= b_stop:
+            return None
+        # the bulge ends where the next run of base starts, or at another
+        # barrier which cannot be a tetrad
+        t2 = t - r
+        i += 1
+        if (i == len(run_starts) or run_starts[i] != second or
+                run_ends[i] < second + t2):
+            return None
+        return r, ((pos, bulge_start), (bulge_start, second),
+                   (second, second + t2)), second + t2
+
+    def solve(f, memo, k, pos):
+        # combs of the patterns of family f which can be completed from its
+        # kth tetrad at pos, each mapped to the end of the following loop
+        # (None after the last tetrad)
+        family = families[f]
+        found = {}
+        tetrads = family_tetrads[f]
+        step = tetrads.get(pos, False)
+        if step is False:
+            step = tetrads[pos] = tetrad(family, pos)
+        if step is not None:
+            digit, _, end = step
+            n_wanted = family.n_suffixes[k].get(digit, 0)
+            if digit in family.ends[k]:
+                found[(digit,)] = None
+            if len(found) < n_wanted:
+                extend = family.extend[k][digit]
+                barriers, l_start, l_stop, allow_G = loop_barriers[f][k]
+                starts, ends = barriers
+                j = bisect_right(ends, end)
+                longest = min(
+                    l_stop, (max(starts[j], end) if j < len(ends)
+                             else length) - end)
+                if allow_G:
+                    # lazy loop: shortest first
+                    loop_ends = range(end + l_start, end + longest + 1)
+                else:
+                    # greedy loop: longest first
+                    loop_ends = range(end + longest, end + l_start - 1, -1)
+                for loop_end in loop_ends:
+                    rest = memo.get((k + 1, loop_end))
+                    if rest is None:
+                        rest = solve(f, memo, k + 1, loop_end)
+                    if not rest:
+                        continue
+                    for comb in rest:
+                        comb = extend.get(comb)
+                        # first loop length which completes a comb wins,
+                        # as when the regex module backtracks
+                        if comb is not None and comb not in found:
+                            found[comb] = loop_end
+                    if len(found) == n_wanted:
+                        break
+        memo[k, pos] = found
+        if pos > furthest[0]:
+            furthest[0] = pos
+        return found
+
+    def spans(f, memo, pos, comb):
+        # group spans of the match of comb from pos
+        tetrads = family_tetrads[f]
+        all_spans = ()
+        for k in range(len(comb)):
+            _, tetrad_spans, end = tetrads[pos]
+            loop_end = memo[k, pos][comb[k:]]
+            all_spans += tetrad_spans
+            if loop_end is not None:
+                all_spans += ((end, loop_end),)
+            pos = loop_end
+        return all_spans
+
+    memos = [{} for _ in families]
+    # tetrads do not depend on which tetrad of a G4 they are, or on loops
+    tetrad_memos = {}
+    family_tetrads = [
+        tetrad_memos.setdefault((family.t, family.bulge), {})
+        for family in families]
+    # furthest position in the memos, starts after it cannot reach them
+    furthest = [-1]
+    if starts is None:
+        starts = table.tetrad_starts(
+            base, min(family.run_length for family in families))
+    memo_size = EXTEND_MEMO_SIZE
+    for start in starts:
+        if start > furthest[0]:
+            for memo in memos:
+                memo.clear()
+            for tetrads in tetrad_memos.values():
+                tetrads.clear()
+        elif sum(len(memo) for memo in memos) > memo_size:
+            # in long G rich regions, forget positions behind start
+            for memo in memos:
+                for key in [key for key in memo if key[1] < start]:
+                    del memo[key]
+            for tetrads in tetrad_memos.values():
+                for pos in [pos for pos in tetrads if pos < start]:
+                    del tetrads[pos]
+            memo_size = max(EXTEND_MEMO_SIZE,
+                            sum(len(memo) for memo in memos) * 2)
+        matches = {}
+        for f, memo in enumerate(memos):
+            found = memo.get((0, start))
+            if found is None:
+                found = solve(f, memo, 0, start)
+            patterns = families[f].patterns
+            for comb in found:
+                matches[patterns[comb]] = spans(f, memo, start, comb)
+        if matches:
+            yield start, matches
@@ -24,7 +24,8 @@ setup(
         'g4funcs',
     ],
     install_requires=[
-        'regex>=2016.3.2'
+        'regex>=2016.3.2',
+        'numpy>=1.17'
     ],
     test_suite='setup.test_suite'
 )
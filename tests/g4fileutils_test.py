@@ -1,6 +1,13 @@
 import sys
 import os
+import random
+import gzip
+import shutil
+import struct
 import unittest
+import zlib
+from tempfile import mkdtemp, mkstemp
+import numpy as np
 try:
     from StringIO import StringIO
 except ImportError:
@@ -14,6 +21,68 @@ sys.path.append(
 import g4funcs as g4
 
 
+def write_bgzf(fn, data, block_size=100):
+    '''
+    write data to a BGZF file in blocks of block_size bytes, with an empty
+    end of file block like bgzip
+    '''
+    with open(fn, 'wb') as f:
+        blocks = [data[i: i + block_size]
+                  for i in range(0, len(data), block_size)]
+        for block in blocks + [b'']:
+            compressor = zlib.compressobj(6, zlib.DEFLATED, -15)
+            cdata = compressor.compress(block) + compressor.flush()
+            f.write(b'\x1f\x8b\x08\x04\x00\x00\x00\x00\x00\xff'
+                    + struct.pack('<H', 6) + b'BC'
+                    + struct.pack('<HH', 2, len(cdata) + 25) + cdata
+                    + struct.pack('<II', zlib.crc32(block), len(block)))
+
+
+def find_blocks(seq, chars):
+    '''
+    starts and sizes of runs of chars in seq
+    '''
+    starts, sizes = [], []
+    for i, base in enumerate(seq):
+        if base in chars:
+            if starts and starts[-1] + sizes[-1] == i:
+                sizes[-1] += 1
+            else:
+                starts.append(i)
+                sizes.append(1)
+    return starts, sizes
+
+
+def write_twobit(fn, seqs, byte_order='<'):
+    '''
+    write (name, seq) pairs to a UCSC .2bit file
+    '''
+    records = []
+    for _, seq in seqs:
+        record = struct.pack(byte_order + 'I', len(seq))
+        for chars in ('Nn', 'acgtn'):
+            starts, sizes = find_blocks(seq, chars)
+            record += struct.pack(
+                '{}{}I'.format(byte_order, 1 + 2 * len(starts)),
+                len(starts), *(starts + sizes))
+        record += struct.pack(byte_order + 'I', 0)
+        codes = ['TCAG'.find(base) % 4 for base in seq.upper()]
+        codes += [0] * (-len(codes) % 4)
+        record += bytes(
+            codes[i] << 6 | codes[i + 1] << 4 | codes[i + 2] << 2
+            | codes[i + 3] for i in range(0, len(codes), 4))
+        records.append(record)
+    offset = 16 + sum(5 + len(name) for name, _ in seqs)
+    with open(fn, 'wb') as f:
+        f.write(struct.pack(byte_order + 'IIII', 0x1A412743, 0, len(seqs), 0))
+        for (name, _), record in zip(seqs, records):
+            f.write(struct.pack('B', len(name)) + name.encode()
+                    + struct.pack(byte_order + 'I', offset))
+            offset += len(record)
+        for record in records:
+            f.write(record)
+
+
 class TestParseFasta(unittest.TestCase):
 
     def setUp(self):
@@ -56,6 +125,431 @@ GATAGCTATCTACTATATCATTAATATATT
             next(fasta_iter)
 
 
+class TestStreamingFasta(unittest.TestCase):
+    '''
+    blocks can end anywhere, including in headers and between newlines
+    '''
+
+    def setUp(self):
+        random.seed(17)
+        self.seqs = [
+            ('chr{}'.format(i),
+             ''.join(random.choice('ACGTNacgt')
+                     for _ in range(random.randint(0, 300))))
+            for i in range(6)]
+        self.fasta = ''.join(
+            '>{} description\r\n{}\r\n'.format(
+                name, '\r\n'.join(seq[i: i + 17]
+                                   for i in range(0, len(seq), 17)))
+            for name, seq in self.seqs)
+
+    def test_parse_fasta(self):
+        for block_size in (1, 5, 64, g4.FASTA_BLOCK_SIZE):
+            f = g4.FastaReader(StringIO(self.fasta), block_size=block_size)
+            self.assertListEqual(list(f.parse_fasta()), self.seqs)
+
+    def test_decode_method(self):
+        # decode_method is still accepted, but ignored
+        with self.assertWarns(DeprecationWarning):
+            f = g4.FastaReader(StringIO(self.fasta), str)
+        self.assertListEqual(list(f.parse_fasta()), self.seqs)
+
+    def test_iter_chunks(self):
+        for block_size in (3, 64, g4.FASTA_BLOCK_SIZE):
+            for chunk_size, overlap in ((1, 0), (10, 7), (50, 33), (None, 5)):
+                expected = [
+                    (c.seq_id, c.offset, c.seq.encode(), c.n_owned)
+                    for name, seq in self.seqs
+                    for c in g4.iter_chunks(
+                        name, seq, chunk_size or g4.STREAM_CHUNK_SIZE,
+                        overlap)]
+                f = g4.FastaReader(StringIO(self.fasta), block_size=block_size)
+                self.assertListEqual(
+                    [tuple(c) for c in f.iter_chunks(chunk_size, overlap)],
+                    expected)
+
+
+class TestIndexedFasta(unittest.TestCase):
+
+    def setUp(self):
+        random.seed(13)
+        self.tmpdir = mkdtemp()
+        self.fn = os.path.join(self.tmpdir, 'test.fa')
+        self.seqs = [
+            ('chr1', ''.join(random.choice('ACGTNacgt') for _ in range(95))),
+            ('chr2 description', 'GGGAGGGAGGGAGGG'),
+            ('empty', ''),
+            ('chr:3', ''.join(random.choice('ACGT') for _ in range(40)))]
+        with open(self.fn, 'w') as f:
+            for name, seq in self.seqs:
+                f.write('>{}\n'.format(name))
+                for i in range(0, len(seq), 20):
+                    f.write(seq[i: i + 20] + '\n')
+
+    def tearDown(self):
+        shutil.rmtree(self.tmpdir)
+
+    def test_parse_fasta(self):
+        expected = [(name.split()[0], seq) for name, seq in self.seqs]
+        for _ in range(2):
+            # second time round the saved index is used
+            with g4.open_fasta(self.fn) as f:
+                self.assertIsInstance(f, g4.IndexedFastaReader)
+                self.assertListEqual(
+                    [(name, bytes(seq).decode())
+                     for name, seq in f.parse_fasta()],
+                    expected)
+            self.assertTrue(os.path.exists(self.fn + '.fai'))
+
+    def test_fetch(self):
+        seq = self.seqs[0][1]
+        with g4.IndexedFastaReader(self.fn) as f:
+            for _ in range(100):
+                start = random.randint(-5, 100)
+                end = random.randint(start, 105)
+                self.assertEqual(
+                    bytes(f.fetch('chr1', start, end)).decode(),
+                    seq[max(start, 0):end])
+            self.assertEqual(
+                bytes(f.fetch_region('chr1:21-40')), seq[20:40].encode())
+            self.assertEqual(
+                bytes(f.fetch_region('chr2')), b'GGGAGGGAGGGAGGG')
+            self.assertEqual(
+                bytes(f.fetch_region('chr:3:1-2')),
+                self.seqs[3][1][:2].encode())
+            self.assertEqual(bytes(f.fetch('empty')), b'')
+
+    def test_build_fai_pieces(self):
+        with open(self.fn, 'rb') as f:
+            data = f.read()
+        entries = g4.build_fai([data])
+        self.assertListEqual(
+            [(e.name, e.length) for e in entries],
+            [(name.split()[0], len(seq)) for name, seq in self.seqs])
+        for _ in range(20):
+            cuts = sorted(random.sample(range(len(data)), 10))
+            pieces = [data[i:j] for i, j in zip([0] + cuts, cuts + [None])]
+            self.assertListEqual(g4.build_fai(pieces), entries)
+
+    def test_irregular_lines(self):
+        with open(self.fn, 'a') as f:
+            f.write('>bad\nACGT\nACGTACGT\nA\n')
+        with self.assertRaises(IOError):
+            g4.IndexedFastaReader(self.fn)
+        # these are read with the streaming reader instead
+        with g4.open_fasta(self.fn) as f:
+            self.assertIsInstance(f, g4.FastaReader)
+            self.assertEqual(
+                list(f.parse_fasta())[-1], ('bad', 'ACGTACGTACGTA'))
+
+
+class TestRegions(unittest.TestCase):
+
+    def setUp(self):
+        random.seed(17)
+        self.tmpdir = mkdtemp()
+        self.fn = os.path.join(self.tmpdir, 'test.fa')
+        self.seqs = [
+            ('chr{}'.format(i),
+             ''.join(random.choice('ACGT') for _ in range(500)))
+            for i in range(3)]
+        with open(self.fn, 'w') as f:
+            for name, seq in self.seqs:
+                f.write('>{}\n'.format(name))
+                for i in range(0, len(seq), 60):
+                    f.write(seq[i: i + 60] + '\n')
+        self.bed_fn = os.path.join(self.tmpdir, 'regions.bed')
+        with open(self.bed_fn, 'w') as f:
+            f.write('track name=regions\n'
+                    '# comment\n'
+                    'chr2\t300\t350\tb\n'
+                    'chr0\t100\t200\ta\n'
+                    'chr0\t150\t250\ta\n'
+                    'chr2\t380\t400\tc\n'
+                    'chr2\t480\t600\td\n'
+                    'chrX\t0\t100\te\n')
+
+    def tearDown(self):
+        shutil.rmtree(self.tmpdir)
+
+    def test_region_set(self):
+        regions = g4.RegionSet.from_bed(self.bed_fn)
+        self.assertEqual(len(regions), 150 + 50 + 20 + 120 + 100)
+        self.assertIn('chr0', regions)
+        self.assertNotIn('chr1', regions)
+        self.assertListEqual(regions.intervals('chr0'), [(100, 250)])
+        self.assertListEqual(
+            regions.intervals('chr2'), [(300, 350), (380, 400), (480, 600)])
+        # padded intervals which overlap are merged, and clipped
+        self.assertListEqual(
+            regions.intervals('chr2', 20, 500), [(280, 420), (460, 500)])
+        self.assertListEqual(regions.intervals('chr0', 200), [(0, 450)])
+        self.assertListEqual(regions.intervals('chr1', 10), [])
+        self.assertTrue(regions.overlaps('chr2', 340, 380))
+        self.assertTrue(regions.overlaps('chr2', 399, 500))
+        self.assertFalse(regions.overlaps('chr2', 350, 380))
+        self.assertFalse(regions.overlaps('chr1', 0, 500))
+
+    def test_region_chunks(self):
+        regions = g4.RegionSet.from_bed(self.bed_fn)
+        seqs = dict(self.seqs)
+        expected = [('chr0', 90, 170), ('chr0', 170, 250),
+                    ('chr0', 250, 260), ('chr2', 290, 360),
+                    ('chr2', 370, 410), ('chr2', 470, 500)]
+        for reader in (g4.FastaReader, g4.IndexedFastaReader):
+            with reader(self.fn) as f:
+                chunks = list(f.iter_chunks(80, 10, regions))
+                self.assertListEqual(
+                    [(c.seq_id, c.offset, c.offset + c.n_owned)
+                     for c in chunks],
+                    expected)
+                for c in chunks:
+                    self.assertEqual(
+                        bytes(c.seq).decode(),
+                        seqs[c.seq_id][c.offset: c.offset + len(c.seq)])
+                self.assertEqual(len(chunks[0].seq), 90)
+            with reader(self.fn) as f:
+                self.assertListEqual(
+                    [(p.seq_id, p.offset, bytes(p.seq).decode())
+                     for p in f.parse_regions(regions, 10)],
+                    [(name, start, seqs[name][start:end])
+                     for name, start, end in [('chr0', 90, 260),
+                                              ('chr2', 290, 360),
+                                              ('chr2', 370, 410),
+                                              ('chr2', 470, 500)]])
+
+
+class TestBgzfFasta(unittest.TestCase):
+
+    def setUp(self):
+        random.seed(19)
+        self.tmpdir = mkdtemp()
+        self.fn = os.path.join(self.tmpdir, 'test.fa.gz')
+        self.seqs = [
+            ('chr{}'.format(i),
+             ''.join(random.choice('ACGTN')
+                     for _ in range(random.randint(0, 500))))
+            for i in range(5)]
+        self.data = ''.join(
+            '>{}\n{}\n'.format(
+                name, '\n'.join(seq[i: i + 30]
+                                for i in range(0, len(seq), 30)))
+            for name, seq in self.seqs).encode()
+        write_bgzf(self.fn, self.data)
+
+    def tearDown(self):
+        shutil.rmtree(self.tmpdir)
+
+    def test_bgzf_file(self):
+        with gzip.open(self.fn) as f:
+            self.assertEqual(f.read(), self.data)
+        for threads in (1, 3):
+            with g4.BgzfFile(self.fn, threads=threads) as f:
+                self.assertEqual(f.size, len(self.data))
+                for _ in range(100):
+                    first = random.randint(0, len(self.data))
+                    last = random.randint(first, len(self.data) + 10)
+                    self.assertEqual(f.read(first, last),
+                                     self.data[first:last])
+        # the saved .gzi index gives the same blocks
+        self.assertTrue(os.path.exists(self.fn + '.gzi'))
+        with g4.BgzfFile(self.fn) as f:
+            self.assertEqual(f.read(0, len(self.data)), self.data)
+
+    def test_bgzf_fasta(self):
+        for _ in range(2):
+            with g4.open_fasta(self.fn, threads=2) as f:
+                self.assertIsInstance(f, g4.BgzfFastaReader)
+                self.assertListEqual(
+                    [(name, bytes(seq).decode())
+                     for name, seq in f.parse_fasta()],
+                    self.seqs)
+                self.assertEqual(
+                    bytes(f.fetch('chr1', 25, 95)).decode(),
+                    self.seqs[1][1][25:95])
+
+    def test_plain_gzip(self):
+        fn = os.path.join(self.tmpdir, 'plain.fa.gz')
+        with gzip.open(fn, 'wb') as f:
+            f.write(self.data)
+        with g4.open_fasta(fn) as f:
+            self.assertIsInstance(f, g4.FastaReader)
+            self.assertListEqual(list(f.parse_fasta()), self.seqs)
+
+
+class TestTwoBit(unittest.TestCase):
+
+    def setUp(self):
+        random.seed(23)
+        self.tmpdir = mkdtemp()
+        self.fn = os.path.join(self.tmpdir, 'test.2bit')
+        self.seqs = [
+            ('chr{}'.format(i),
+             ''.join(random.choice('ACGTNNacgtn')
+                     for _ in range(random.randint(0, 500))))
+            for i in range(5)]
+
+    def tearDown(self):
+        shutil.rmtree(self.tmpdir)
+
+    def test_parse_fasta(self):
+        for byte_order in '<>':
+            write_twobit(self.fn, self.seqs, byte_order)
+            with g4.open_fasta(self.fn) as f:
+                self.assertIsInstance(f, g4.TwoBitReader)
+                self.assertListEqual(f.names, [x for x, _ in self.seqs])
+                self.assertListEqual(
+                    [(name, bytes(seq).decode())
+                     for name, seq in f.parse_fasta()],
+                    self.seqs)
+
+    def test_fetch(self):
+        write_twobit(self.fn, self.seqs)
+        with g4.TwoBitReader(self.fn) as f:
+            for name, seq in self.seqs:
+                for _ in range(50):
+                    start = random.randint(0, len(seq))
+                    end = random.randint(start, len(seq) + 10)
+                    self.assertEqual(bytes(f.fetch(name, start, end)),
+                                     seq[start:end].encode())
+                starts, sizes = f.n_blocks(name)
+                self.assertEqual(
+                    (starts.tolist(), sizes.tolist()),
+                    find_blocks(seq, 'Nn'))
+            self.assertEqual(bytes(f.fetch_region('chr2:11-20')),
+                             self.seqs[2][1][10:20].encode())
+
+    def test_iter_chunks(self):
+        write_twobit(self.fn, self.seqs)
+        with g4.TwoBitReader(self.fn) as f:
+            chunks = [(c.seq_id, c.offset, bytes(c.seq), c.n_owned)
+                      for c in f.iter_chunks(100, 20)]
+        expected = [(c.seq_id, c.offset, c.seq.encode(), c.n_owned)
+                    for name, seq in self.seqs
+                    for c in g4.iter_chunks(name, seq, 100, 20)]
+        self.assertListEqual(chunks, expected)
+
+    def test_n_gaps(self):
+        # long N blocks are not chunked, no G4 is lost around them
+        seq = ''.join(random.choice('GGGCCCAT') for _ in range(3000))
+        seq = seq[:1000] + 'N' * 1200 + seq[1000:2000] + 'n' * 999 + seq[2000:]
+        write_twobit(self.fn, [('chr1', seq)])
+        g4regex = g4.G4Regex(tetrad_kwargs=dict(start=2, stop=3))
+        with g4.TwoBitReader(self.fn) as f:
+            chunks = list(f.iter_chunks(500, g4regex.max_length))
+            self.assertListEqual(
+                [str(r) for c in chunks
+                 for r in g4regex.get_g4s_from_chunk(c)],
+                [str(r) for r in g4regex.get_g4s(seq, 'chr1')])
+            self.assertFalse(any(
+                c.offset < 2200 and c.offset + len(c.seq) > 1000
+                for c in chunks))
+            self.assertListEqual(
+                [(c.offset, len(c.seq)) for c in f.parse_regions()],
+                [(0, 1000), (2200, 2999)])
+
+    def test_not_twobit(self):
+        with open(self.fn, 'wb') as f:
+            f.write(b'>chr1\nACGT\n')
+        with self.assertRaises(IOError):
+            g4.TwoBitReader(self.fn)
+
+
+class TestIterChunks(unittest.TestCase):
+
+    def test_iter_chunks(self):
+        seq = 'ACGTACGTAC'
+        self.assertListEqual(
+            list(g4.iter_chunks('1', seq, 4, 2)),
+            [('1', 0, 'ACGTAC', 4), ('1', 4, 'ACGTAC', 4),
+             ('1', 8, 'AC', 2)])
+        # short sequences and no chunk size give one chunk
+        self.assertListEqual(
+            list(g4.iter_chunks('1', seq, 8, 2)), [('1', 0, seq, 10)])
+        self.assertListEqual(
+            list(g4.iter_chunks('1', seq)), [('1', 0, seq, 10)])
+        with self.assertRaises(ValueError):
+            list(g4.iter_chunks('1', seq, 0))
+
+
+class TestSharedSequence(unittest.TestCase):
+
+    def test_shared_sequence(self):
+        seq = 'ACGTACGTAC'
+        with g4.SharedSequence('1', seq) as shared:
+            attached = g4.SharedSequence('1', name=shared.name, length=10)
+            chunks = [attached.chunk(*span)
+                      for span in g4.chunk_spans(len(attached), 4, 2)]
+            self.assertListEqual(
+                [(c.seq_id, c.offset, bytes(c.seq), c.n_owned)
+                 for c in chunks],
+                [('1', 0, b'ACGTAC', 4), ('1', 4, b'ACGTAC', 4),
+                 ('1', 8, b'AC', 2)])
+            for c in chunks:
+                c.seq.release()
+            attached.close()
+        # the owner frees the memory on close
+        with self.assertRaises(FileNotFoundError):
+            g4.SharedSequence('1', name=shared.name, length=10)
+
+    def test_empty_sequence(self):
+        with g4.SharedSequence('1', '') as shared:
+            self.assertEqual(len(shared), 0)
+            self.assertEqual(bytes(shared.chunk(0, 0, 0).seq), b'')
+
+
+class TestG4Record(unittest.TestCase):
+
+    def test_format_and_parse(self):
+        bed12 = ('1\t10\t30\t3t0b1,2,3l\t34.0\t+\t10\t30\t85,118,209'
+                 '\t4\t3,3,3,3\t0,4,9,17')
+        record = g4.G4Record.from_bed(bed12)
+        self.assertEqual(record.block_starts, (0, 4, 9, 17))
+        self.assertEqual(str(record), bed12)
+        bed6 = '\t'.join(bed12.split('\t')[:6])
+        self.assertEqual(str(g4.G4Record.from_bed(bed6)), bed6)
+        self.assertEqual(record.to_bed6(), bed6)
+
+
+class TestBedColumns(unittest.TestCase):
+
+    def setUp(self):
+        self.lines = (
+            b'chr1\t10\t30\t3t0b1,2,3l\t34\t+\t10\t30\t85,118,209'
+            b'\t4\t3,3,3,3\t0,4,9,17\n'
+            b'chr1\t12\t40\ttest\t-2.5\t-\n'
+            b'chr10\t5\t25\ttest\t1e2\t+')
+
+    def test_columns(self):
+        cols = g4.BedColumns(b'track name=test\n# comment\n\n' + self.lines)
+        self.assertEqual(len(cols), 3)
+        self.assertListEqual(cols.chrom.tolist(), [b'chr1', b'chr1', b'chr10'])
+        self.assertListEqual(cols.start.tolist(), [10, 12, 5])
+        self.assertListEqual(cols.end.tolist(), [30, 40, 25])
+        self.assertListEqual(cols.score.tolist(), [34.0, -2.5, 100.0])
+        self.assertListEqual(cols.strand.tolist(), [b'+', b'-', b'+'])
+        # lines are copied unchanged
+        lines = self.lines.split(b'\n')
+        self.assertEqual(cols.lines(np.array([0, 2])),
+                         lines[0] + b'\n' + lines[2] + b'\n')
+        self.assertEqual(cols.tail(1), b'\n'.join(lines[1:]) + b'\n')
+        self.assertEqual(len(g4.BedColumns(b'')), 0)
+        with self.assertRaises(ValueError):
+            g4.BedColumns(b'chr1\t10\t30\n')
+
+    def test_line_blocks(self):
+        fd, fn = mkstemp(suffix='.bed')
+        with os.fdopen(fd, 'wb') as f:
+            f.write(self.lines)
+        try:
+            with g4.BedReader(fn, block_size=7) as bed:
+                blocks = list(bed.iter_line_blocks())
+        finally:
+            os.remove(fn)
+        self.assertEqual(b''.join(blocks), self.lines)
+        self.assertTrue(all(b.endswith(b'\n') for b in blocks[:-1]))
+
+
 class TestSortBed(unittest.TestCase):
 
     def setUp(self):
@@ -85,3 +579,57 @@ class TestSortBed(unittest.TestCase):
     def test_sort_bed(self):
         sorted_output = list(g4.sort_bed_file(self.unsorted_bed_fn))
         self.assertEqual(sorted_output, self.sorted_bed)
+
+
+class TestSortRecords(unittest.TestCase):
+
+    def setUp(self):
+        random.seed(29)
+        self.tmpdir = mkdtemp()
+        self.records = [
+            g4.G4Record('chr{}'.format(random.choice('21X')),
+                        random.randint(0, 1000), 0, 'test{}'.format(i),
+                        float(random.randint(0, 50)), random.choice('+-'),
+                        (), ())
+            for i in range(1000)]
+        # contigs in order of first appearance, ties in input order
+        ranks = {}
+        for r in self.records:
+            ranks.setdefault(r.chrom, len(ranks))
+        self.sorted_records = [
+            str(r) for r in sorted(
+                self.records, key=lambda r: (ranks[r.chrom], r.start))]
+
+    def tearDown(self):
+        shutil.rmtree(self.tmpdir)
+
+    def test_sort_records(self):
+        for memory in (g4.SORT_MEMORY, 10000, 1):
+            self.assertListEqual(
+                list(g4.sort_records(iter(self.records), memory,
+                                     self.tmpdir)),
+                self.sorted_records)
+            self.assertListEqual(os.listdir(self.tmpdir), [])
+        # bed lines are sorted the same way
+        self.assertListEqual(
+            list(g4.sort_records(
+                ('{}\n'.format(r) for r in self.records), 10000,
+                self.tmpdir)),
+            self.sorted_records)
+
+    def test_cleanup(self):
+        sorted_records = g4.sort_records(
+            iter(self.records), 10000, self.tmpdir)
+        next(sorted_records)
+        self.assertEqual(len(os.listdir(self.tmpdir)), 1)
+        sorted_records.close()
+        self.assertListEqual(os.listdir(self.tmpdir), [])
+
+        def failing():
+            for record in self.records:
+                yield record
+            raise ValueError('bad record')
+
+        with self.assertRaises(ValueError):
+            list(g4.sort_records(failing(), 10000, self.tmpdir))
+        self.assertListEqual(os.listdir(self.tmpdir), [])
@@ -1,6 +1,8 @@
 import sys
 import os
+import random
 import unittest
+from tempfile import mkstemp
 try:
     from StringIO import StringIO
 except ImportError:
@@ -55,6 +57,15 @@ class TestClusterOverlapping(unittest.TestCase):
             two_clusters_diff_chromosome += 1
         self.assertEqual(two_clusters_diff_chromosome, 2)
 
+    def test_cluster_records(self):
+        # lines are parsed to G4Records, which are clustered unchanged
+        records = [g4.G4Record.from_bed(line)
+                   for line in self.two_clusters_opposite_strand]
+        self.assertEqual(records[0].start, 0)
+        self.assertEqual(records[0].score, 0.0)
+        clusters = list(g4.cluster_overlapping(iter(records)))
+        self.assertListEqual(clusters, [records[:2], records[2:]])
+
 
 class TestOverlapMethod(object):
     '''
@@ -62,23 +73,23 @@ class TestOverlapMethod(object):
     '''
 
     one_record_cluster = [
-        ['1', 1, 100, 'test', 40, '+']
+        g4.G4Record('1', 1, 100, 'test', 40, '+', (), ())
     ]
     two_record_cluster = [
-        ['1', 0, 100, 'test', 40, '+'],
-        ['1', 50, 150, 'test', 30, '+']
+        g4.G4Record('1', 0, 100, 'test', 40, '+', (), ()),
+        g4.G4Record('1', 50, 150, 'test', 30, '+', (), ())
     ]
     three_record_cluster = [
-        ['1', 0, 100, 'test', 40, '+'],
-        ['1', 50, 150, 'test', 30, '+'],
-        ['1', 120, 160, 'test', 20, '+']
+        g4.G4Record('1', 0, 100, 'test', 40, '+', (), ()),
+        g4.G4Record('1', 50, 150, 'test', 30, '+', (), ()),
+        g4.G4Record('1', 120, 160, 'test', 20, '+', (), ())
     ]
     five_record_cluster = [
-        ['1', 0, 100, 'test', 40, '+'],
-        ['1', 50, 150, 'test', 30, '+'],
-        ['1', 120, 160, 'test', 20, '+'],
-        ['1', 155, 200, 'test', 20, '+'],
-        ['1', 165, 300, 'test', 50, '+']
+        g4.G4Record('1', 0, 100, 'test', 40, '+', (), ()),
+        g4.G4Record('1', 50, 150, 'test', 30, '+', (), ()),
+        g4.G4Record('1', 120, 160, 'test', 20, '+', (), ()),
+        g4.G4Record('1', 155, 200, 'test', 20, '+', (), ()),
+        g4.G4Record('1', 165, 300, 'test', 50, '+', (), ())
     ]
 
     def test_filter_method(self):
@@ -86,16 +97,19 @@ class TestOverlapMethod(object):
         def sort_bed_key(record):
             return int(record.split()[1])
 
-        self.assertListEqual(sorted(self.method(self.one_record_cluster),
+        def method(cluster):
+            return [str(r) for r in self.method(cluster)]
+
+        self.assertListEqual(sorted(method(self.one_record_cluster),
                                     key=sort_bed_key),
                              self.one_record_cluster_output)
-        self.assertListEqual(sorted(self.method(self.two_record_cluster),
+        self.assertListEqual(sorted(method(self.two_record_cluster),
                                     key=sort_bed_key),
                              self.two_record_cluster_output)
-        self.assertListEqual(sorted(self.method(self.three_record_cluster),
+        self.assertListEqual(sorted(method(self.three_record_cluster),
                                     key=sort_bed_key),
                              self.three_record_cluster_output)
-        self.assertListEqual(sorted(self.method(self.five_record_cluster),
+        self.assertListEqual(sorted(method(self.five_record_cluster),
                                     key=sort_bed_key),
                              self.five_record_cluster_output)
 
@@ -123,5 +137,138 @@ class TestMergeOverlapping(TestOverlapMethod, unittest.TestCase):
         self.five_record_cluster_output = ['1\t0\t300\tPG4_cluster\t5\t+']
 
 
+class TestApplyFilterMethod(unittest.TestCase):
+    '''
+    filtering a sorted stream of records should give the same records as
+    filtering each cluster and then sorting, already in sorted order
+    '''
+
+    def setUp(self):
+        random.seed(31)
+        g4regex = g4.G4Regex(tetrad_kwargs=dict(start=2, stop=3))
+        self.records = [
+            r for i in range(3)
+            for r in g4regex.get_g4s(
+                ''.join(random.choice('GGGCCCAT') for _ in range(1000)),
+                'chr{}'.format(i))]
+
+    def test_apply_filter_method(self):
+        for method in (g4.filter_overlapping, g4.merge_overlapping):
+            expected = list(g4.sort_records(
+                r for cluster in g4.cluster_overlapping(iter(self.records))
+                for r in method(cluster)))
+            filtered = [str(r) for r in g4.apply_filter_method(
+                iter(self.records), method)]
+            self.assertListEqual(filtered, expected)
+            # bed lines are parsed first
+            self.assertListEqual(
+                [str(r) for r in g4.apply_filter_method(
+                    (str(r) for r in self.records), method)],
+                expected)
+
+
+class TestTopScoring(unittest.TestCase):
+
+    def test_top_scoring(self):
+        records = [g4.G4Record('1', i, i + 20, 'test', score, '+', (), ())
+                   for i, score in enumerate([30, 50, 40, 50, 20, 40])]
+        self.assertListEqual(
+            g4.top_scoring(iter(records), 3),
+            [records[1], records[2], records[3]])
+        self.assertListEqual(g4.top_scoring(iter(records), 10), records)
+        self.assertListEqual(g4.top_scoring(iter([]), 3), [])
+
+
+class TestFilterOverlappingArrays(unittest.TestCase):
+    '''
+    the numpy paths should choose exactly the same records as the pure
+    python one, including between equal scoring records
+    '''
+
+    def setUp(self):
+        random.seed(32)
+        self.g4regex = g4.G4Regex(tetrad_kwargs=dict(start=2, stop=3))
+        self.seq = ''.join(random.choice('GGGCCCAT') for _ in range(3000))
+
+    def test_large_clusters(self):
+        clusters = list(g4.cluster_overlapping(
+            iter(self.g4regex.get_g4s(self.seq, 'test'))))
+        expected = [g4.filter_overlapping(c) for c in clusters]
+        array_size = g4.g4filter.FILTER_ARRAY_SIZE
+        g4.g4filter.FILTER_ARRAY_SIZE = 3
+        try:
+            self.assertListEqual(
+                [g4.filter_overlapping(c) for c in clusters], expected)
+        finally:
+            g4.g4filter.FILTER_ARRAY_SIZE = array_size
+
+    def test_filter_overlapping_array(self):
+        expected = sorted(
+            (r.start, r.end, r.strand) for r in g4.apply_filter_method(
+                self.g4regex.get_g4s(self.seq, 'test'),
+                g4.filter_overlapping))
+        g4s = g4.filter_overlapping_array(
+            self.g4regex.get_g4s_as_arrays(self.seq))
+        self.assertListEqual(
+            sorted(zip(g4s['start'].tolist(), g4s['end'].tolist(),
+                       g4s['strand'].tolist())),
+            expected)
+        # rows keep their original order
+        self.assertTrue((g4s['start'][1:] >= g4s['start'][:-1]).all())
+        empty = self.g4regex.get_g4s_as_arrays('ATATAT')
+        self.assertEqual(len(g4.filter_overlapping_array(empty)), 0)
+
+
+class TestFilterBed(unittest.TestCase):
+    '''
+    filtering a bed file in blocks should keep the same lines as
+    apply_filter_method, copied from the file unchanged
+    '''
+
+    def setUp(self):
+        random.seed(33)
+        g4regex = g4.G4Regex(tetrad_kwargs=dict(start=2, stop=3))
+        self.records = [
+            r for i in range(3)
+            for r in g4regex.get_g4s(
+                ''.join(random.choice('GGGCCCAT') for _ in range(1000)),
+                'chr{}'.format(i), use_bed12=i != 1)]
+        fd, self.fn = mkstemp(suffix='.bed')
+        with os.fdopen(fd, 'w') as f:
+            f.write('track name=test\n')
+            for r in self.records:
+                f.write('{}\n'.format(r))
+
+    def tearDown(self):
+        os.remove(self.fn)
+
+    def test_filter_bed(self):
+        for method in (g4.filter_overlapping, g4.merge_overlapping):
+            expected = [str(r) for r in g4.apply_filter_method(
+                iter(self.records), method)]
+            for block_size in (g4.BED_BLOCK_SIZE, 2000, 1):
+                filtered = '\n'.join(
+                    g4.filter_bed(self.fn, method, block_size))
+                self.assertListEqual(filtered.split('\n'), expected)
+        with self.assertRaises(ValueError):
+            next(g4.filter_bed(self.fn, g4.join_records))
+
+    def test_filter_unsorted_bed(self):
+        # shuffled records are sorted (spilling to disk) before filtering,
+        # contigs are sorted in the order they first appear
+        shuffled = self.records[:]
+        random.shuffle(shuffled)
+        with open(self.fn, 'w') as f:
+            for r in shuffled:
+                f.write('{}\n'.format(r))
+        for method in (g4.filter_overlapping, g4.merge_overlapping):
+            expected = [str(r) for r in g4.apply_filter_method(
+                iter(self.records), method)]
+            filtered = '\n'.join(g4.filter_bed(
+                g4.sort_bed_file(self.fn, memory=10000), method, 2000))
+            self.assertListEqual(sorted(filtered.split('\n')),
+                                 sorted(expected))
+
+
 if __name__ == '__main__':
     unittest.main()
@@ -0,0 +1,132 @@
+import sys
+import os
+import random
+import unittest
+from multiprocessing.pool import ThreadPool
+from tempfile import mkstemp
+
+sys.path.append(
+    os.path.abspath(os.path.dirname(
+            os.path.dirname(
+                __file__))))
+
+import g4funcs as g4
+from g4funcs.g4parallel import _imap_scheduled
+
+
+class TestParallel(unittest.TestCase):
+    '''
+    parallel prediction should give the same records, in the same order, as
+    serial prediction with the same chunk size
+    '''
+
+    def setUp(self):
+        random.seed(3)
+        self.seqs = [
+            ('chr{}'.format(i),
+             ''.join(random.choice('GGGGCCCCATN')
+                     for _ in range(random.randint(100, 2000))))
+            for i in range(5)]
+        self.g4regex = g4.G4Regex(
+            bulge_kwargs=dict(bulges_allowed=1, start=1, stop=3))
+
+    def test_parallel_g4s_as_bed(self):
+        for chunk_size in (None, 250):
+            serial = [
+                r for seq_id, seq in self.seqs
+                for r in self.g4regex.get_g4s(
+                    seq, seq_id, chunk_size=chunk_size)]
+            self.assertListEqual(
+                list(g4.parallel_g4s_as_bed(
+                    self.g4regex, iter(self.seqs), 3, chunk_size=chunk_size)),
+                serial)
+
+    def test_threaded_g4s_as_bed(self):
+        for engine in ('regex', 'combined'):
+            g4regex = g4.G4Regex(
+                engine=engine,
+                bulge_kwargs=dict(bulges_allowed=1, start=1, stop=3))
+            for chunk_size in (None, 250):
+                serial = [
+                    r for seq_id, seq in self.seqs
+                    for r in g4regex.get_g4s(
+                        seq, seq_id, chunk_size=chunk_size)]
+                self.assertListEqual(
+                    list(g4.threaded_g4s_as_bed(
+                        g4regex, iter(self.seqs), 3, chunk_size=chunk_size)),
+                    serial)
+
+    def test_regions(self):
+        # pieces of sequences are reported in whole sequence coordinates
+        regions = g4.RegionSet(
+            [('chr0', 10, 60), ('chr1', 0, 40), ('chr1', 70, 500),
+             ('chr3', 900, 5000)])
+        pieces = [
+            g4.SeqChunk(seq_id, start, seq[start:end], end - start)
+            for seq_id, seq in self.seqs
+            for start, end in regions.intervals(
+                seq_id, self.g4regex.max_length, len(seq))]
+        serial = [
+            r for piece in pieces
+            for chunk in g4.iter_chunks(
+                piece.seq_id, piece.seq, 100, self.g4regex.max_length,
+                piece.offset)
+            for r in self.g4regex.get_g4s_from_chunk(chunk)]
+        self.assertTrue(serial)
+        for func in (g4.parallel_g4s_as_bed, g4.threaded_g4s_as_bed):
+            self.assertListEqual(
+                list(func(self.g4regex, iter(pieces), 3, chunk_size=100)),
+                serial)
+        # and are the same records as for the whole sequences
+        whole = [r for seq_id, seq in self.seqs
+                 for r in self.g4regex.get_g4s(seq, seq_id)]
+        self.assertListEqual(
+            sorted(r for r in serial
+                   if regions.overlaps(r.chrom, r.start, r.end)),
+            sorted(r for r in whole
+                   if regions.overlaps(r.chrom, r.start, r.end)))
+
+    def test_parallel_g4s_from_index(self):
+        fd, fn = mkstemp(suffix='.npz')
+        os.close(fd)
+        try:
+            g4.build_run_index(self.seqs, fn, min_run=1)
+            serial = [
+                r for seq_id, seq in self.seqs
+                for r in self.g4regex.get_g4s(seq, seq_id)]
+            self.assertListEqual(
+                list(g4.parallel_g4s_from_index(self.g4regex, fn, 3)),
+                serial)
+        finally:
+            os.remove(fn)
+
+
+class TestScheduler(unittest.TestCase):
+
+    def test_chunk_costs(self):
+        seq = 'GGGGAAAAAACCCAAAAAAAAAAGGaaaGGG'
+        spans = [(0, 15, 10), (10, 15, 10), (20, 11, 11)]
+        # GGGG has two tetrad positions, CCC and GGG one each
+        self.assertListEqual(
+            g4.chunk_costs(seq, spans, 3),
+            [10 + 2 * g4.TETRAD_COST, 10 + g4.TETRAD_COST,
+             11 + g4.TETRAD_COST])
+        self.assertListEqual(
+            g4.chunk_costs(seq.encode(), spans, 4),
+            [10 + g4.TETRAD_COST, 10, 11])
+
+    def test_scheduled_order(self):
+        submitted = []
+
+        def func(task):
+            submitted.append(task)
+            return task * 2
+
+        tasks = [(cost, i) for i, cost in enumerate([1, 5, 3, 9, 2, 7])]
+        usage = g4.WorkerUsage(1)
+        with ThreadPool(1) as pool:
+            results = list(_imap_scheduled(pool, func, tasks, 6, 6, usage))
+        # results come back in task order, tasks run most costly first
+        self.assertListEqual(results, [(i, i * 2) for i in range(6)])
+        self.assertListEqual(submitted, [0, 3, 5, 1, 2, 4])
+        self.assertEqual(len(usage.utilisation()), 1)
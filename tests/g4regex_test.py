@@ -1,5 +1,7 @@
 import sys
 import os
+import pickle
+import random
 import unittest
 import regex
 
@@ -169,16 +171,17 @@ class TestG4RegexTwoOrThreeTetrad(TestG4Regex, unittest.TestCase):
             ['AAGGACTGGATGGTTTGGTTT',
              ['test\t2\t18\t2t0b3,2,3l\t28.0\t+\t2\t'
               '18\t85,118,209\t4\t2,2,2,2\t0,5,9,14']],
-            # matches one 3 tetrad and two 2 tetrad quadruplexes
+            # matches one 3 tetrad and two 2 tetrad quadruplexes, ordered
+            # by start position then pattern
             ['AAGGGACTGGGATGGGTTTGGGTTT',
              ['test\t2\t21\t2t0b4,3,4l\t23.5\t+\t2\t'
               '21\t85,118,209\t4\t2,2,2,2\t0,6,11,17',
 
-              'test\t3\t21\t2t0b3,3,4l\t25.0\t+\t3\t'
-              '21\t85,118,209\t4\t2,2,2,2\t0,5,10,16',
-
               'test\t2\t22\t3t0b3,2,3l\t48.0\t+\t2\t'
-              '22\t85,118,209\t4\t3,3,3,3\t0,6,11,17']]
+              '22\t85,118,209\t4\t3,3,3,3\t0,6,11,17',
+
+              'test\t3\t21\t2t0b3,3,4l\t25.0\t+\t3\t'
+              '21\t85,118,209\t4\t2,2,2,2\t0,5,10,16']]
         ]
         self.patterns_bed6 = [
             [seq, ['\t'.join(r.split()[:6]) for r in records]]
@@ -336,16 +339,392 @@ class TestG4RegexIntermolecular(TestG4Regex, unittest.TestCase):
             # loops are too long here, should not match anything
             ['AAGGGACAAATTTTGGGATGGTTT',
              []],
-            # should match multiple overlapping
+            # should match multiple overlapping, ordered by start position
             ['AAGGGACTGGGATGGGTTT',
              ['test\t2\t11\tPG4_3t_2\t55.5\t+\t2\t'
               '11\t85,118,209\t2\t3,3\t0,6',
-              'test\t8\t16\tPG4_3t_2\t57.0\t+\t8\t'
-              '16\t85,118,209\t2\t3,3\t0,5',
               'test\t2\t16\tPG4_3t_3\t52.5\t+\t2\t'
-              '16\t85,118,209\t3\t3,3,3\t0,6,11']]
+              '16\t85,118,209\t3\t3,3,3\t0,6,11',
+              'test\t8\t16\tPG4_3t_2\t57.0\t+\t8\t'
+              '16\t85,118,209\t2\t3,3\t0,5']]
         ]
         self.patterns_bed6 = [
             [seq, ['\t'.join(r.split()[:6]) for r in records]]
             for seq, records in self.patterns_bed12
         ]
+
+
+class TestG4PatternSet(unittest.TestCase):
+
+    def setUp(self):
+        self.test_params = dict(
+            bulge_kwargs=dict(bulges_allowed=1, start=1, stop=5)
+        )
+        self.g4regex = g4.G4Regex(**self.test_params)
+        self.seq = 'AAGGAGACTTGGGATGGGTTTGGGTTTCCCACCCTACCCAACCC'
+
+    def test_patterns_compiled_once(self):
+        other = g4.G4Regex(**self.test_params)
+        for strand in '+-':
+            self.assertEqual(len(self.g4regex._patterns[strand]),
+                             len(self.g4regex._regex[strand]))
+            self.assertIs(self.g4regex._patterns[strand],
+                          other._patterns[strand])
+
+    def test_binary_sequence(self):
+        for engine in g4.ENGINES:
+            g4regex = g4.G4Regex(engine=engine, **self.test_params)
+            self.assertListEqual(
+                list(g4regex.get_g4s_as_bed(
+                    memoryview(self.seq.encode()), seq_id='test')),
+                list(g4regex.get_g4s_as_bed(self.seq, seq_id='test')))
+
+    def test_pickle(self):
+        unpickled = pickle.loads(pickle.dumps(self.g4regex))
+        self.assertListEqual(
+            list(unpickled.get_g4s_as_bed(self.seq, seq_id='test')),
+            list(self.g4regex.get_g4s_as_bed(self.seq, seq_id='test')))
+        self.assertIs(unpickled._patterns['+'], self.g4regex._patterns['+'])
+
+
+class TestPatternInfo(unittest.TestCase):
+    '''
+    names and scores worked out once per pattern should be the same as
+    working them out from the group lengths of each match
+    '''
+
+    def setUp(self):
+        random.seed(36)
+        # G4s on both strands
+        self.seqs = [
+            ''.join(random.choice(alphabet) for _ in range(300))
+            for alphabet in ('GGGAT', 'CCCAT') for _ in range(3)]
+
+    @staticmethod
+    def match_name_and_score(g4regex, match, partial=False):
+        gl = {k: match.end(k) - match.start(k) for k in match.re.groupindex}
+        score_params = g4regex._params['score_kwargs']
+        if partial:
+            n_tetrad = sum(k.startswith('tet') for k in gl)
+            l_tetrad = gl['tet0']
+            name = 'PG4_{}t_{}'.format(l_tetrad, n_tetrad)
+            bulge_pos = set()
+        else:
+            n_tetrad = 4
+            tetrads = [v for k, v in gl.items() if k.startswith('tet')]
+            # both halves of the first tetrad if every tetrad is bulged
+            l_tetrad = tetrads[0] if tetrads else (
+                gl['btet0_1'] + gl['btet0_2'])
+            bulge_pos = set(k[4] for k in gl if k.startswith('btet'))
+            name = '{}t{}b{}l'.format(
+                l_tetrad, sum(2 ** int(f) for f in bulge_pos),
+                ','.join(str(gl['loop{}'.format(x)]) for x in (0, 1, 2)))
+        length = match.end(0) - match.start(0)
+        score = (score_params['tetrad_score_factor'] * l_tetrad -
+                 score_params['loop_pen_factor'] * (
+                     length - l_tetrad * n_tetrad) -
+                 score_params['bulge_pen_factor'] * len(bulge_pos))
+        return name, score
+
+    def check_records(self, g4regex, partial=False):
+        names = set()
+        for seq in self.seqs:
+            for strand, m in g4regex._iter_matches(seq):
+                record = g4regex._make_record(m, 'test', strand)
+                self.assertEqual(
+                    (record.name, record.score),
+                    self.match_name_and_score(g4regex, m, partial))
+                names.add(record.name)
+        return names
+
+    def test_every_tetrad_bulged(self):
+        g4regex = g4.G4Regex(
+            bulge_kwargs=dict(bulges_allowed=4, start=1, stop=3),
+            score_kwargs=dict(bulge_pen_factor=3))
+        names = self.check_records(g4regex)
+        # some matches have all four tetrads bulged (bulge flag 15)
+        self.assertTrue(any(n.startswith('3t15b') for n in names))
+
+    def test_partial_tetrads(self):
+        g4regex = g4.PartialG4Regex(
+            tetrad_kwargs=dict(start=2, stop=3),
+            inter_kwargs=dict(start=2, stop=4),
+            score_kwargs=dict(loop_pen_factor=2))
+        names = self.check_records(g4regex, partial=True)
+        self.assertSetEqual(names, set(['PG4_2t_2', 'PG4_3t_2', 'PG4_3t_3']))
+
+
+class TestG4RegexCombinedEngine(unittest.TestCase):
+    '''
+    combined engine should find the same records as the regex engine,
+    ordered by position rather than by pattern
+    '''
+
+    def setUp(self):
+        self.test_params = dict(
+            tetrad_kwargs=dict(start=2, stop=3),
+            bulge_kwargs=dict(bulges_allowed=1, start=1, stop=5)
+        )
+        self.g4regex = g4.G4Regex(**self.test_params)
+        self.combined = g4.G4Regex(engine='combined', **self.test_params)
+        self.seqs = [
+            'AAGGGACTGGGATGGGTTTGGGTTT',
+            'AAGGAGACTTGGGATGGGTTTGGGTTT',
+            'AACCCACTTCCCATCCCTTAAAAAATCCCTTTCCTCCTACC',
+        ]
+
+    def test_combined_pattern(self):
+        combined = self.combined._patterns.combined('+')
+        for seq in self.seqs:
+            starts = sorted(set(
+                m.start() for r in self.g4regex._patterns['+']
+                for m in r.finditer(seq, overlapped=True)))
+            self.assertListEqual(
+                [m.start() for m in combined.finditer(seq, overlapped=True)],
+                starts)
+
+    def test_matching(self):
+        for seq in self.seqs:
+            for use_bed12 in (True, False):
+                records = list(self.combined.get_g4s_as_bed(
+                    seq, seq_id='test', use_bed12=use_bed12))
+                self.assertListEqual(
+                    sorted(records),
+                    sorted(self.g4regex.get_g4s_as_bed(
+                        seq, seq_id='test', use_bed12=use_bed12)))
+                plus = [int(r.split()[1]) for r in records if '\t+\t' in r]
+                self.assertListEqual(plus, sorted(plus))
+
+
+class TestG4RegexChunked(unittest.TestCase):
+    '''
+    chunked scanning should find exactly the same records as scanning the
+    whole sequence
+    '''
+
+    def setUp(self):
+        random.seed(5)
+        self.seqs = [
+            ''.join(random.choice('GGGGCCCCATN') for _ in range(300))
+            for _ in range(10)]
+
+    def test_max_length(self):
+        self.assertEqual(g4.G4Regex().max_length, 3 * 4 + 7 * 3)
+        g4regex = g4.G4Regex(
+            tetrad_kwargs=dict(start=2, stop=4),
+            bulge_kwargs=dict(bulges_allowed=1, start=1, stop=5))
+        self.assertEqual(g4regex.max_length, 4 * 4 + 7 * 3 + 5)
+        g4regex = g4.G4Regex(
+            bulge_kwargs=dict(bulges_allowed=2, start=1, stop=5))
+        self.assertEqual(g4regex.max_length, 3 * 4 + 7 * 3 + 5 * 2)
+        g4regex = g4.PartialG4Regex(inter_kwargs=dict(start=2, stop=3))
+        self.assertEqual(g4regex.max_length, 3 * 3 + 7 * 2)
+
+    def test_no_patterns(self):
+        # an empty tetrad range gives no patterns and no G4s
+        seq = self.seqs[0]
+        for g4regex in (
+                g4.G4Regex(tetrad_kwargs=dict(start=4, stop=3)),
+                g4.PartialG4Regex(tetrad_kwargs=dict(start=1, stop=1))):
+            self.assertEqual(g4regex.max_length, 0)
+            self.assertEqual(g4regex.min_run, 0)
+            self.assertEqual(g4regex.min_table_run, 0)
+            self.assertListEqual(list(g4regex.get_g4s_as_bed(seq, 'test')), [])
+            self.assertListEqual(
+                list(g4regex.get_g4s_as_bed(seq, 'test', chunk_size=17)), [])
+        for engine in g4.ENGINES:
+            g4regex = g4.G4Regex(
+                tetrad_kwargs=dict(start=4, stop=3), engine=engine)
+            self.assertListEqual(list(g4regex.get_g4s_as_bed(seq, 'test')), [])
+            self.assertListEqual(
+                list(g4regex.get_g4s_from_runs(g4.RunTable(seq))), [])
+
+    def test_chunked_matching(self):
+        for cls, params in [
+                (g4.G4Regex, dict(tetrad_kwargs=dict(start=2, stop=3))),
+                (g4.G4Regex, dict(
+                    bulge_kwargs=dict(bulges_allowed=2, start=1, stop=5))),
+                (g4.PartialG4Regex, dict(inter_kwargs=dict(start=2, stop=3)))]:
+            g4regex = cls(**params)
+            for seq in self.seqs:
+                records = list(g4regex.get_g4s_as_bed(seq, 'test'))
+                for chunk_size in (1, 17, 100):
+                    self.assertListEqual(
+                        list(g4regex.get_g4s_as_bed(
+                            seq, 'test', chunk_size=chunk_size)),
+                        records)
+
+    def test_sorted_output(self):
+        # every engine gives records ordered by start position, with ties
+        # in the same order
+        params = dict(bulge_kwargs=dict(bulges_allowed=1, start=1, stop=3),
+                      tetrad_kwargs=dict(start=2, stop=3))
+        for seq in self.seqs:
+            records = list(g4.G4Regex(**params).get_g4s(seq, 'test'))
+            starts = [r.start for r in records]
+            self.assertListEqual(starts, sorted(starts))
+            for engine in g4.ENGINES[1:]:
+                self.assertListEqual(
+                    list(g4.G4Regex(engine=engine, **params).get_g4s(
+                        seq, 'test', chunk_size=50)),
+                    records)
+
+
+class TestG4RegexArrays(unittest.TestCase):
+    '''
+    get_g4s_as_arrays should have one row per record from get_g4s, with
+    the same coordinates and scores
+    '''
+
+    def setUp(self):
+        random.seed(11)
+        self.seq = ''.join(random.choice('GGGGCCCCATN') for _ in range(2000))
+
+    def test_arrays(self):
+        for cls, params in [
+                (g4.G4Regex, dict()),
+                (g4.G4Regex, dict(
+                    engine='runs',
+                    bulge_kwargs=dict(bulges_allowed=1, start=1, stop=3))),
+                (g4.PartialG4Regex, dict(inter_kwargs=dict(start=2, stop=4)))]:
+            g4regex = cls(**params)
+            records = list(g4regex.get_g4s(self.seq, 'test'))
+            for batch_size in (1, 10, g4.ARRAY_BATCH_SIZE):
+                g4s = g4regex.get_g4s_as_arrays(
+                    self.seq, batch_size=batch_size)
+                self.assertEqual(g4s.dtype, g4regex.array_dtype)
+                self.assertListEqual(
+                    [(int(x['start']), int(x['end']), str(x['strand']),
+                      float(x['score'])) for x in g4s],
+                    [(r.start, r.end, r.strand, r.score) for r in records])
+
+    def test_fields(self):
+        g4s = g4.PartialG4Regex(inter_kwargs=dict(start=2, stop=3)
+                                ).get_g4s_as_arrays('GGGAGGGAAGGG')
+        self.assertListEqual(g4s['n_tetrad'].tolist(), [2, 3, 2])
+        self.assertListEqual(g4s['loop0'].tolist(), [1, 1, 2])
+        self.assertListEqual(g4s['loop1'].tolist(), [-1, 2, -1])
+        self.assertEqual(len(g4.G4Regex().get_g4s_as_arrays('ACGT')), 0)
+
+
+class TestG4RegexPrefilter(unittest.TestCase):
+    '''
+    scanning only the candidate windows should find exactly the same
+    records, in the same order, as scanning the whole sequence
+    '''
+
+    def setUp(self):
+        random.seed(7)
+        self.seqs = [
+            ''.join(random.choice(['N' * 2500, 'AT' * 700, 'CCCAGGGTGGGAGGG'])
+                    + ''.join(random.choice('GGGCCCATNgc')
+                              for _ in range(random.randint(0, 200)))
+                    for _ in range(8))
+            for _ in range(5)]
+
+    def test_min_run(self):
+        self.assertEqual(g4.G4Regex().min_run, 3)
+        self.assertEqual(g4.G4Regex(
+            tetrad_kwargs=dict(start=2, stop=4)).min_run, 2)
+        # with three bulges, one tetrad is always unbulged
+        self.assertEqual(g4.G4Regex(
+            bulge_kwargs=dict(bulges_allowed=3)).min_run, 3)
+        self.assertEqual(g4.G4Regex(
+            bulge_kwargs=dict(bulges_allowed=4)).min_run, 2)
+
+    def test_candidate_windows(self):
+        g4regex = g4.G4Regex()
+        seq = 'N' * 5000 + 'GGGAGGGAGGGAGGG' + 'A' * 5000
+        self.assertListEqual(
+            g4regex._candidate_windows(seq, len(seq)),
+            [(5000 - g4regex.max_length, 6000 + g4regex.max_length, 6000)])
+        self.assertListEqual(g4regex._candidate_windows(seq, 4000), [])
+        self.assertListEqual(g4regex._candidate_windows('N' * 5000, 5000), [])
+
+    def test_prefilter_matching(self):
+        for engine in ('regex', 'combined'):
+            for params in [
+                    dict(),
+                    dict(soft_mask=True),
+                    dict(tetrad_kwargs=dict(start=2, stop=4),
+                         bulge_kwargs=dict(
+                             bulges_allowed=2, start=1, stop=3))]:
+                g4regex = g4.G4Regex(engine=engine, **params)
+                unfiltered = g4.G4Regex(
+                    engine=engine, prefilter=False, **params)
+                for seq in self.seqs:
+                    for chunk_size in (None, 1500):
+                        self.assertListEqual(
+                            list(g4regex.get_g4s_as_bed(
+                                seq, 'test', chunk_size=chunk_size)),
+                            list(unfiltered.get_g4s_as_bed(
+                                seq, 'test', chunk_size=chunk_size)))
+
+
+class TestG4RegexMinScore(unittest.TestCase):
+    '''
+    with a min_score, every engine should give exactly the records scoring
+    at least min_score, in the same order, as filtering afterwards
+    '''
+
+    def setUp(self):
+        random.seed(37)
+        self.seqs = [
+            ''.join(random.choice(['GGG', 'GGGG', 'GG', 'T', 'TTTTT', 'A',
+                                   'C', 'N', 'ggg'])
+                    for _ in range(random.randint(10, 40)))
+            for _ in range(20)]
+
+    def test_min_score(self):
+        for cls, params in [
+                (g4.G4Regex, dict()),
+                (g4.G4Regex, dict(
+                    tetrad_kwargs=dict(start=2, stop=4),
+                    bulge_kwargs=dict(bulges_allowed=2, start=1, stop=3))),
+                (g4.G4Regex, dict(
+                    soft_mask=True,
+                    loop_kwargs_list=[
+                        dict(start=1, stop=5, allow_G=False),
+                        dict(start=2, stop=9, allow_G=True),
+                        dict(start=1, stop=3, allow_G=False)],
+                    bulge_kwargs=dict(bulges_allowed=1, start=1, stop=5))),
+                (g4.PartialG4Regex, dict(
+                    tetrad_kwargs=dict(start=2, stop=3),
+                    inter_kwargs=dict(start=2, stop=4)))]:
+            records = [list(cls(**params).get_g4s(seq, 'test'))
+                       for seq in self.seqs]
+            for min_score in (20, 40, 45.5, 52):
+                for engine in g4.ENGINES:
+                    g4regex = cls(engine=engine, min_score=min_score,
+                                  **params)
+                    for seq, seq_records in zip(self.seqs, records):
+                        expected = [r for r in seq_records
+                                    if r.score >= min_score]
+                        self.assertListEqual(
+                            list(g4regex.get_g4s(seq, 'test')), expected)
+                        self.assertListEqual(
+                            list(g4regex.get_g4s(
+                                seq, 'test', chunk_size=50)), expected)
+                        self.assertListEqual(
+                            list(g4regex.get_g4s_from_runs(
+                                g4.RunTable(seq, g4regex._params['soft_mask']),
+                                'test')),
+                            expected)
+
+    def test_tightened_patterns(self):
+        # 60 - 1.5 * gap >= 50 allows 6 bases of loops, at least 1 each
+        g4regex = g4.G4Regex(min_score=50)
+        self.assertListEqual(
+            [e[3] for e in g4regex._specs['+'][0] if e[0] == 'loop'],
+            [4, 4, 4])
+        self.assertEqual(g4regex.max_length, 3 * 4 + 3 * 4)
+        self.assertIn('[ACGT]{1,4}?', g4regex._regex['-'][0])
+        # bulged patterns lose 5 more, so only 2 bases of loops are allowed
+        g4regex = g4.G4Regex(min_score=50, bulge_kwargs=dict(
+            bulges_allowed=1, start=1, stop=5))
+        self.assertEqual(len(g4regex._specs['+']), 1)
+        # unchanged patterns are the same as without min_score
+        self.assertListEqual(
+            g4.G4Regex(min_score=0)._regex['+'], g4.G4Regex()._regex['+'])
+        with self.assertRaises(ValueError):
+            g4.G4Regex(min_score=61)
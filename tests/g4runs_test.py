@@ -0,0 +1,265 @@
+import sys
+import os
+import random
+import unittest
+from io import StringIO
+from contextlib import redirect_stderr
+from tempfile import mkstemp
+import numpy as np
+
+sys.path.append(
+    os.path.abspath(os.path.dirname(
+            os.path.dirname(
+                __file__))))
+
+import g4funcs as g4
+from g4funcs import g4predict
+
+
+def random_seq(length, alphabet='GGGGCCCCATNgca'):
+    return ''.join(random.choice(alphabet) for _ in range(length))
+
+
+class TestRunTable(unittest.TestCase):
+
+    def setUp(self):
+        self.table = g4.RunTable('AAGGGTGGNNCCCCggg')
+        self.masked_table = g4.RunTable('AAGGGTGGNNCCCCggg', soft_mask=True)
+
+    def test_runs(self):
+        self.assertEqual(self.table.runs('G'), ([2, 6, 14], [5, 8, 17]))
+        self.assertEqual(self.table.runs('G', 3), ([2, 14], [5, 17]))
+        self.assertEqual(self.table.runs('C'), ([10], [14]))
+        self.assertEqual(self.table.runs('N'), ([8], [10]))
+        # soft masked bases are invalid when soft masking is on
+        self.assertEqual(self.masked_table.runs('G', 3), ([2], [5]))
+        self.assertEqual(self.masked_table.runs('N'), ([8, 14], [10, 17]))
+
+    def test_tetrads(self):
+        self.assertListEqual(list(self.table.tetrad_starts('C', 3)), [10, 11])
+        self.assertTrue(self.table.is_tetrad('G', 2, 3))
+        self.assertFalse(self.table.is_tetrad('G', 3, 3))
+        self.assertListEqual(
+            list(self.table.tetrad_ends('G', 2, 0, 9)), [4, 5, 8])
+
+    def test_barriers(self):
+        self.assertEqual(self.table.next_run(('N',), 0), 8)
+        self.assertEqual(self.table.next_run(('N', 'C'), 9), 9)
+        self.assertEqual(self.table.next_run(('N',), 10), 17)
+        self.assertEqual(self.table.prev_run_end(('N', 'G'), 12), 10)
+        self.assertEqual(self.table.prev_run_end(('C',), 10), 0)
+
+
+class TestRunEngine(object):
+    '''
+    The run engine should give exactly the same records, in the same order,
+    as the regex engine.
+    '''
+
+    def test_same_as_regex_engine(self):
+        random.seed(42)
+        regex_engine = self.cls(**self.test_params)
+        run_engine = self.cls(engine='runs', **self.test_params)
+        for _ in range(25):
+            seq = random_seq(random.randint(20, 250))
+            for use_bed12 in (True, False):
+                self.assertListEqual(
+                    list(run_engine.get_g4s_as_bed(seq, 'test', use_bed12)),
+                    list(regex_engine.get_g4s_as_bed(seq, 'test', use_bed12)))
+
+    def test_extend_same_as_combined_engine(self):
+        # the extend engine orders records by position, like combined
+        random.seed(43)
+        combined = self.cls(engine='combined', **self.test_params)
+        extend_engine = self.cls(engine='extend', **self.test_params)
+        soft_mask = self.test_params.get('soft_mask', False)
+        for _ in range(25):
+            seq = random_seq(random.randint(20, 250))
+            records = list(combined.get_g4s_as_bed(seq, 'test'))
+            self.assertListEqual(
+                list(extend_engine.get_g4s_as_bed(seq, 'test')), records)
+            # starts found from the run table alone, e.g. for a run index
+            self.assertListEqual(
+                [str(r) for r in extend_engine.get_g4s_from_runs(
+                    g4.RunTable(seq, soft_mask), 'test')],
+                records)
+
+
+class TestRunEngineDefault(TestRunEngine, unittest.TestCase):
+
+    def setUp(self):
+        self.cls = g4.G4Regex
+        self.test_params = dict()
+
+
+class TestRunEngineTwoToFourTetrad(TestRunEngine, unittest.TestCase):
+
+    def setUp(self):
+        self.cls = g4.G4Regex
+        self.test_params = dict(tetrad_kwargs=dict(start=2, stop=4))
+
+
+class TestRunEngineBulges(TestRunEngine, unittest.TestCase):
+
+    def setUp(self):
+        self.cls = g4.G4Regex
+        self.test_params = dict(
+            bulge_kwargs=dict(bulges_allowed=2, start=1, stop=3))
+
+
+class TestRunEngineBulgesThreeToFiveTetrad(TestRunEngine, unittest.TestCase):
+
+    def setUp(self):
+        self.cls = g4.G4Regex
+        self.test_params = dict(
+            tetrad_kwargs=dict(start=3, stop=5),
+            bulge_kwargs=dict(bulges_allowed=1, start=1, stop=3))
+
+    def test_bulged_tetrad_lengths(self):
+        # every tetrad length can be bulged, not just the shortest
+        g4regex = self.cls(**self.test_params)
+        for specs in g4regex._specs.values():
+            self.assertSetEqual(
+                set(e[2] + e[3] for spec in specs for e in spec
+                    if e[0] == 'btet'),
+                {3, 4, 5})
+        # a four tetrad G4 with a bulge in its second tetrad
+        seq = 'TGGGGAGGTGGAGGGGAGGGGT'
+        for engine in g4.ENGINES:
+            records = list(self.cls(engine=engine, **self.test_params)
+                           .get_g4s_as_bed(seq, 'test', use_bed12=False))
+            self.assertIn('test\t1\t21\t4t2b1,1,1l\t69.0\t+', records)
+            self.assertEqual(len(records), 5)
+
+
+class TestRunEngineNoGLoops(TestRunEngine, unittest.TestCase):
+
+    def setUp(self):
+        self.cls = g4.G4Regex
+        self.test_params = dict(
+            loop_kwargs_list=[
+                dict(start=1, stop=5, allow_G=False),
+                dict(start=2, stop=9, allow_G=True),
+                dict(start=1, stop=3, allow_G=False)],
+            bulge_kwargs=dict(bulges_allowed=1, start=1, stop=2))
+
+
+class TestRunEngineSoftMask(TestRunEngine, unittest.TestCase):
+
+    def setUp(self):
+        self.cls = g4.G4Regex
+        self.test_params = dict(
+            soft_mask=True,
+            bulge_kwargs=dict(bulges_allowed=1, start=1, stop=5))
+
+
+class TestRunEngineIntermolecular(TestRunEngine, unittest.TestCase):
+
+    def setUp(self):
+        self.cls = g4.PartialG4Regex
+        self.test_params = dict(
+            tetrad_kwargs=dict(start=2, stop=3),
+            inter_kwargs=dict(start=2, stop=4))
+
+
+class TestRunIndex(unittest.TestCase):
+
+    def setUp(self):
+        random.seed(7)
+        self.seqs = [
+            ('chr{}'.format(i), random_seq(random.randint(50, 500)))
+            for i in range(4)]
+        self.seqs.append(('empty', ''))
+        fd, self.fn = mkstemp(suffix='.npz')
+        os.close(fd)
+
+    def tearDown(self):
+        os.remove(self.fn)
+
+    def test_find_array_runs(self):
+        seq_array = np.frombuffer(b'GGAGNNGgGG', dtype=np.uint8)
+        starts, lengths = g4.find_array_runs(seq_array, b'Gg')
+        self.assertListEqual(starts.tolist(), [0, 3, 6])
+        self.assertListEqual(lengths.tolist(), [2, 1, 4])
+        starts, lengths = g4.find_array_runs(seq_array, b'ACGT', invert=True)
+        self.assertListEqual(starts.tolist(), [4, 7])
+        self.assertListEqual(lengths.tolist(), [2, 1])
+
+    def test_same_as_sequence(self):
+        for soft_mask in (False, True):
+            self.assertEqual(
+                g4.build_run_index(self.seqs, self.fn, soft_mask=soft_mask,
+                                   min_run=1),
+                len(self.seqs))
+            index = g4.RunIndex(self.fn)
+            self.assertListEqual(index.names, [x for x, _ in self.seqs])
+            g4regex = g4.G4Regex(
+                soft_mask=soft_mask,
+                bulge_kwargs=dict(bulges_allowed=1, start=1, stop=3))
+            tables = index.iter_tables(soft_mask)
+            for (seq_id, seq), (table_id, table) in zip(self.seqs, tables):
+                self.assertEqual(seq_id, table_id)
+                self.assertListEqual(
+                    list(g4regex.get_g4s_from_runs(table, seq_id)),
+                    list(g4regex.get_g4s(seq, seq_id)))
+
+    def test_min_run(self):
+        g4.build_run_index(self.seqs, self.fn, min_run=3)
+        index = g4.RunIndex(self.fn)
+        seq_id, seq = self.seqs[0]
+        g4regex = g4.G4Regex()
+        self.assertListEqual(
+            list(g4regex.get_g4s_from_runs(index.table(0), seq_id)),
+            list(g4regex.get_g4s(seq, seq_id)))
+        # two tetrad G4s need runs of two
+        g4regex = g4.G4Regex(tetrad_kwargs=dict(start=2, stop=3))
+        with self.assertRaises(ValueError):
+            list(g4regex.get_g4s_from_runs(index.table(0), seq_id))
+        # index was built without soft masking
+        with self.assertRaises(ValueError):
+            next(index.iter_tables(soft_mask=True))
+
+    def test_min_table_run(self):
+        # an index of the shortest runs the patterns need is enough
+        for params in [
+                dict(),
+                dict(tetrad_kwargs=dict(start=2, stop=4)),
+                dict(loop_kwargs_list=[dict(start=1, stop=7, allow_G=False)]
+                     * 3),
+                dict(bulge_kwargs=dict(bulges_allowed=1, start=1, stop=3))]:
+            g4regex = g4.G4Regex(engine='runs', **params)
+            min_run = g4regex.min_table_run
+            g4.build_run_index(self.seqs, self.fn, min_run=min_run)
+            index = g4.RunIndex(self.fn)
+            index.check_min_run(min_run)
+            for (seq_id, seq), (_, table) in zip(
+                    self.seqs, index.iter_tables()):
+                self.assertListEqual(
+                    list(g4regex.get_g4s_from_runs(table, seq_id)),
+                    list(g4regex.get_g4s(seq, seq_id)))
+            with self.assertRaises(ValueError):
+                index.check_min_run(min_run - 1)
+
+    def test_predict_args(self):
+        # an incompatible index is rejected before any output is written
+        g4.build_run_index(self.seqs, self.fn, min_run=2)
+        args = ['intra', '-i', self.fn, '-b', '-']
+        general_params, g4regex = g4predict.parse_args(args)
+        self.assertEqual(general_params['index'], self.fn)
+        for extra in (['-B', '1'], ['-G', '0'], ['-c']):
+            with redirect_stderr(StringIO()) as err:
+                with self.assertRaises(SystemExit):
+                    g4predict.parse_args(args + extra)
+            self.assertIn('rebuild', err.getvalue())
+        # tables from an index are not scanned in threads, whatever engine
+        for engine in ('runs', 'extend'):
+            with redirect_stderr(StringIO()) as err:
+                with self.assertRaises(SystemExit):
+                    g4predict.parse_args(
+                        args + ['-e', engine, '-p', '2', '-P', 'thread'])
+            self.assertIn('--pool thread cannot be used with --index',
+                          err.getvalue())
+
+
+if __name__ == '__main__':
+    unittest.main()